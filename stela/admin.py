@@ -30,7 +30,7 @@ class CuentaAdmin(admin.ModelAdmin):
 from stela.models.finanzas import (
     Periodo, Balance, BalanceDetalle,
     LineaEstado, MapeoCuentaLinea,
-    RatioDef, ResultadoRatio
+    RatioDef, ResultadoRatio, RatioSector
 )
 
 @admin.register(Periodo)
@@ -72,3 +72,9 @@ class ResultadoRatioAdmin(admin.ModelAdmin):
     list_display = ("empresa", "periodo", "ratio", "valor")
     list_filter = ("periodo__anio", "ratio")
     search_fields = ("empresa__razon_social", "empresa__nit")
+
+@admin.register(RatioSector)
+class RatioSectorAdmin(admin.ModelAdmin):
+    list_display = ("ciiu", "ratio", "valor")
+    list_filter = ("ratio",)
+    search_fields = ("ciiu__codigo", "ciiu__descripcion")
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class StelaConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'stela'
+
+    def ready(self):
+        # Registrar receptores de señales (invalidación de caches)
+        from . import signals  # noqa: F401
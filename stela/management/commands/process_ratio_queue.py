@@ -0,0 +1,36 @@
+"""
+Vacía la cola de recálculo de ratios (RecalculoPendiente) que llenan los
+endpoints de lectura cuando a un período le faltan ratios guardados.
+Sin --loop procesa lo que haya y termina (apto para cron); con --loop queda
+revisando la cola cada --intervalo segundos.
+"""
+import time
+from django.core.management.base import BaseCommand, CommandError
+from stela.services.cola_ratios import procesar_cola_ratios
+
+
+class Command(BaseCommand):
+    help = "Recalcula en segundo plano los períodos encolados por falta de ratios guardados"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limite', type=int, help='Máximo de períodos por pasada')
+        parser.add_argument('--tipo', choices=['BAL', 'RES'], default='RES',
+                            help='Estado con prioridad en el cálculo (default: RES)')
+        parser.add_argument('--loop', action='store_true', help='Seguir revisando la cola indefinidamente')
+        parser.add_argument('--intervalo', type=float, default=5,
+                            help='Segundos de espera entre pasadas con --loop (default: 5)')
+
+    def handle(self, *args, **o):
+        if o['limite'] is not None and o['limite'] < 1:
+            raise CommandError("--limite debe ser mayor que 0")
+
+        while True:
+            procesados = procesar_cola_ratios(limite=o['limite'], tipo_estado=o['tipo'])
+            if procesados:
+                self.stdout.write(self.style.SUCCESS(f'OK: ratios recalculados para {procesados} período(s)'))
+            if not o['loop']:
+                if not procesados:
+                    self.stdout.write('La cola está vacía')
+                return
+            if not procesados:
+                time.sleep(o['intervalo'])
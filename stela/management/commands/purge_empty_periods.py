@@ -0,0 +1,24 @@
+"""
+Elimina los períodos sin estados financieros (y sus ratios calculados).
+Antes lo hacía empresa_detalles en cada GET; ahora es mantenimiento. Conviene
+correrlo fuera de las cargas de estados: una carga crea el período antes que
+sus balances.
+"""
+from django.core.management.base import BaseCommand, CommandError
+from stela.services.estados import eliminar_periodos_vacios
+
+
+class Command(BaseCommand):
+    help = "Elimina los períodos sin ningún estado financiero (Balance) y sus ratios"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--empresa', nargs='+', help='NIT de una o más empresas')
+        parser.add_argument('--all', action='store_true', help='Revisar todas las empresas')
+
+    def handle(self, *args, **o):
+        if not (o['all'] or o['empresa']):
+            raise CommandError("Debes pasar --all o --empresa")
+
+        filtros = {'empresa__nit__in': o['empresa']} if o['empresa'] else {}
+        eliminados = eliminar_periodos_vacios(**filtros)
+        self.stdout.write(self.style.SUCCESS(f'OK: {eliminados} período(s) vacío(s) eliminado(s)'))
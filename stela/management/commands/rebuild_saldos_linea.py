@@ -0,0 +1,33 @@
+"""
+Reconstruye en bloque la tabla materializada SaldoLinea.
+Útil tras cargar datos por fuera de la aplicación o cambiar LineaEstado.
+"""
+from django.core.management.base import BaseCommand, CommandError
+from stela.models.finanzas import Balance
+from stela.services.saldos_linea import reconstruir_saldos_linea
+
+
+class Command(BaseCommand):
+    help = "Reconstruye SaldoLinea (montos por línea de estado) para las empresas indicadas"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--empresa', nargs='+', help='NIT de una o más empresas')
+        parser.add_argument('--all', action='store_true', help='Reconstruir todos los balances')
+        parser.add_argument('--lote', type=int, default=500,
+                            help='Balances por transacción (default: 500)')
+
+    def handle(self, *args, **o):
+        if not (o['all'] or o['empresa']):
+            raise CommandError("Debes pasar --all o --empresa")
+        if o['lote'] < 1:
+            raise CommandError("--lote debe ser mayor que 0")
+
+        balances = Balance.objects.all()
+        if o['empresa']:
+            balances = balances.filter(empresa__nit__in=o['empresa'])
+        ids = list(balances.order_by('empresa_id', 'periodo_id').values_list('id_balance', flat=True))
+
+        filas = 0
+        for i in range(0, len(ids), o['lote']):
+            filas += reconstruir_saldos_linea(Balance.objects.filter(pk__in=ids[i:i + o['lote']]))
+        self.stdout.write(self.style.SUCCESS(f'OK: {filas} saldo(s) de línea en {len(ids)} balance(s)'))
@@ -0,0 +1,93 @@
+"""
+Recalcula ResultadoRatio para muchas (empresa, periodo) en paralelo.
+
+Los pares se reparten en lotes entre procesos; cada proceso abre su propia
+conexión a la BD y resuelve su lote con calcular_ratios_batch (consultas
+agregadas + un solo upsert por lote).
+
+Los modelos y servicios se importan dentro de las funciones: con el método
+'spawn' (Windows/macOS) el proceso hijo importa este módulo antes de que
+Django esté configurado.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+
+
+def _inicializar_worker():
+    # En 'spawn' configura Django; en 'fork' descarta la conexión heredada del padre
+    django.setup()
+    connections.close_all()
+
+
+def _procesar_lote(pares, tipo_estado):
+    from stela.services.ratios_batch import calcular_ratios_batch
+    empresas = {empresa_id for empresa_id, _ in pares}
+    periodos = {periodo_id for _, periodo_id in pares}
+    # Los id de Periodo son únicos por empresa: filtrar por ambos da exactamente el lote
+    batch = calcular_ratios_batch(empresas, periodos, tipo_estado=tipo_estado)
+    return len(batch.pares)
+
+
+class Command(BaseCommand):
+    help = "Recalcula los ratios (ResultadoRatio) por empresa, CIIU y/o año usando varios procesos"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--empresa', nargs='+', help='NIT de una o más empresas')
+        parser.add_argument('--ciiu', nargs='+', help='Código CIIU de las empresas a recalcular')
+        parser.add_argument('--anio', type=int, nargs='+', help='Año(s) de los períodos a recalcular')
+        parser.add_argument('--all', action='store_true', help='Recalcular todas las empresas y períodos')
+        parser.add_argument('--tipo', choices=['BAL', 'RES'], default='RES',
+                            help='Estado con prioridad en el cálculo (default: RES)')
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                            help='Procesos en paralelo (default: núcleos disponibles)')
+        parser.add_argument('--lote', type=int, default=200,
+                            help='Pares (empresa, periodo) por unidad de trabajo (default: 200)')
+
+    def handle(self, *args, **o):
+        from stela.models.finanzas import Balance
+
+        if not (o['all'] or o['empresa'] or o['ciiu'] or o['anio']):
+            raise CommandError("Debes pasar --all o al menos uno de --empresa, --ciiu, --anio")
+        if o['workers'] < 1 or o['lote'] < 1:
+            raise CommandError("--workers y --lote deben ser mayores que 0")
+
+        balances = Balance.objects.all()
+        if o['empresa']:
+            balances = balances.filter(empresa__nit__in=o['empresa'])
+        if o['ciiu']:
+            balances = balances.filter(empresa__ciiu__codigo__in=o['ciiu'])
+        if o['anio']:
+            balances = balances.filter(periodo__anio__in=o['anio'])
+        pares = list(
+            balances.values_list('empresa_id', 'periodo_id').distinct().order_by('empresa_id', 'periodo_id')
+        )
+        if not pares:
+            self.stdout.write(self.style.WARNING('No hay estados financieros que coincidan con los filtros'))
+            return
+
+        # Lotes contiguos: los pares de una misma empresa quedan juntos
+        lote = o['lote']
+        lotes = [pares[i:i + lote] for i in range(0, len(pares), lote)]
+        workers = min(o['workers'], len(lotes))
+        if connection.vendor == 'sqlite':
+            # SQLite serializa las escrituras: varios procesos solo compiten por el lock
+            workers = 1
+
+        self.stdout.write(f'Recalculando {len(pares)} período(s) en {len(lotes)} lote(s) con {workers} proceso(s)...')
+        procesados = 0
+        if workers == 1:
+            for pares_lote in lotes:
+                procesados += _procesar_lote(pares_lote, o['tipo'])
+        else:
+            # Los hijos no deben heredar la conexión abierta del padre
+            connections.close_all()
+            with ProcessPoolExecutor(max_workers=workers, initializer=_inicializar_worker) as pool:
+                futuros = [pool.submit(_procesar_lote, pares_lote, o['tipo']) for pares_lote in lotes]
+                for futuro in as_completed(futuros):
+                    procesados += futuro.result()
+                    self.stdout.write(f'  {procesados}/{len(pares)}')
+
+        self.stdout.write(self.style.SUCCESS(f'OK: ratios recalculados para {procesados} período(s)'))
@@ -0,0 +1,45 @@
+"""
+Recalcula en bloque la tabla EstadisticaSector (n, promedio, desviación y
+percentiles de cada ratio por CIIU y año/mes).
+Útil tras cargar ResultadoRatio por fuera de la aplicación; en el uso normal
+las celdas se refrescan solas al recalcular ratios.
+"""
+from django.core.management.base import BaseCommand, CommandError
+from stela.models.finanzas import EstadisticaSector, ResultadoRatio
+from stela.services.estadistica_sector import celdas_con_ancestros, refrescar_estadisticas_sector
+
+
+class Command(BaseCommand):
+    help = "Recalcula las estadísticas sectoriales (EstadisticaSector) por CIIU y año"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ciiu', nargs='+', help='Código(s) CIIU a recalcular')
+        parser.add_argument('--anio', type=int, nargs='+', help='Año(s) a recalcular')
+        parser.add_argument('--all', action='store_true', help='Recalcular todas las celdas')
+
+    def handle(self, *args, **o):
+        if not (o['all'] or o['ciiu'] or o['anio']):
+            raise CommandError("Debes pasar --all o al menos uno de --ciiu, --anio")
+
+        resultados = ResultadoRatio.objects.filter(empresa__ciiu__isnull=False)
+        guardadas = EstadisticaSector.objects.all()
+        if o['ciiu']:
+            resultados = resultados.filter(empresa__ciiu_id__in=o['ciiu'])
+            guardadas = guardadas.filter(ciiu_id__in=o['ciiu'])
+        if o['anio']:
+            resultados = resultados.filter(periodo__anio__in=o['anio'])
+            guardadas = guardadas.filter(anio__in=o['anio'])
+
+        # Cada CIIU con resultados y sus ancestros (la celda de un CIIU agrega su subárbol);
+        # las celdas guardadas que ya no tienen resultados también se recalculan (quedan vacías)
+        celdas = celdas_con_ancestros(
+            resultados.values_list('empresa__ciiu_id', 'empresa__ciiu__ruta', 'periodo__anio', 'periodo__mes')
+            .distinct().order_by()
+        ) | {
+            # EstadisticaSector guarda el período anual como mes 0
+            (ciiu_id, anio, mes or None)
+            for ciiu_id, anio, mes in guardadas.values_list('ciiu_id', 'anio', 'mes').distinct().order_by()
+        }
+
+        filas = refrescar_estadisticas_sector(celdas)
+        self.stdout.write(self.style.SUCCESS(f'OK: {filas} estadística(s) en {len(celdas)} celda(s)'))
@@ -3,6 +3,7 @@ import os
 from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
 from stela.models.ciiu import Ciiu
+from stela.services.ciiu_jerarquia import recalcular_rutas_ciiu
 
 
 class Command(BaseCommand):
@@ -86,6 +87,9 @@ class Command(BaseCommand):
                     else:
                         errores.append(f"CIIU {codigo} tiene padre {codigo_padre} que no existe")
 
+        # Rutas materializadas de toda la jerarquía (subárboles para benchmarks)
+        rutas = recalcular_rutas_ciiu()
+
         # Resultado
         if errores:
             self.stdout.write(self.style.WARNING(f"Se encontraron {len(errores)} errores:"))
@@ -97,5 +101,7 @@ class Command(BaseCommand):
         self.stdout.write(self.style.SUCCESS(
             f"CIIU cargados: {creados} creados, {actualizados} actualizados. Total en BD: {Ciiu.objects.count()}"
         ))
+        if rutas:
+            self.stdout.write(f"Rutas de jerarquía actualizadas: {rutas}")
 
 
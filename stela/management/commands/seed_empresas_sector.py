@@ -22,8 +22,10 @@ from stela.models.ciiu import Ciiu
 from stela.models.catalogo import Catalogo, GrupoCuenta, Cuenta
 from stela.models.finanzas import Periodo, Balance, BalanceDetalle
 from stela.services.plantillas import CUENTAS_BASE
-from stela.services.ratios import calcular_y_guardar_ratios
-from stela.services.estados import recalcular_saldos_detalle
+from stela.services.ratios_batch import calcular_ratios_batch
+from stela.services.ratios_incremental import sin_recalculo_incremental
+from stela.services.estados import recalcular_saldos_balances
+from stela.services.saldos_linea import saldos_recalculados
 
 
 # Cargar ratios sector desde JSON
@@ -348,15 +350,11 @@ def generar_estados_financieros(empresa, catalogo, ratios_sector, anio_inicio=20
                 )
                 detalle.debe = Decimal(str(valores['debe']))
                 detalle.haber = Decimal(str(valores['haber']))
-                detalle.save()
+                detalle.save(update_fields=['debe', 'haber'])
         
         # Recalcular saldos
-        recalcular_saldos_detalle(balance_bal)
-        recalcular_saldos_detalle(balance_res)
-        
-        # Calcular ratios automáticamente
-        calcular_y_guardar_ratios(empresa, periodo, tipo_estado='BAL')
-        calcular_y_guardar_ratios(empresa, periodo, tipo_estado='RES')
+        recalcular_saldos_balances([balance_bal, balance_res])
+        saldos_recalculados([balance_bal, balance_res])
     
     return periodos_creados
 
@@ -422,7 +420,8 @@ class Command(BaseCommand):
         
         empresas_creadas = []
         
-        with transaction.atomic():
+        # Los ratios se calculan todos al final con calcular_ratios_batch
+        with transaction.atomic(), sin_recalculo_incremental():
             for ciiu_codigo in ciiu_codigos:
                 try:
                     ciiu = Ciiu.objects.get(codigo=ciiu_codigo)
@@ -480,6 +479,11 @@ class Command(BaseCommand):
                             f'CIIU: {ciiu.codigo}) - {len(periodos)} períodos generados'
                         )
                     )
+            
+            # Calcular ratios de todas las empresas creadas en una sola pasada vectorizada
+            if empresas_creadas:
+                batch = calcular_ratios_batch([e['empresa'] for e in empresas_creadas])
+                self.stdout.write(f'Ratios calculados para {len(batch.pares)} pares empresa/período')
         
         self.stdout.write(
             self.style.SUCCESS(
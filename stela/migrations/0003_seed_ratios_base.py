@@ -0,0 +1,35 @@
+from django.db import migrations
+
+# Copia fija de los ratios base: las migraciones no importan código de la app
+RATIOS_BASE = [
+    ('LIQUIDEZ_CORRIENTE', 'Liquidez Corriente', '(ACTIVO_CORRIENTE)/(PASIVO_CORRIENTE)', False),
+    ('ENDEUDAMIENTO', 'Endeudamiento', '(PASIVO_CORRIENTE)/(TOTAL_ACTIVO)', True),
+    ('MARGEN_NETO', 'Margen Neto', '(UTILIDAD_NETA)/(VENTAS_NETAS)', True),
+    ('ROA', 'Rentabilidad sobre Activos (ROA)', '(UTILIDAD_NETA)/(TOTAL_ACTIVO)', True),
+    ('ROE', 'Rentabilidad sobre Patrimonio (ROE)', '(UTILIDAD_NETA)/(PATRIMONIO_TOTAL)', True),
+    ('ROTACION_ACTIVOS', 'Rotación de Activos', '(VENTAS_NETAS)/(TOTAL_ACTIVO)', False),
+    ('APALANCAMIENTO', 'Apalancamiento', '(TOTAL_ACTIVO)/(PATRIMONIO_TOTAL)', False),
+    ('CAPITAL_TRABAJO', 'Capital de Trabajo', '(ACTIVO_CORRIENTE)-(PASIVO_CORRIENTE)', False),
+    ('RAZON_ACTIVOS_CORRIENTES', 'Razón de Activos Corrientes', '(ACTIVO_CORRIENTE)/(TOTAL_ACTIVO)', True),
+    ('RAZON_PATRIMONIO', 'Razón de Patrimonio', '(PATRIMONIO_TOTAL)/(TOTAL_ACTIVO)', True),
+]
+
+
+def crear_ratios_base(apps, schema_editor):
+    RatioDef = apps.get_model('stela', 'RatioDef')
+    for clave, nombre, formula, porcentaje in RATIOS_BASE:
+        RatioDef.objects.get_or_create(
+            clave=clave,
+            defaults={'nombre': nombre, 'formula': formula, 'porcentaje': porcentaje}
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stela', '0002_alter_empresa_nit_alter_empresa_telefono'),
+    ]
+
+    operations = [
+        migrations.RunPython(crear_ratios_base, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.1.3 on 2026-10-18 19:23
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stela', '0003_seed_ratios_base'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SaldoLinea',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('monto', models.DecimalField(decimal_places=2, default=0, max_digits=20)),
+                ('balance', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='saldos_linea', to='stela.balance')),
+                ('linea', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='stela.lineaestado')),
+            ],
+            options={
+                'unique_together': {('balance', 'linea')},
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.3 on 2026-10-18 19:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stela', '0004_saldolinea'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='balance',
+            name='revision',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.1.3 on 2026-10-18 19:39
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stela', '0005_balance_revision'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EstadisticaSector',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('anio', models.IntegerField()),
+                ('mes', models.IntegerField(default=0)),
+                ('n', models.PositiveIntegerField()),
+                ('promedio', models.DecimalField(decimal_places=4, max_digits=18)),
+                ('desv', models.DecimalField(decimal_places=4, max_digits=18)),
+                ('p10', models.DecimalField(decimal_places=4, max_digits=18)),
+                ('p25', models.DecimalField(decimal_places=4, max_digits=18)),
+                ('p50', models.DecimalField(decimal_places=4, max_digits=18)),
+                ('p75', models.DecimalField(decimal_places=4, max_digits=18)),
+                ('p90', models.DecimalField(decimal_places=4, max_digits=18)),
+                ('ciiu', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='estadisticas', to='stela.ciiu')),
+                ('ratio', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='stela.ratiodef')),
+            ],
+            options={
+                'unique_together': {('ciiu', 'anio', 'mes', 'ratio')},
+            },
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.1.3 on 2026-10-18 19:41
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stela', '0006_estadisticasector'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RatioSector',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('valor', models.DecimalField(decimal_places=4, max_digits=18)),
+                ('ciiu', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ratios_sector', to='stela.ciiu')),
+                ('ratio', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='stela.ratiodef')),
+            ],
+            options={
+                'unique_together': {('ciiu', 'ratio')},
+            },
+        ),
+    ]
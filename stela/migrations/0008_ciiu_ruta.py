@@ -0,0 +1,38 @@
+# Generated by Django 5.1.3 on 2026-10-18 19:44
+
+from django.db import migrations, models
+
+
+def calcular_rutas(apps, schema_editor):
+    # Misma lógica que services.ciiu_jerarquia.recalcular_rutas_ciiu (las migraciones no importan la app)
+    Ciiu = apps.get_model('stela', 'Ciiu')
+    padres = dict(Ciiu.objects.values_list('codigo', 'padre_id'))
+    rutas = {}
+    for codigo in padres:
+        cadena = []
+        actual = codigo
+        while actual is not None and actual not in rutas and actual not in cadena:
+            cadena.append(actual)
+            actual = padres.get(actual)
+        base = rutas.get(actual, '')
+        for c in reversed(cadena):
+            base = rutas[c] = f'{base}{c}/'
+    Ciiu.objects.bulk_update(
+        [Ciiu(codigo=codigo, ruta=ruta) for codigo, ruta in rutas.items()], ['ruta'], batch_size=500
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stela', '0007_ratiosector'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ciiu',
+            name='ruta',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=255),
+        ),
+        migrations.RunPython(calcular_rutas, migrations.RunPython.noop),
+    ]
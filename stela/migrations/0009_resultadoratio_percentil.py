@@ -0,0 +1,18 @@
+# Generated by Django 5.1.3 on 2026-10-18 19:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stela', '0008_ciiu_ruta'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='resultadoratio',
+            name='percentil',
+            field=models.DecimalField(blank=True, decimal_places=4, max_digits=7, null=True),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.1.3 on 2026-10-18 19:53
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stela', '0009_resultadoratio_percentil'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RecalculoPendiente',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('creado', models.DateTimeField(auto_now_add=True)),
+                ('encolado', models.DateTimeField(auto_now=True)),
+                ('empresa', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='stela.empresa')),
+                ('periodo', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='stela.periodo')),
+            ],
+            options={
+                'unique_together': {('empresa', 'periodo')},
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.1.3 on 2026-10-18 20:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stela', '0010_recalculopendiente'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='empresa',
+            name='datos_actualizados',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='empresa',
+            name='version_datos',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -13,6 +13,12 @@ class Ciiu(models.Model):
         blank=True,                 
         related_name='hijos'        
     )
+    # Ruta materializada de códigos desde la raíz, ej. 'A/01/011/0111/' (ver services/ciiu_jerarquia)
+    ruta = models.CharField(max_length=255, blank=True, default='', db_index=True)
+
+    def codigos_ancestros(self):
+        """Códigos desde este CIIU hasta la raíz (él mismo incluido), según la ruta."""
+        return self.ruta.strip('/').split('/')[::-1] if self.ruta else [self.codigo]
 
     def __str__(self):
         return f"{self.codigo} - {self.descripcion}"
\ No newline at end of file
@@ -20,6 +20,10 @@ class Empresa(models.Model):
     direccion = models.CharField(max_length=255)
     telefono = models.CharField(max_length=9)
     email = models.EmailField()
+    # Versión de los datos financieros (períodos, estados, cuentas, ratios) y
+    # cuándo cambió: ETag y Last-Modified de las APIs JSON (ver version_datos)
+    version_datos = models.PositiveIntegerField(default=0)
+    datos_actualizados = models.DateTimeField(null=True, blank=True)
 
     def __str__(self):
         return f"{self.razon_social} (NIT: {self.nit})"
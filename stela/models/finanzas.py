@@ -1,6 +1,7 @@
 from django.db import models
 from decimal import Decimal
 from .empresa import Empresa
+from .ciiu import Ciiu
 from .catalogo import Cuenta
 
 class Periodo(models.Model):
@@ -24,6 +25,8 @@ class Balance(models.Model):
     empresa = models.ForeignKey(Empresa, on_delete=models.CASCADE)
     periodo = models.ForeignKey(Periodo, on_delete=models.CASCADE)
     tipo_balance = models.CharField(max_length=3, choices=TIPO)
+    # Se incrementa con cada cambio de detalles o mapeos (clave de cache de análisis)
+    revision = models.PositiveIntegerField(default=0)
 
     class Meta:
         unique_together = ('empresa','periodo','tipo_balance')
@@ -57,6 +60,15 @@ class MapeoCuentaLinea(models.Model):
     class Meta:
         unique_together = ('cuenta','linea')
 
+class SaldoLinea(models.Model):
+    """Monto de cada línea de estado por balance (materializado desde estado_dict)."""
+    balance = models.ForeignKey(Balance, on_delete=models.CASCADE, related_name='saldos_linea')
+    linea   = models.ForeignKey(LineaEstado, on_delete=models.CASCADE)
+    monto   = models.DecimalField(max_digits=20, decimal_places=2, default=0)
+
+    class Meta:
+        unique_together = ('balance','linea')
+
 class RatioDef(models.Model):
     clave = models.CharField(max_length=64, unique=True)             # LIQUIDEZ_CORRIENTE
     nombre = models.CharField(max_length=255)
@@ -71,6 +83,47 @@ class ResultadoRatio(models.Model):
     periodo = models.ForeignKey(Periodo, on_delete=models.CASCADE)
     ratio   = models.ForeignKey(RatioDef, on_delete=models.CASCADE)
     valor   = models.DecimalField(max_digits=18, decimal_places=4, null=True)
+    # Rango percentil (0-100) del valor entre las empresas del mismo CIIU y año/mes
+    percentil = models.DecimalField(max_digits=7, decimal_places=4, null=True, blank=True)
 
     class Meta:
         unique_together = ('empresa','periodo','ratio')
+
+class EstadisticaSector(models.Model):
+    """Estadísticas de cada ratio entre las empresas de un CIIU y sus descendientes en un año/mes (precalculadas)."""
+    ciiu     = models.ForeignKey(Ciiu, on_delete=models.CASCADE, related_name='estadisticas')
+    anio     = models.IntegerField()
+    # 0 = período anual (Periodo.mes NULL): con NULL la clave única no evitaría duplicados
+    mes      = models.IntegerField(default=0)
+    ratio    = models.ForeignKey(RatioDef, on_delete=models.CASCADE)
+    n        = models.PositiveIntegerField()
+    promedio = models.DecimalField(max_digits=18, decimal_places=4)
+    desv     = models.DecimalField(max_digits=18, decimal_places=4)
+    p10      = models.DecimalField(max_digits=18, decimal_places=4)
+    p25      = models.DecimalField(max_digits=18, decimal_places=4)
+    p50      = models.DecimalField(max_digits=18, decimal_places=4)
+    p75      = models.DecimalField(max_digits=18, decimal_places=4)
+    p90      = models.DecimalField(max_digits=18, decimal_places=4)
+
+    class Meta:
+        unique_together = ('ciiu','anio','mes','ratio')
+
+class RatioSector(models.Model):
+    """Valor de referencia digitado de un ratio para un CIIU (prevalece sobre ratios_sector.json)."""
+    ciiu  = models.ForeignKey(Ciiu, on_delete=models.CASCADE, related_name='ratios_sector')
+    ratio = models.ForeignKey(RatioDef, on_delete=models.CASCADE)
+    valor = models.DecimalField(max_digits=18, decimal_places=4)
+
+    class Meta:
+        unique_together = ('ciiu','ratio')
+
+class RecalculoPendiente(models.Model):
+    """Par (empresa, periodo) sin ratios guardados, en cola para recalcularse fuera del request."""
+    empresa = models.ForeignKey(Empresa, on_delete=models.CASCADE)
+    periodo = models.ForeignKey(Periodo, on_delete=models.CASCADE)
+    creado  = models.DateTimeField(auto_now_add=True)
+    # Se renueva cada vez que el par se vuelve a encolar (ver procesar_cola_ratios)
+    encolado = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('empresa','periodo')
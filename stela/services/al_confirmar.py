@@ -0,0 +1,44 @@
+"""
+Marcas agrupadas por transacción y procesadas al confirmarla.
+
+El recálculo incremental, la versión de datos y las estadísticas de sector
+marcan lo que cambió mientras se guardan filas y hacen el trabajo una sola
+vez en on_commit. Cada transacción tiene su propio lote de marcas y un único
+callback: la primera marca crea el lote y registra el callback, las
+siguientes solo agregan al lote.
+
+Si la transacción (o el savepoint donde se registró el callback) se revierte,
+Django descarta el callback; la próxima marca encuentra el lote huérfano y
+empieza uno nuevo, así que las marcas revertidas no las procesa el commit de
+otra transacción (ej. el siguiente request del mismo hilo).
+"""
+from django.db import transaction
+
+
+def marcar_al_confirmar(estado, nuevo_lote, agregar, procesar):
+    """
+    Agrega una marca al lote de la transacción en curso; el lote se procesa
+    al confirmarla (de inmediato en modo autocommit).
+
+    Args:
+        estado: threading.local del módulo que marca (guarda el lote vigente)
+        nuevo_lote: función() -> lote vacío
+        agregar: función(lote) que agrega la marca
+        procesar: función(lote) que procesa el lote confirmado
+    """
+    vigente = getattr(estado, 'lote', None)    # (lote, callback)
+    if vigente is not None and any(
+            entrada[1] is vigente[1] for entrada in transaction.get_connection().run_on_commit):
+        agregar(vigente[0])
+        return
+
+    lote = nuevo_lote()
+    agregar(lote)
+
+    def al_confirmar():
+        if estado.lote is registrado:
+            estado.lote = None
+        procesar(lote)
+
+    registrado = estado.lote = (lote, al_confirmar)
+    transaction.on_commit(al_confirmar)
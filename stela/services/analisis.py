@@ -1,8 +1,13 @@
 from decimal import Decimal
-from .estados import estado_dict
+import numpy as np
+from .cubo import cubo_lineas
+from .indice_mapeo import lineas_por_estado
+from .saldos_linea import asegurar_saldos_linea, estado_materializado
 
-def analisis_vertical(empresa, periodo, tipo_estado):
-    data = estado_dict(empresa, periodo, tipo_estado)
+CENTAVOS = Decimal('0.01')
+
+def analisis_vertical(empresa, periodo, tipo_estado, snapshot=None):
+    data = estado_materializado(empresa, periodo, tipo_estado, snapshot=snapshot)
     base = next((v['monto'] for v in data.values() if v['base']), Decimal('0')) or Decimal('1')
     out = []
     for k,v in data.items():
@@ -10,9 +15,27 @@ def analisis_vertical(empresa, periodo, tipo_estado):
         out.append({'clave':k,'nombre':v['nombre'],'monto':v['monto'],'porc':pct})
     return out
 
-def analisis_horizontal(empresa, periodo_base, periodo_act, tipo_estado):
-    a = estado_dict(empresa, periodo_base, tipo_estado)
-    b = estado_dict(empresa, periodo_act,  tipo_estado)
+def analisis_horizontal(empresa, periodo_base, periodo_act, tipo_estado, snapshot_base=None, snapshot_act=None):
+    # Ambos períodos salen de un cubo de SaldoLinea (una consulta)
+    lineas = lineas_por_estado(tipo_estado)
+    claves = [clave for clave, _, _ in lineas]
+    cubo = cubo_lineas(empresa, [periodo_base, periodo_act], tipo_estado, claves=claves)
+    if lineas and all(m is not None for m in cubo.montos.flat):
+        nombres = {clave: nombre for clave, nombre, _ in lineas}
+        base, actual = cubo.columna(periodo_base), cubo.columna(periodo_act)
+        out = []
+        for i, k in sorted(enumerate(cubo.filas.tolist()), key=lambda x: x[1]):
+            va, vb = base[i], actual[i]
+            vari = vb - va
+            porc = (vari/va*Decimal('100')) if va else None
+            out.append({'clave':k, 'nombre':nombres[k],
+                        'base':va, 'actual':vb,
+                        'variacion':vari, 'porc':porc})
+        return out
+
+    # Algún período aún no está materializado: calcular (y materializar) cada uno
+    a = estado_materializado(empresa, periodo_base, tipo_estado, snapshot=snapshot_base)
+    b = estado_materializado(empresa, periodo_act,  tipo_estado, snapshot=snapshot_act)
     claves = set(a.keys()) | set(b.keys())
     out = []
     for k in sorted(claves):
@@ -24,3 +47,74 @@ def analisis_horizontal(empresa, periodo_base, periodo_act, tipo_estado):
                     'base':va['monto'], 'actual':vb['monto'],
                     'variacion':vari, 'porc':porc})
     return out
+
+def _celda(valor):
+    return None if valor is None else valor.quantize(CENTAVOS)
+
+def _porcentaje(valor):
+    return None if np.isnan(valor) else float(valor)
+
+def _dividir(a, b):
+    """a / b * 100 celda por celda; NaN si falta un dato o b es cero."""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return a / np.where(b == 0, np.nan, b) * 100
+
+def analisis_tendencia(empresa, periodos, tipo_estado):
+    """
+    Tendencia de cada línea del estado a lo largo de N períodos, calculada
+    sobre el cubo de SaldoLinea (una consulta) en una pasada vectorizada.
+
+    Por línea y período entrega: monto, variación absoluta y porcentual contra
+    el período anterior, número índice (primer período = 100) y porcentaje
+    vertical sobre la línea base del estado. Monto y variación son importes
+    en Decimal (Cubo.montos); los porcentajes salen de Cubo.valores en
+    float64, donde NaN marca las celdas sin dato.
+
+    Args:
+        empresa: Instancia de Empresa
+        periodos: lista de Periodo en orden cronológico
+        tipo_estado: 'BAL' o 'RES'
+
+    Returns:
+        dict: {'periodos': [Periodo], 'etiquetas': [str],
+               'filas': [{'clave', 'nombre', 'celdas': [{'monto', 'variacion',
+                          'porc', 'indice', 'vertical'}, ...]}, ...]}
+               Las celdas sin dato (o sin base para dividir) quedan en None.
+    """
+    lineas = lineas_por_estado(tipo_estado)
+    asegurar_saldos_linea(empresa)
+    cubo = cubo_lineas(empresa, periodos, tipo_estado, claves=[clave for clave, _, _ in lineas])
+    montos, valores = cubo.montos, cubo.valores
+    falta = np.isnan(valores)
+
+    # Valores del período anterior (la primera columna no tiene)
+    anterior = np.full(valores.shape, np.nan)
+    anterior[:, 1:] = valores[:, :-1]
+    sin_anterior = np.isnan(anterior)
+
+    # Variación en Decimal: las celdas sin dato restan 0 y luego se enmascaran
+    completos = np.where(falta, Decimal('0'), montos)
+    variacion = np.full(montos.shape, None, dtype=object)
+    variacion[:, 1:] = completos[:, 1:] - completos[:, :-1]
+    variacion[falta | sin_anterior] = None
+
+    porc = _dividir(valores - anterior, anterior)
+    indice = _dividir(valores, valores[:, :1])
+    # Igual que analisis_vertical: base cero (o sin dato) se reemplaza por 1
+    bases = [i for i, (_, _, base) in enumerate(lineas) if base]
+    if bases:
+        base_vertical = np.where(falta[bases[0]] | (valores[bases[0]] == 0), 1.0, valores[bases[0]])
+        vertical = _dividir(valores, base_vertical)
+    else:
+        vertical = np.full(valores.shape, np.nan)
+
+    filas = []
+    for i, (clave, nombre, _) in enumerate(lineas):
+        celdas = [
+            {'monto': _celda(montos[i, j]), 'variacion': _celda(variacion[i, j]),
+             'porc': _porcentaje(porc[i, j]), 'indice': _porcentaje(indice[i, j]),
+             'vertical': _porcentaje(vertical[i, j])}
+            for j in range(montos.shape[1])
+        ]
+        filas.append({'clave': clave, 'nombre': nombre, 'celdas': celdas})
+    return {'periodos': cubo.periodos, 'etiquetas': cubo.etiquetas(), 'filas': filas}
@@ -1,22 +1,47 @@
 from decimal import Decimal
-from statistics import mean, pstdev
-from stela.models.finanzas import ResultadoRatio, RatioDef
+import numpy as np
+from django.db.models import Avg, Count, F, Max, Min, OuterRef, StdDev, Subquery
+from stela.models.finanzas import ResultadoRatio
+from .ciiu_jerarquia import MIN_EMPRESAS_SECTOR, ciiu_referencia
+from .estadistica_sector import CUATRO_DECIMALES, estadisticas_sector
 
 def benchmarking_por_ciiu(ciiu, periodo):
-    ratios = RatioDef.objects.all()
-    empresas_ids = list(ciiu.empresas_asociadas.values_list('pk', flat=True))
-    out = {}
-    for r in ratios:
-        vals = list(ResultadoRatio.objects
-                    .filter(periodo=periodo, ratio=r, empresa_id__in=empresas_ids)
-                    .values_list('valor', flat=True))
-        vals = [Decimal(v) for v in vals if v is not None]
-        if not vals:
-            continue
-        prom = Decimal(mean(vals))
-        desv = Decimal(pstdev(vals)) if len(vals) > 1 else Decimal('0')
-        out[r.clave] = {'nombre': r.nombre, 'promedio': prom, 'desv': desv}
-    return out
+    """
+    Estadísticas de cada ratio entre las empresas del CIIU (y de sus
+    descendientes), leídas de EstadisticaSector (una consulta). No escribe:
+    las celdas se refrescan al guardar ratios y con refresh_estadisticas_sector,
+    y una celda aún no calculada se devuelve vacía.
+
+    Cada empresa tiene sus propios Periodo, así que el sector se compara por
+    año/mes del período.
+
+    Args:
+        ciiu: Instancia de Ciiu (o su código)
+        periodo: Periodo, o lista de Periodo para traer toda la historia del sector
+
+    Returns:
+        dict: {clave_ratio: {'nombre', 'promedio', 'desv', 'n', 'p10', ..., 'p90'}}
+              para un período; {(anio, mes): {clave_ratio: {...}}} si se pasó una lista
+    """
+    varios = isinstance(periodo, (list, tuple, set))
+    periodos = list(periodo) if varios else [periodo]
+    out = estadisticas_sector(ciiu, periodos)
+    return out if varios else out[(periodos[0].anio, periodos[0].mes)]
+
+def benchmark_sector(ciiu, periodo, minimo=MIN_EMPRESAS_SECTOR):
+    """
+    Como benchmarking_por_ciiu, pero si el CIIU tiene menos de `minimo`
+    empresas sube al ancestro más cercano que las tenga (ver ciiu_referencia).
+    Es lo que usa tools_finanzas para comparar la empresa con su sector.
+
+    Cada celda de EstadisticaSector agrega el subárbol de su CIIU (él y sus
+    descendientes), así que la celda del ancestro incluye a los vecinos.
+
+    Returns:
+        tuple: (codigo_ciiu_usado, resultado de benchmarking_por_ciiu)
+    """
+    codigo, _ = ciiu_referencia(ciiu, minimo)
+    return codigo, benchmarking_por_ciiu(codigo, periodo)
 
 def etiqueta_semaforo(valor, prom, desv, k=1):
     if valor is None: return 'NA'
@@ -25,3 +50,70 @@ def etiqueta_semaforo(valor, prom, desv, k=1):
     if valor > prom + k*desv: return 'ALTO'
     if valor < prom - k*desv: return 'BAJO'
     return 'OK'
+
+def _redondear(valor):
+    return None if valor is None else Decimal(str(valor)).quantize(CUATRO_DECIMALES)
+
+def historico_ratios(empresa, claves=None):
+    """
+    Historia de cada ratio de la empresa (todos sus períodos) en una sola
+    consulta agrupada por ratio: promedio, desviación poblacional, mínimo,
+    máximo y valor del período más reciente.
+
+    Args:
+        empresa: Instancia de Empresa
+        claves: lista de claves de ratio a incluir (None = todas)
+
+    Returns:
+        dict: {clave_ratio: {'n', 'promedio', 'desv', 'minimo', 'maximo', 'ultimo'}}
+              Los ratios sin ningún valor no aparecen.
+    """
+    qs = ResultadoRatio.objects.filter(empresa=empresa, valor__isnull=False)
+    if claves is not None:
+        qs = qs.filter(ratio__clave__in=claves)
+    # Período más reciente primero; el anual (mes NULL) va antes que los meses de su año
+    ultimo = ResultadoRatio.objects.filter(
+        empresa=empresa, ratio_id=OuterRef('ratio_id'), valor__isnull=False
+    ).order_by('-periodo__anio', F('periodo__mes').desc(nulls_last=True)).values('valor')[:1]
+    filas = qs.values('ratio_id', 'ratio__clave').order_by().annotate(
+        n=Count('pk'), promedio=Avg('valor'), desv=StdDev('valor'),
+        minimo=Min('valor'), maximo=Max('valor'), ultimo=Subquery(ultimo),
+    )
+    return {
+        f['ratio__clave']: {
+            'n': f['n'],
+            'promedio': _redondear(f['promedio']),
+            'desv': _redondear(f['desv']),
+            'minimo': f['minimo'],
+            'maximo': f['maximo'],
+            'ultimo': f['ultimo'],
+        }
+        for f in filas
+    }
+
+def clasificar_semaforos(filas, k=1):
+    """
+    etiqueta_semaforo sobre todas las filas a la vez (NumPy).
+
+    Args:
+        filas: lista de dict con 'valor', 'promedio' y 'desv' (None = sin dato)
+
+    Returns:
+        list: las mismas filas con 'semaforo' ('OK', 'ALTO', 'BAJO' o 'NA')
+    """
+    if not filas:
+        return filas
+
+    def columna(campo):
+        return np.array([np.nan if f.get(campo) is None else float(f[campo]) for f in filas])
+
+    valor, prom, desv = columna('valor'), columna('promedio'), columna('desv')
+    desv = np.nan_to_num(desv)
+    etiquetas = np.select(
+        [np.isnan(valor) | np.isnan(prom), valor > prom + k * desv, valor < prom - k * desv],
+        ['NA', 'ALTO', 'BAJO'],
+        'OK',
+    )
+    for fila, etiqueta in zip(filas, etiquetas.tolist()):
+        fila['semaforo'] = etiqueta
+    return filas
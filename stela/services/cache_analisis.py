@@ -0,0 +1,107 @@
+"""
+Cache de resultados de análisis vertical, horizontal y de tendencia.
+
+tools_finanzas recalculaba hasta cuatro análisis verticales y dos
+horizontales en cada carga aunque el balance casi nunca cambia. Los
+resultados se guardan en la cache de Django con clave (id_balance,
+revision): Balance.revision se incrementa con cada cambio de detalles
+(señales de BalanceDetalle, saldos_recalculados) o de mapeos,
+cuentas, grupos y líneas (señales), así que una clave nunca sirve un
+resultado viejo y no hace falta borrar nada.
+
+Una vista repetida del mismo período cuesta una consulta a Balance.
+"""
+import hashlib
+from django.core.cache import cache
+from django.db.models import F
+from stela.models.finanzas import Balance
+from .analisis import analisis_horizontal, analisis_tendencia, analisis_vertical
+
+# Segundos que se conserva un resultado (la revisión ya evita servir datos viejos)
+TTL_ANALISIS = 60 * 60 * 24
+
+
+def incrementar_revision(**filtros):
+    """
+    Incrementa la revisión de los Balance que cumplen los filtros (todos si
+    no se pasa ninguno), ej. pk__in=[...] o detalles__cuenta_id=...
+
+    Returns:
+        int: Cantidad de Balance actualizados
+    """
+    return Balance.objects.filter(**filtros).update(revision=F('revision') + 1)
+
+
+def revisiones(empresa, periodos):
+    """
+    Revisión de los Balance de la empresa en los períodos dados (una consulta).
+
+    Returns:
+        dict: {(periodo_id, tipo_balance): (id_balance, revision)}
+    """
+    return {
+        (periodo_id, tipo): (id_balance, revision)
+        for id_balance, periodo_id, tipo, revision in Balance.objects.filter(
+            empresa=empresa, periodo__in=periodos
+        ).values_list('id_balance', 'periodo_id', 'tipo_balance', 'revision')
+    }
+
+
+def _cacheado(clave, calcular):
+    resultado = cache.get(clave)
+    if resultado is None:
+        resultado = calcular()
+        cache.set(clave, resultado, TTL_ANALISIS)
+    return resultado
+
+
+def _version(revs, periodo, tipo_estado):
+    par = revs.get((periodo.pk, tipo_estado))
+    return None if par is None else f'{par[0]}.{par[1]}'
+
+
+def vertical_cacheado(empresa, periodo, tipo_estado, snapshot=None, revs=None):
+    """
+    analisis_vertical servido desde la cache.
+
+    Args:
+        revs: resultado de revisiones() si ya se consultó (opcional)
+    """
+    if revs is None:
+        revs = revisiones(empresa, [periodo])
+    version = _version(revs, periodo, tipo_estado)
+    if version is None:
+        return analisis_vertical(empresa, periodo, tipo_estado, snapshot=snapshot)
+    return _cacheado(
+        f'stela:vertical:{version}',
+        lambda: analisis_vertical(empresa, periodo, tipo_estado, snapshot=snapshot),
+    )
+
+
+def horizontal_cacheado(empresa, periodo_base, periodo_act, tipo_estado, revs=None):
+    """analisis_horizontal servido desde la cache (clave: revisión de ambos balances)."""
+    if revs is None:
+        revs = revisiones(empresa, [periodo_base, periodo_act])
+    base = _version(revs, periodo_base, tipo_estado)
+    actual = _version(revs, periodo_act, tipo_estado)
+    if base is None or actual is None:
+        return analisis_horizontal(empresa, periodo_base, periodo_act, tipo_estado)
+    return _cacheado(
+        f'stela:horizontal:{base}:{actual}',
+        lambda: analisis_horizontal(empresa, periodo_base, periodo_act, tipo_estado),
+    )
+
+
+def tendencia_cacheada(empresa, periodos, tipo_estado, revs=None):
+    """analisis_tendencia servido desde la cache (clave: revisión de cada balance)."""
+    if revs is None:
+        revs = revisiones(empresa, periodos)
+    versiones = ','.join(
+        f'{p.pk}:{_version(revs, p, tipo_estado) or "-"}' for p in periodos
+    )
+    # Con muchos períodos la clave excedería el largo que admiten algunos backends
+    huella = hashlib.sha1(versiones.encode()).hexdigest()
+    return _cacheado(
+        f'stela:tendencia:{empresa.pk}:{tipo_estado}:{huella}',
+        lambda: analisis_tendencia(empresa, periodos, tipo_estado),
+    )
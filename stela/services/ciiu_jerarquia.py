@@ -0,0 +1,117 @@
+"""
+Jerarquía CIIU con ruta materializada.
+
+Ciiu.ruta guarda los códigos desde la raíz separados por '/', con '/' final
+(ej. 'A/01/011/0111/'). El subárbol de un CIIU es ruta__startswith=ruta (una
+consulta con índice) y sus ancestros salen de la propia ruta, sin recorrer
+padre por padre.
+
+La ruta se mantiene así:
+
+- al guardar un Ciiu (señales) se calcula su ruta y, si cambió, se reescribe
+  la de todo su subárbol con un solo UPDATE;
+- seed_ciiu recalcula todas las rutas al terminar (recalcular_rutas_ciiu).
+"""
+from django.db.models import Count, Q, Value
+from django.db.models.functions import Concat, Substr
+from stela.models.ciiu import Ciiu
+from stela.models.empresa import Empresa
+
+SEPARADOR = '/'
+
+# Empresas mínimas para que un CIIU sirva de referencia sectorial por sí solo
+MIN_EMPRESAS_SECTOR = 5
+
+
+def prefijos_ruta(ruta):
+    """Rutas del CIIU y de cada ancestro, del más específico a la raíz."""
+    codigos = ruta.strip(SEPARADOR).split(SEPARADOR) if ruta else []
+    return [SEPARADOR.join(codigos[:i]) + SEPARADOR for i in range(len(codigos), 0, -1)]
+
+
+def codigo_de_ruta(ruta):
+    """Último código de la ruta (el del propio CIIU)."""
+    return ruta.strip(SEPARADOR).rsplit(SEPARADOR, 1)[-1]
+
+
+def recalcular_rutas_ciiu():
+    """
+    Recalcula la ruta de todos los Ciiu en memoria (una consulta) y guarda
+    solo las que cambiaron.
+
+    Returns:
+        int: Cantidad de Ciiu actualizados
+    """
+    nodos = {codigo: (padre_id, ruta) for codigo, padre_id, ruta in Ciiu.objects.values_list('codigo', 'padre_id', 'ruta')}
+    rutas = {}
+
+    def ruta_de(codigo):
+        # Iterativo (no recursivo) y a prueba de ciclos en datos corruptos
+        cadena = []
+        actual = codigo
+        while actual is not None and actual not in rutas and actual not in cadena:
+            cadena.append(actual)
+            actual = nodos[actual][0] if actual in nodos else None
+        base = rutas.get(actual, '')
+        for c in reversed(cadena):
+            base = rutas[c] = f'{base}{c}{SEPARADOR}'
+        return rutas[codigo]
+
+    cambiados = [
+        Ciiu(codigo=codigo, ruta=ruta_de(codigo))
+        for codigo, (_, ruta) in nodos.items()
+        if ruta_de(codigo) != ruta
+    ]
+    Ciiu.objects.bulk_update(cambiados, ['ruta'], batch_size=500)
+    return len(cambiados)
+
+
+def asignar_ruta(ciiu):
+    """
+    Calcula la ruta de un Ciiu antes de guardarlo (una consulta) y devuelve
+    la ruta que tenía en la BD ('' si es nuevo).
+    """
+    rutas = dict(
+        Ciiu.objects.filter(pk__in=[ciiu.pk, ciiu.padre_id]).values_list('codigo', 'ruta')
+    )
+    base = rutas.get(ciiu.padre_id, '') if ciiu.padre_id else ''
+    if ciiu.padre_id and not base:
+        base = f'{ciiu.padre_id}{SEPARADOR}'
+    ciiu.ruta = f'{base}{ciiu.codigo}{SEPARADOR}'
+    return rutas.get(ciiu.pk, '')
+
+
+def mover_subarbol(ruta_anterior, ruta_nueva):
+    """Reescribe con un UPDATE la ruta de los descendientes de ruta_anterior."""
+    if not ruta_anterior or ruta_anterior == ruta_nueva:
+        return 0
+    return Ciiu.objects.filter(ruta__startswith=ruta_anterior).exclude(ruta=ruta_anterior).update(
+        ruta=Concat(Value(ruta_nueva), Substr('ruta', len(ruta_anterior) + 1))
+    )
+
+
+def ciiu_referencia(ciiu, minimo=MIN_EMPRESAS_SECTOR):
+    """
+    CIIU más cercano (él mismo o un ancestro) cuyo subárbol tiene al menos
+    `minimo` empresas. Cuenta todos los niveles en una sola consulta agregada
+    sobre el subárbol de la raíz.
+
+    Si ningún nivel llega al mínimo devuelve la raíz.
+
+    Args:
+        ciiu: Instancia de Ciiu
+
+    Returns:
+        tuple: (codigo, cantidad de empresas en su subárbol)
+    """
+    prefijos = prefijos_ruta(ciiu.ruta)
+    if not prefijos:
+        return ciiu.codigo, Empresa.objects.filter(ciiu=ciiu).count()
+    conteos = Empresa.objects.filter(ciiu__ruta__startswith=prefijos[-1]).aggregate(**{
+        f'n{i}': Count('pk', filter=Q(ciiu__ruta__startswith=prefijo))
+        for i, prefijo in enumerate(prefijos)
+    })
+    for i, prefijo in enumerate(prefijos):
+        if conteos[f'n{i}'] >= minimo:
+            return codigo_de_ruta(prefijo), conteos[f'n{i}']
+    return codigo_de_ruta(prefijos[-1]), conteos[f'n{len(prefijos) - 1}']
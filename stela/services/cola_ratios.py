@@ -0,0 +1,75 @@
+"""
+Cola de recálculo de ratios en segundo plano (RecalculoPendiente).
+
+Los endpoints de lectura (ratios_series_json) no calculan: si a un período
+le faltan ratios guardados lo encolan y responden con lo que ya hay. La cola
+no repite pares (unique empresa/periodo + upsert que solo renueva
+RecalculoPendiente.encolado), así que muchas lecturas del mismo período
+producen un solo recálculo.
+
+El comando process_ratio_queue la vacía con calcular_ratios_batch (consultas
+agregadas + un upsert por lote); puede correr por cron o como proceso
+permanente con --loop.
+"""
+from django.db import connections
+from django.db.models import Q
+from stela.models.finanzas import RecalculoPendiente
+from .ratios_batch import calcular_ratios_batch
+
+# Pares por llamada a calcular_ratios_batch
+PARES_POR_LOTE = 200
+
+
+def encolar_recalculo(pares):
+    """
+    Encola pares (empresa_id, periodo_id) con un upsert. Un par que ya estaba
+    en cola conserva su lugar (creado) y renueva encolado, para que un
+    procesamiento en curso no lo saque de la cola.
+
+    Returns:
+        int: Cantidad de pares recibidos (no distingue los que ya estaban)
+    """
+    pares = set(pares)
+    if not pares:
+        return 0
+    opciones = {'update_conflicts': True, 'update_fields': ['encolado']}
+    # MySQL no admite indicar las columnas del conflicto (usa cualquier UNIQUE)
+    if connections[RecalculoPendiente.objects.db].features.supports_update_conflicts_with_target:
+        opciones['unique_fields'] = ['empresa', 'periodo']
+    RecalculoPendiente.objects.bulk_create(
+        [RecalculoPendiente(empresa_id=e, periodo_id=p) for e, p in pares], **opciones
+    )
+    return len(pares)
+
+
+def procesar_cola_ratios(limite=None, tipo_estado='RES'):
+    """
+    Recalcula los pares en cola, del más antiguo al más nuevo, y los saca de ella.
+
+    El recálculo es idempotente: si dos procesos toman el mismo par solo se
+    repite trabajo. Una fila se borra solo si su encolado sigue siendo el
+    leído: un par encolado de nuevo mientras se procesaba queda en la cola y
+    se recalcula otra vez.
+
+    Args:
+        limite: Máximo de pares a procesar (None = toda la cola)
+        tipo_estado: Estado con prioridad en el cálculo
+
+    Returns:
+        int: Cantidad de pares procesados
+    """
+    pendientes = RecalculoPendiente.objects.order_by('creado', 'pk').values_list(
+        'pk', 'empresa_id', 'periodo_id', 'encolado'
+    )
+    if limite is not None:
+        pendientes = pendientes[:limite]
+    pendientes = list(pendientes)
+    for i in range(0, len(pendientes), PARES_POR_LOTE):
+        lote = pendientes[i:i + PARES_POR_LOTE]
+        # Los id de Periodo son únicos por empresa: filtrar por ambos da exactamente el lote
+        calcular_ratios_batch({e for _, e, _, _ in lote}, {p for _, _, p, _ in lote}, tipo_estado=tipo_estado)
+        procesados = Q()
+        for pk, _, _, encolado in lote:
+            procesados |= Q(pk=pk, encolado=encolado)
+        RecalculoPendiente.objects.filter(procesados).delete()
+    return len(pendientes)
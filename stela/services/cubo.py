@@ -0,0 +1,140 @@
+"""
+Cubos multi-período de una empresa: matrices NumPy densas (filas x períodos).
+
+Las gráficas, el análisis horizontal, el benchmark histórico y las series de
+ratios recorrían período por período (y fila por fila) con una consulta cada
+vez. Un cubo se arma con una sola consulta sobre todos los períodos pedidos:
+
+- cubo_cuentas: saldo de cada cuenta (BalanceDetalle)
+- cubo_lineas: monto de cada línea de estado (SaldoLinea)
+- cubo_ratios: valor de cada ratio (ResultadoRatio)
+
+Las sumas se hacen en Decimal (Cubo.montos), así que los importes que lee
+un usuario no pierden centavos; Cubo.valores es la misma matriz en float64,
+solo para series de gráficas. Las celdas sin dato quedan en None / NaN.
+"""
+from decimal import Decimal
+import numpy as np
+from stela.models.finanzas import BalanceDetalle, Periodo, ResultadoRatio, SaldoLinea
+
+
+class Cubo:
+    """
+    Matriz densa filas x períodos.
+
+    Atributos:
+        filas: ndarray con el id de cada fila (id_cuenta, clave de línea o de ratio)
+        periodos: lista de Periodo, una por columna (orden cronológico)
+        montos: ndarray de Decimal (len(filas) x len(periodos)), None = sin dato
+        valores: montos en float64 para gráficas, NaN = sin dato
+        codigos: en cubo_cuentas, ndarray con el código de cuenta de cada fila
+                 (alineado con filas); None en los demás cubos
+    """
+
+    def __init__(self, filas, periodos, montos):
+        self.filas = filas
+        self.periodos = periodos
+        self.montos = montos
+        self.codigos = None
+        self.valores = np.array(
+            [[np.nan if m is None else float(m) for m in fila] for fila in montos], dtype=np.float64
+        ).reshape(montos.shape)
+        self._indice_fila = {f: i for i, f in enumerate(filas.tolist())}
+        self._indice_periodo = {p.pk: j for j, p in enumerate(periodos)}
+
+    def __contains__(self, fila):
+        return fila in self._indice_fila
+
+    def serie(self, fila):
+        """Valores de la fila en todos los períodos (todo NaN si la fila no existe)."""
+        i = self._indice_fila.get(fila)
+        if i is None:
+            return np.full(len(self.periodos), np.nan)
+        return self.valores[i]
+
+    def columna(self, periodo):
+        """Montos (Decimal o None) de todas las filas en un período (Periodo o su pk)."""
+        return self.montos[:, self._indice_periodo[getattr(periodo, 'pk', periodo)]]
+
+    def etiquetas(self):
+        """Etiqueta 'AAAA' o 'AAAA-MM' de cada período."""
+        return [f"{p.anio}-{p.mes:02d}" if p.mes else str(p.anio) for p in self.periodos]
+
+
+def periodos_empresa(empresa):
+    """Períodos de la empresa en orden cronológico."""
+    return list(Periodo.objects.filter(empresa=empresa).order_by('anio', 'mes'))
+
+
+def _armar(filas_datos, periodos, filas=None):
+    """
+    Arma el Cubo a partir de tuplas (fila, periodo_id, valor). Si una celda
+    recibe varios valores se suman en Decimal; los valores None no cuentan
+    como dato.
+    """
+    periodos = list(dict.fromkeys(periodos))
+    indice_periodo = {p.pk: j for j, p in enumerate(periodos)}
+    datos = [(f, indice_periodo[p], v) for f, p, v in filas_datos if v is not None]
+    if filas is None:
+        filas = np.array(sorted({f for f, _, _ in datos}), dtype=object)
+    else:
+        filas = np.array(list(dict.fromkeys(filas)), dtype=object)
+
+    montos = np.full((len(filas), len(periodos)), None, dtype=object)
+    indice_fila = {f: i for i, f in enumerate(filas.tolist())}
+    for f, j, v in datos:
+        i = indice_fila.get(f)
+        if i is not None:
+            actual = montos[i, j]
+            montos[i, j] = Decimal(v) if actual is None else actual + Decimal(v)
+    return Cubo(filas, periodos, montos)
+
+
+def cubo_cuentas(empresa, periodos=None, cuentas=None, tipo_estado=None):
+    """
+    Saldo por cuenta y período (una consulta).
+
+    Las filas son id_cuenta (el código solo es único dentro de su grupo);
+    Cubo.codigos trae el código de cada fila en el mismo orden.
+
+    Args:
+        empresa: Instancia de Empresa
+        periodos: lista de Periodo en el orden deseado (None = todos, cronológico)
+        cuentas: lista de id_cuenta para limitar y ordenar las filas (opcional)
+        tipo_estado: 'BAL' o 'RES' para limitar a un estado (opcional)
+    """
+    if periodos is None:
+        periodos = periodos_empresa(empresa)
+    qs = BalanceDetalle.objects.filter(balance__empresa=empresa, balance__periodo__in=periodos)
+    if cuentas is not None:
+        qs = qs.filter(cuenta_id__in=cuentas)
+    if tipo_estado:
+        qs = qs.filter(balance__tipo_balance=tipo_estado)
+    datos = list(qs.values_list('cuenta_id', 'cuenta__codigo', 'balance__periodo_id', 'saldo'))
+    cubo = _armar(((c, p, v) for c, _, p, v in datos), periodos, cuentas)
+    # Una cuenta pedida sin saldos en los períodos queda con código None
+    codigos = {c: codigo for c, codigo, _, _ in datos}
+    cubo.codigos = np.array([codigos.get(c) for c in cubo.filas.tolist()], dtype=object)
+    return cubo
+
+
+def cubo_lineas(empresa, periodos=None, tipo_estado=None, claves=None):
+    """Monto por línea de estado y período, desde SaldoLinea (una consulta)."""
+    if periodos is None:
+        periodos = periodos_empresa(empresa)
+    qs = SaldoLinea.objects.filter(balance__empresa=empresa, balance__periodo__in=periodos)
+    if tipo_estado:
+        qs = qs.filter(balance__tipo_balance=tipo_estado)
+    if claves is not None:
+        qs = qs.filter(linea__clave__in=claves)
+    return _armar(qs.values_list('linea__clave', 'balance__periodo_id', 'monto'), periodos, claves)
+
+
+def cubo_ratios(empresa, periodos=None, claves=None):
+    """Valor por ratio y período, desde ResultadoRatio (una consulta)."""
+    if periodos is None:
+        periodos = periodos_empresa(empresa)
+    qs = ResultadoRatio.objects.filter(empresa=empresa, periodo__in=periodos)
+    if claves is not None:
+        qs = qs.filter(ratio__clave__in=claves)
+    return _armar(qs.values_list('ratio__clave', 'periodo_id', 'valor'), periodos, claves)
@@ -0,0 +1,251 @@
+"""
+Estadísticas sectoriales precalculadas (EstadisticaSector).
+
+Comparar una empresa con su sector recalculaba promedio y desviación desde
+todos los ResultadoRatio del CIIU en cada request: el costo crecía con la
+cantidad de empresas del sector. Aquí cada celda (ciiu, anio, mes) guarda
+por ratio n, promedio, desviación poblacional y percentiles 10/25/50/75/90
+de las empresas del subárbol del CIIU (él y sus descendientes, por ruta).
+
+En la misma pasada se guarda en ResultadoRatio.percentil el rango percentil
+de cada empresa dentro de su propio CIIU y año/mes (bisect sobre los valores
+ordenados), así leerlo es tomar un campo de la fila, sin recorrer el sector.
+
+Las celdas se mantienen así:
+
+- al guardar ResultadoRatio (señal ratios_guardados) se marcan los pares
+  (empresa, periodo) y al confirmar la transacción se refrescan solo sus
+  celdas y las de sus CIIU ancestros;
+- el comando refresh_estadisticas_sector las reconstruye en bloque.
+
+Leer nunca escribe: una celda que aún no se calculó se lee vacía. Refrescar
+es un upsert sobre (ciiu, anio, mes, ratio), así que dos refrescos
+concurrentes de la misma celda no chocan. Las celdas se identifican por el
+mes del Periodo (None = anual); en EstadisticaSector el anual se guarda
+como mes 0.
+"""
+import threading
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+from decimal import Decimal
+import numpy as np
+from django.db import connections, transaction
+from django.db.models import Q
+from stela.models.ciiu import Ciiu
+from stela.models.empresa import Empresa
+from stela.models.finanzas import EstadisticaSector, Periodo, ResultadoRatio
+from .al_confirmar import marcar_al_confirmar
+from .ciiu_jerarquia import codigo_de_ruta, prefijos_ruta
+
+PERCENTILES = (10, 25, 50, 75, 90)
+
+# Celdas por transacción al refrescar (acota el tamaño de los OR en la consulta)
+CELDAS_POR_LOTE = 100
+
+CUATRO_DECIMALES = Decimal('0.0001')
+
+# Campos que reescribe el upsert de EstadisticaSector
+CAMPOS_ESTADISTICA = ['n', 'promedio', 'desv', 'p10', 'p25', 'p50', 'p75', 'p90']
+
+_estado = threading.local()
+
+
+def _decimal(valor):
+    return Decimal(repr(float(valor))).quantize(CUATRO_DECIMALES)
+
+
+def _filtro_celdas(celdas, prefijo_ciiu, prefijo_fecha=''):
+    filtro = Q()
+    for ciiu_id, anio, mes in celdas:
+        filtro |= Q(**{
+            prefijo_ciiu: ciiu_id,
+            f'{prefijo_fecha}anio': anio,
+            f'{prefijo_fecha}mes': mes,
+        })
+    return filtro
+
+
+def _celdas_guardadas(celdas):
+    """Celdas (ciiu, anio, mes del Periodo) con el mes como se guarda en EstadisticaSector."""
+    return [(ciiu_id, anio, mes or 0) for ciiu_id, anio, mes in celdas]
+
+
+def _estadisticas(celda, ratio_id, valores):
+    valores = np.array(valores, dtype=np.float64)
+    p10, p25, p50, p75, p90 = np.percentile(valores, PERCENTILES)
+    ciiu_id, anio, mes = celda
+    return EstadisticaSector(
+        ciiu_id=ciiu_id, anio=anio, mes=mes or 0, ratio_id=ratio_id, n=len(valores),
+        promedio=_decimal(valores.mean()), desv=_decimal(valores.std()),
+        p10=_decimal(p10), p25=_decimal(p25), p50=_decimal(p50),
+        p75=_decimal(p75), p90=_decimal(p90),
+    )
+
+
+def _percentiles_rango(filas):
+    """
+    Rango percentil de cada valor dentro de su grupo: 100 * (menores + iguales/2) / n.
+
+    Args:
+        filas: lista de tuplas (pk, valor, percentil_guardado)
+
+    Returns:
+        list de ResultadoRatio (solo pk y percentil) cuyo percentil cambió
+    """
+    ordenados = sorted(float(valor) for _, valor, _ in filas)
+    n = len(ordenados)
+    cambiados = []
+    for pk, valor, anterior in filas:
+        v = float(valor)
+        rango = (bisect_left(ordenados, v) + bisect_right(ordenados, v)) / 2
+        percentil = _decimal(100 * rango / n)
+        if percentil != anterior:
+            cambiados.append(ResultadoRatio(pk=pk, percentil=percentil))
+    return cambiados
+
+
+def _refrescar_lote(celdas):
+    pedidas = set(celdas)
+    rutas = dict(Ciiu.objects.filter(pk__in={c for c, _, _ in pedidas}).values_list('codigo', 'ruta'))
+    # Una sola consulta con el OR de los subárboles (ruta__startswith usa el índice de ruta)
+    por_ruta = {(rutas.get(c) or f'{c}/', anio, mes): (c, anio, mes) for c, anio, mes in celdas}
+    por_ratio = defaultdict(list)   # {((ciiu, anio, mes), ratio_id): [valor, ...]}
+    propios = defaultdict(list)     # {((ciiu, anio, mes), ratio_id): [(pk, valor, percentil), ...]}
+    sin_valor = []                  # ResultadoRatio que perdieron el valor: sin percentil
+    for pk, ciiu_id, ruta, anio, mes, ratio_id, valor, percentil in ResultadoRatio.objects.filter(
+            _filtro_celdas(por_ruta, 'empresa__ciiu__ruta__startswith', 'periodo__')
+    ).values_list('pk', 'empresa__ciiu_id', 'empresa__ciiu__ruta', 'periodo__anio', 'periodo__mes',
+                  'ratio_id', 'valor', 'percentil'):
+        if valor is None:
+            if percentil is not None:
+                sin_valor.append(ResultadoRatio(pk=pk, percentil=None))
+            continue
+        # Cada valor cuenta en la celda de su CIIU y en las de sus ancestros pedidos
+        for prefijo in prefijos_ruta(ruta):
+            celda = por_ruta.get((prefijo, anio, mes))
+            if celda is not None:
+                por_ratio[(celda, ratio_id)].append(valor)
+        if (ciiu_id, anio, mes) in pedidas:
+            propios[((ciiu_id, anio, mes), ratio_id)].append((pk, valor, percentil))
+    objs = [_estadisticas(celda, ratio_id, valores) for (celda, ratio_id), valores in por_ratio.items()]
+    percentiles = sin_valor + [obj for filas in propios.values() for obj in _percentiles_rango(filas)]
+
+    # Filas guardadas de ratios que ya no tienen valores en su celda
+    ratios_por_celda = defaultdict(set)
+    for celda, ratio_id in por_ratio:
+        ratios_por_celda[celda].add(ratio_id)
+    obsoletas = Q()
+    for celda, guardada in zip(celdas, _celdas_guardadas(celdas)):
+        obsoletas |= _filtro_celdas([guardada], 'ciiu_id') & ~Q(ratio_id__in=ratios_por_celda[celda])
+
+    opciones = {'update_conflicts': True, 'update_fields': CAMPOS_ESTADISTICA}
+    # MySQL no admite indicar las columnas del conflicto (usa cualquier UNIQUE)
+    if connections[EstadisticaSector.objects.db].features.supports_update_conflicts_with_target:
+        opciones['unique_fields'] = ['ciiu', 'anio', 'mes', 'ratio']
+    with transaction.atomic():
+        EstadisticaSector.objects.filter(obsoletas).delete()
+        if objs:
+            EstadisticaSector.objects.bulk_create(objs, **opciones)
+        ResultadoRatio.objects.bulk_update(percentiles, ['percentil'], batch_size=500)
+    return len(objs)
+
+
+def refrescar_estadisticas_sector(celdas):
+    """
+    Recalcula las estadísticas de las celdas dadas desde ResultadoRatio.
+
+    Por cada lote de celdas: una consulta de valores, un DELETE de las filas
+    de ratios que ya no tienen valores y un upsert del resto. Una celda sin
+    valores queda vacía.
+
+    Args:
+        celdas: iterable de tuplas (ciiu_codigo, anio, mes)
+
+    Returns:
+        int: Cantidad de filas escritas
+    """
+    celdas = sorted({(c, a, m or None) for c, a, m in celdas if c}, key=lambda c: (c[0], c[1], c[2] or 0))
+    return sum(
+        _refrescar_lote(celdas[i:i + CELDAS_POR_LOTE])
+        for i in range(0, len(celdas), CELDAS_POR_LOTE)
+    )
+
+
+def celdas_con_ancestros(filas):
+    """
+    Celdas (ciiu, anio, mes) de cada CIIU y de todos sus ancestros: la celda
+    de un CIIU agrega su subárbol, así que un valor nuevo cambia todas ellas.
+
+    Args:
+        filas: iterable de tuplas (ciiu_id, ruta, anio, mes)
+    """
+    celdas = set()
+    for ciiu_id, ruta, anio, mes in filas:
+        if not ciiu_id:
+            continue
+        celdas.add((ciiu_id, anio, mes))
+        celdas |= {(codigo_de_ruta(prefijo), anio, mes) for prefijo in prefijos_ruta(ruta)[1:]}
+    return celdas
+
+
+def celdas_de_pares(pares):
+    """
+    Celdas (ciiu, anio, mes) de pares (empresa_id, periodo_id) y de sus CIIU
+    ancestros, con dos consultas. Las empresas sin CIIU no tienen celda.
+    """
+    pares = set(pares)
+    if not pares:
+        return set()
+    ciius = {
+        pk: (ciiu_id, ruta)
+        for pk, ciiu_id, ruta in Empresa.objects.filter(
+            pk__in={e for e, _ in pares}).values_list('pk', 'ciiu_id', 'ciiu__ruta')
+    }
+    fechas = {
+        pk: (anio, mes)
+        for pk, anio, mes in Periodo.objects.filter(
+            pk__in={p for _, p in pares}).values_list('pk', 'anio', 'mes')
+    }
+    return celdas_con_ancestros(
+        (*ciius.get(e, (None, None)), *fechas[p]) for e, p in pares if p in fechas
+    )
+
+
+def registrar_ratios_guardados(pares):
+    """
+    Marca pares (empresa_id, periodo_id) con ratios recién guardados; sus
+    celdas se refrescan al confirmar la transacción en curso (las de una
+    transacción revertida se descartan).
+    """
+    marcar_al_confirmar(_estado, set, lambda lote: lote.update(pares), procesar_sector_pendientes)
+
+
+def procesar_sector_pendientes(pares):
+    """Refresca las celdas de los pares marcados."""
+    refrescar_estadisticas_sector(celdas_de_pares(pares))
+
+
+def estadisticas_sector(ciiu, periodos):
+    """
+    Lee las estadísticas guardadas del CIIU para los períodos (una consulta).
+
+    Args:
+        ciiu: Instancia de Ciiu (o su código)
+        periodos: lista de Periodo (se comparan por año/mes)
+
+    Returns:
+        dict: {(anio, mes): {clave_ratio: {'nombre', 'n', 'promedio', 'desv',
+               'p10', 'p25', 'p50', 'p75', 'p90'}}}
+    """
+    ciiu_id = getattr(ciiu, 'pk', ciiu)
+    fechas = {(p.anio, p.mes) for p in periodos}
+    out = {fecha: {} for fecha in fechas}
+    if not fechas:
+        return out
+    celdas = _celdas_guardadas((ciiu_id, a, m) for a, m in fechas)
+    for e in EstadisticaSector.objects.filter(_filtro_celdas(celdas, 'ciiu_id')).select_related('ratio'):
+        out[(e.anio, e.mes or None)][e.ratio.clave] = {
+            'nombre': e.ratio.nombre, 'n': e.n, 'promedio': e.promedio, 'desv': e.desv,
+            'p10': e.p10, 'p25': e.p25, 'p50': e.p50, 'p75': e.p75, 'p90': e.p90,
+        }
+    return out
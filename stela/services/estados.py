@@ -1,45 +1,111 @@
 from decimal import Decimal
-from django.db.models import Sum, Q
-from stela.models.finanzas import Balance, BalanceDetalle, LineaEstado, MapeoCuentaLinea
+from django.db.models import Case, DecimalField, Exists, F, OuterRef, Q, QuerySet, Sum, When
+from stela.models.finanzas import Balance, BalanceDetalle, Periodo
 from stela.models.catalogo import Cuenta
+from .indice_mapeo import lineas_por_estado, mapeos_empresa
+from .snapshot import PeriodSnapshot, filas_agregadas
+
+# Naturalezas cuyo saldo es debe - haber (el resto: haber - debe)
+NATURALEZAS_DEUDORAS = ('Activo', 'Gasto')
+
+
+def recalcular_saldos_balances(balances):
+    """
+    Calcula el saldo de todos los detalles de varios balances con un solo
+    UPDATE, según la naturaleza del grupo de cada cuenta.
+
+    La naturaleza se lee con un Exists correlacionado sobre Cuenta/GrupoCuenta
+    en lugar de UPDATE ... JOIN: el ORM no genera UPDATE con JOIN y su sintaxis
+    cambia entre motores (UPDATE ... FROM, UPDATE ... JOIN). El motor lo
+    resuelve como semi-join por la PK de la cuenta, en la misma sentencia.
+
+    El UPDATE no dispara señales: quien lo llama debe invalidar después lo que
+    deriva de los saldos (saldos_linea.saldos_recalculados).
+
+    Args:
+        balances: QuerySet de Balance, o lista de Balance / id_balance
+
+    Returns:
+        int: Cantidad de detalles actualizados
+    """
+    if isinstance(balances, QuerySet):
+        ids = list(balances.values_list('pk', flat=True))
+    else:
+        ids = [getattr(b, 'pk', b) for b in balances]
+    if not ids:
+        return 0
+    deudora = Cuenta.objects.filter(pk=OuterRef('cuenta_id'), grupo__naturaleza__in=NATURALEZAS_DEUDORAS)
+    return BalanceDetalle.objects.filter(balance_id__in=ids).update(
+        saldo=Case(
+            When(Exists(deudora), then=F('debe') - F('haber')),
+            default=F('haber') - F('debe'),
+            output_field=DecimalField(max_digits=18, decimal_places=2),
+        )
+    )
+
 
 def recalcular_saldos_detalle(balance: Balance):
-    """Si importas debe/haber, calcula saldo según naturaleza del grupo."""
-    detalles = BalanceDetalle.objects.filter(balance=balance).select_related('cuenta__grupo')
-    bulk = []
-    for d in detalles:
-        nat = d.cuenta.grupo.naturaleza
-        if nat in ('Activo', 'Gasto'):
-            d.saldo = (d.debe or 0) - (d.haber or 0)
-        else:
-            d.saldo = (d.haber or 0) - (d.debe or 0)
-        bulk.append(d)
-    BalanceDetalle.objects.bulk_update(bulk, ['saldo'])
+    """
+    Si importas debe/haber, calcula saldo según naturaleza del grupo
+    y vuelve a materializar las líneas del balance (SaldoLinea).
+    """
+    actualizados = recalcular_saldos_balances([balance.pk])
+    # Import local: saldos_linea depende de este módulo
+    from .saldos_linea import saldos_recalculados
+    saldos_recalculados([balance.pk])
+    return actualizados
+
+def eliminar_periodos_vacios(**filtros):
+    """
+    Elimina los Periodo sin ningún Balance; sus ResultadoRatio se borran en
+    cascada. Es mantenimiento (eliminar_balance, comando purge_empty_periods):
+    las vistas de consulta no lo llaman.
+
+    Args:
+        filtros: filtros sobre Periodo (ej. empresa=..., pk=...); sin filtros, todos
+
+    Returns:
+        int: Cantidad de períodos eliminados
+    """
+    vacios = Periodo.objects.filter(**filtros).exclude(Exists(Balance.objects.filter(periodo=OuterRef('pk'))))
+    _, por_modelo = vacios.delete()
+    return por_modelo.get(Periodo._meta.label, 0)
 
-def calcular_totales_por_seccion(balance: Balance):
+def calcular_totales_por_seccion(balance: Balance = None, snapshot: PeriodSnapshot = None, tipo_estado='RES'):
     """
     Calcula los totales por sección del Estado de Resultados.
     Devuelve un diccionario con los totales de cada sección.
     Si no hay cuentas para un bloque, el subtotal será 0.
+
+    Si se pasa un PeriodSnapshot se usan sus filas del tipo de estado
+    (el del balance, o tipo_estado si no hay balance) sin consultar la BD.
+
+    Raises:
+        ValueError: Si no se pasa ni balance ni snapshot
     """
-    detalles = BalanceDetalle.objects.filter(balance=balance).select_related('cuenta__grupo')
+    if balance is None and snapshot is None:
+        raise ValueError("calcular_totales_por_seccion requiere un balance o un snapshot")
+    if snapshot is not None:
+        tipo = balance.tipo_balance if balance is not None else tipo_estado
+        filas = snapshot.detalles(tipo)
+    else:
+        filas = filas_agregadas(Balance.objects.filter(pk=balance.pk)) or []
     
     # Agrupar por sección
     totales_seccion = {}
     
-    for detalle in detalles:
-        cuenta = detalle.cuenta
+    for fila in filas:
         # Solo procesar cuentas de Ingreso o Gasto con bloque ER asignado
-        if cuenta.grupo.naturaleza in ('Ingreso', 'Gasto') and cuenta.er_bloque:
-            bloque = cuenta.er_bloque
+        if fila.naturaleza in ('Ingreso', 'Gasto') and fila.er_bloque:
+            bloque = fila.er_bloque
             if bloque not in totales_seccion:
                 totales_seccion[bloque] = Decimal('0')
             
             # Para ingresos: sumar saldo positivo, para gastos: sumar saldo negativo
-            if cuenta.grupo.naturaleza == 'Ingreso':
-                totales_seccion[bloque] += detalle.saldo or Decimal('0')
+            if fila.naturaleza == 'Ingreso':
+                totales_seccion[bloque] += fila.saldo
             else:  # Gasto
-                totales_seccion[bloque] -= detalle.saldo or Decimal('0')
+                totales_seccion[bloque] -= fila.saldo
     
     # Inicializar todos los bloques posibles con 0 si no tienen cuentas
     bloques_posibles = [
@@ -89,7 +155,37 @@ def calcular_totales_por_seccion(balance: Balance):
     return totales_finales
 
 
-def estado_dict(empresa, periodo, tipo_estado):
+def total_linea_sin_mapeo(clave, filas):
+    """
+    Total de una línea del Balance General cuando no tiene cuentas mapeadas,
+    calculado directamente desde bloques (bg_bloque) o naturaleza.
+    Las líneas sin regla propia valen 0.
+    """
+    total = Decimal('0')
+    if clave == 'PATRIMONIO_TOTAL':
+        # Calcular patrimonio directamente desde cuentas con naturaleza 'Patrimonio'
+        for det in filas:
+            if det.naturaleza == 'Patrimonio':
+                total += det.saldo
+    elif clave == 'ACTIVO_CORRIENTE':
+        # Calcular desde bg_bloque
+        for det in filas:
+            if det.naturaleza == 'Activo' and det.bg_bloque == 'ACTIVO_CORRIENTE':
+                total += det.saldo
+    elif clave == 'PASIVO_CORRIENTE':
+        # Calcular desde bg_bloque
+        for det in filas:
+            if det.naturaleza == 'Pasivo' and det.bg_bloque == 'PASIVO_CORRIENTE':
+                total += det.saldo
+    elif clave == 'TOTAL_ACTIVO':
+        # Calcular sumando todos los activos
+        for det in filas:
+            if det.naturaleza == 'Activo':
+                total += det.saldo
+    return total
+
+
+def estado_dict(empresa, periodo, tipo_estado, snapshot: PeriodSnapshot = None):
     """
     Calcula los valores de las líneas de estado para un período específico.
     
@@ -97,7 +193,7 @@ def estado_dict(empresa, periodo, tipo_estado):
     1. Obtiene el Balance del período y tipo especificado
     2. Obtiene todos los BalanceDetalle (saldos de cuentas)
     3. Para cada LineaEstado del tipo especificado:
-       - Busca todas las cuentas mapeadas (MapeoCuentaLinea)
+       - Busca las cuentas mapeadas (índice de MapeoCuentaLinea del catálogo)
        - Suma los saldos de esas cuentas (aplicando el signo del mapeo)
     4. Si no hay mapeos, calcula directamente desde bloques (bg_bloque/er_bloque) o naturaleza
     5. Devuelve un diccionario con las claves de línea y sus valores
@@ -108,62 +204,49 @@ def estado_dict(empresa, periodo, tipo_estado):
         empresa: Instancia de Empresa
         periodo: Instancia de Periodo
         tipo_estado: 'BAL' o 'RES'
+        snapshot: PeriodSnapshot ya cargado del período (opcional)
         
     Returns:
         dict: {clave_linea: {'nombre': str, 'monto': Decimal, 'base': bool}}
         Ejemplo: {'ACTIVO_CORRIENTE': {'nombre': 'Activo Corriente', 'monto': 150000, 'base': False}}
+
+    Raises:
+        Balance.DoesNotExist: Si el período no tiene estado del tipo indicado
     """
-    bal = Balance.objects.get(empresa=empresa, periodo=periodo, tipo_balance=tipo_estado)
-    # Pre-indexar detalle por cuenta para velocidad
-    detalles = BalanceDetalle.objects.filter(balance=bal).select_related('cuenta', 'cuenta__grupo')
-    by_cuenta = {d.cuenta_id: d for d in detalles}
+    if snapshot is None:
+        snapshot = PeriodSnapshot.cargar(empresa, periodo)
+    if not snapshot.tiene(tipo_estado):
+        raise Balance.DoesNotExist(
+            f"No existe Balance {tipo_estado} para {empresa} en {periodo}"
+        )
+    detalles = snapshot.detalles(tipo_estado)
+    by_cuenta = snapshot.saldos_por_cuenta(tipo_estado)
+    # Líneas y mapeos del catálogo salen del índice en memoria (sin consulta por línea)
+    mapeos_por_linea = mapeos_empresa(empresa.pk)
     data = {}
-    for le in LineaEstado.objects.filter(estado=tipo_estado):
+    for clave, nombre, base_vertical in lineas_por_estado(tipo_estado):
         total = Decimal('0')
         tiene_mapeos = False
         
         # Si es UTILIDAD_NETA, calcular desde los bloques consolidados (er_bloque)
-        if le.clave == 'UTILIDAD_NETA':
+        if clave == 'UTILIDAD_NETA':
             # UTILIDAD_NETA se calcula desde los bloques consolidados del Estado de Resultados
             # Las cuentas ya están agrupadas por er_bloque, así que usamos calcular_totales_por_seccion
             # que agrupa por er_bloque y calcula UTILIDAD_NETA automáticamente
-            totales = calcular_totales_por_seccion(bal)
+            totales = calcular_totales_por_seccion(snapshot=snapshot, tipo_estado=tipo_estado)
             total = totales.get('UTILIDAD_NETA', Decimal('0'))
             tiene_mapeos = True
         else:
             # Para otras líneas, usar mapeos normales
-            mapeos = MapeoCuentaLinea.objects.filter(linea=le).only('cuenta_id','signo')
-            for map_ in mapeos:
-                det = by_cuenta.get(map_.cuenta_id)
-                if not det:
+            for cuenta_id, signo in mapeos_por_linea.get(clave, ()):
+                if cuenta_id not in by_cuenta:
                     continue
-                total += (det.saldo or 0) * map_.signo
+                total += by_cuenta[cuenta_id] * signo
                 tiene_mapeos = True
         
         # Si no hay mapeos, calcular directamente desde bloques o naturaleza
         if not tiene_mapeos and tipo_estado == 'BAL':
-            if le.clave == 'PATRIMONIO_TOTAL':
-                # Calcular patrimonio directamente desde cuentas con naturaleza 'Patrimonio'
-                for det in detalles:
-                    if det.cuenta.grupo.naturaleza == 'Patrimonio':
-                        total += det.saldo or Decimal('0')
-            elif le.clave == 'ACTIVO_CORRIENTE':
-                # Calcular desde bg_bloque
-                for det in detalles:
-                    if (det.cuenta.grupo.naturaleza == 'Activo' and 
-                        det.cuenta.bg_bloque == 'ACTIVO_CORRIENTE'):
-                        total += det.saldo or Decimal('0')
-            elif le.clave == 'PASIVO_CORRIENTE':
-                # Calcular desde bg_bloque
-                for det in detalles:
-                    if (det.cuenta.grupo.naturaleza == 'Pasivo' and 
-                        det.cuenta.bg_bloque == 'PASIVO_CORRIENTE'):
-                        total += det.saldo or Decimal('0')
-            elif le.clave == 'TOTAL_ACTIVO':
-                # Calcular sumando todos los activos
-                for det in detalles:
-                    if det.cuenta.grupo.naturaleza == 'Activo':
-                        total += det.saldo or Decimal('0')
+            total += total_linea_sin_mapeo(clave, detalles)
         
-        data[le.clave] = {'nombre': le.nombre, 'monto': total, 'base': le.base_vertical}
+        data[clave] = {'nombre': nombre, 'monto': total, 'base': base_vertical}
     return data
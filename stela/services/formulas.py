@@ -0,0 +1,200 @@
+"""
+Compilación de fórmulas de RatioDef.
+
+Cada RatioDef.formula (ej: '(ACTIVO_CORRIENTE)/(PASIVO_CORRIENTE)') se
+parsea una sola vez y se convierte en un evaluador reutilizable que recibe
+un diccionario {clave_linea: valor}. Los evaluadores se guardan en una
+cache de proceso indexada por el texto de la fórmula.
+
+Reglas de evaluación (las mismas que usaba calcular_y_guardar_ratios):
+- Solo se permiten +, -, *, / y el menos unario.
+- Las claves que no estén en el diccionario valen 0.
+- Una división entre 0 hace que el ratio completo sea None.
+
+Además del evaluador escalar (Decimal) cada fórmula tiene un evaluador
+vectorial (NumPy) que calcula el ratio para muchas filas a la vez; ahí la
+división entre 0 produce NaN.
+"""
+import ast
+import operator
+from decimal import Decimal, InvalidOperation
+import numpy as np
+
+# Operadores permitidos en las fórmulas
+OPS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+}
+
+CERO = Decimal('0')
+CIEN = Decimal('100')
+
+_cache_formulas = {}
+
+
+class FormulaCompilada:
+    """
+    Fórmula ya parseada y lista para evaluarse sobre un dict de valores.
+
+    Atributos:
+        texto: Texto original de la fórmula
+        claves: frozenset con las claves de línea que usa la fórmula
+    """
+
+    __slots__ = ('texto', 'claves', '_fn', '_fn_vector')
+
+    def __init__(self, texto, claves, fn, fn_vector):
+        self.texto = texto
+        self.claves = claves
+        self._fn = fn
+        self._fn_vector = fn_vector
+
+    def evaluar(self, valores, porcentaje=False):
+        """
+        Evalúa la fórmula con los valores dados.
+
+        Args:
+            valores: dict {clave: Decimal}
+            porcentaje: Si es True multiplica el resultado por 100
+
+        Returns:
+            Decimal o None si hay división entre cero
+        """
+        try:
+            val = self._fn(valores)
+        except (ZeroDivisionError, InvalidOperation):
+            return None
+        if porcentaje:
+            val *= CIEN
+        return val
+
+    def evaluar_vector(self, columnas, n, porcentaje=False):
+        """
+        Evalúa la fórmula sobre columnas NumPy (una fila por empresa/período).
+
+        Args:
+            columnas: dict {clave: ndarray float64 de largo n}
+            n: Cantidad de filas
+            porcentaje: Si es True multiplica el resultado por 100
+
+        Returns:
+            ndarray float64 de largo n, con NaN donde hubo división entre cero
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            val = np.broadcast_to(self._fn_vector(columnas, n), (n,)).astype(np.float64)
+        if porcentaje:
+            val = val * 100.0
+        return val
+
+    def __repr__(self):
+        return f"FormulaCompilada({self.texto!r})"
+
+
+def _a_decimal(valor):
+    if valor is None:
+        return CERO
+    if isinstance(valor, Decimal):
+        return valor
+    return Decimal(str(valor))
+
+
+def _compilar_nodo(node, claves):
+    """Convierte un nodo AST en una función valores -> Decimal."""
+    if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)) \
+            and not isinstance(node.value, bool):
+        const = Decimal(str(node.value))
+        return lambda valores: const
+
+    if isinstance(node, ast.Name):
+        clave = node.id
+        claves.add(clave)
+        return lambda valores: _a_decimal(valores.get(clave))
+
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+        operando = _compilar_nodo(node.operand, claves)
+        return lambda valores: -operando(valores)
+
+    if isinstance(node, ast.BinOp) and type(node.op) in OPS:
+        izq = _compilar_nodo(node.left, claves)
+        der = _compilar_nodo(node.right, claves)
+        if isinstance(node.op, ast.Div):
+            def dividir(valores):
+                den = der(valores)
+                if den == 0:
+                    raise ZeroDivisionError
+                return izq(valores) / den
+            return dividir
+        op = OPS[type(node.op)]
+        return lambda valores: op(izq(valores), der(valores))
+
+    raise ValueError("Expresión no soportada")
+
+
+def _compilar_vector(node):
+    """Convierte un nodo AST (ya validado) en una función (columnas, n) -> ndarray."""
+    if isinstance(node, ast.Constant):
+        const = float(node.value)
+        return lambda columnas, n: const
+
+    if isinstance(node, ast.Name):
+        clave = node.id
+        return lambda columnas, n: columnas[clave] if clave in columnas else np.zeros(n)
+
+    if isinstance(node, ast.UnaryOp):
+        operando = _compilar_vector(node.operand)
+        return lambda columnas, n: -operando(columnas, n)
+
+    izq = _compilar_vector(node.left)
+    der = _compilar_vector(node.right)
+    if isinstance(node.op, ast.Div):
+        def dividir(columnas, n):
+            den = der(columnas, n)
+            return np.where(den == 0, np.nan, izq(columnas, n) / den)
+        return dividir
+    op = OPS[type(node.op)]
+    return lambda columnas, n: op(izq(columnas, n), der(columnas, n))
+
+
+def compilar_formula(texto):
+    """
+    Devuelve la FormulaCompilada para el texto dado, usando la cache de proceso.
+
+    Raises:
+        ValueError: Si la fórmula tiene sintaxis inválida u operaciones no permitidas
+    """
+    compilada = _cache_formulas.get(texto)
+    if compilada is not None:
+        return compilada
+    try:
+        arbol = ast.parse(texto.strip(), mode='eval')
+    except SyntaxError as e:
+        raise ValueError(f"Fórmula inválida: {texto}") from e
+    claves = set()
+    fn = _compilar_nodo(arbol.body, claves)
+    compilada = FormulaCompilada(texto, frozenset(claves), fn, _compilar_vector(arbol.body))
+    _cache_formulas[texto] = compilada
+    return compilada
+
+
+def evaluar_ratio(ratio, valores):
+    """
+    Evalúa un RatioDef sobre un dict de valores de línea.
+
+    Returns:
+        Decimal o None si la fórmula es inválida o divide entre cero
+    """
+    try:
+        compilada = compilar_formula(ratio.formula)
+    except ValueError:
+        return None
+    return compilada.evaluar(valores, porcentaje=ratio.porcentaje)
+
+
+def invalidar_formula(texto=None):
+    """Elimina una fórmula de la cache (o toda la cache si texto es None)."""
+    if texto is None:
+        _cache_formulas.clear()
+    else:
+        _cache_formulas.pop(texto, None)
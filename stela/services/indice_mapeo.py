@@ -0,0 +1,127 @@
+"""
+Índice de líneas de estado y mapeos cuenta → línea, en la cache de Django.
+
+estado_dict consultaba MapeoCuentaLinea una vez por LineaEstado en cada
+llamada. Aquí los mapeos del catálogo de una empresa se traen en una sola
+consulta y se agrupan como {clave_linea: [(cuenta_id, signo), ...]}; el
+índice queda en la cache de Django (compartida entre procesos si el backend
+lo es) bajo una clave con versión.
+
+La cache se invalida así:
+
+- al reescribir los mapeos de un catálogo (mapear_cuentas_por_bloques,
+  catalogo_mapeo_cuentas) se borra una vez la entrada de esa empresa; dentro
+  de sin_senales_mapeo las señales de cada fila no invalidan nada;
+- la señal de MapeoCuentaLinea (ej. cambios desde el admin) borra solo la
+  entrada de la empresa dueña de la cuenta;
+- la señal de LineaEstado sube la versión, y con ella caducan todas las
+  entradas;
+- cada entrada vence a los TTL_INDICE segundos, así que con una cache local
+  por proceso un cambio hecho en otro proceso se ve a lo sumo tras ese plazo.
+"""
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from django.core.cache import cache
+from stela.models.finanzas import LineaEstado, MapeoCuentaLinea
+
+# Segundos que se conserva una entrada del índice (igual que el registro de ratios)
+TTL_INDICE = 300
+
+CLAVE_VERSION = 'stela:indice_mapeo:version'
+
+_estado = threading.local()
+
+
+@contextmanager
+def sin_senales_mapeo():
+    """
+    Desactiva, en este hilo, las invalidaciones que las señales de
+    MapeoCuentaLinea hacen fila por fila. Lo usan los servicios que reescriben
+    los mapeos de un catálogo completo e invalidan una sola vez al terminar.
+    """
+    _estado.suspendido = getattr(_estado, 'suspendido', 0) + 1
+    try:
+        yield
+    finally:
+        _estado.suspendido -= 1
+
+
+def senales_mapeo_suspendidas():
+    return bool(getattr(_estado, 'suspendido', 0))
+
+
+def _version():
+    version = cache.get(CLAVE_VERSION)
+    if version is None:
+        # Un valor nuevo (no 1) para no reutilizar entradas de una versión anterior
+        # si la clave de versión fue desalojada
+        cache.add(CLAVE_VERSION, time.time_ns(), None)
+        version = cache.get(CLAVE_VERSION)
+    return version
+
+
+def _clave(nombre):
+    return f'stela:indice_mapeo:{_version()}:{nombre}'
+
+
+def _lineas():
+    clave = _clave('lineas')
+    lineas_cacheadas = cache.get(clave)
+    if lineas_cacheadas is None:
+        lineas = defaultdict(list)
+        ids = {}
+        for pk, estado, clave_linea, nombre, base in LineaEstado.objects.order_by('pk').values_list(
+                'pk', 'estado', 'clave', 'nombre', 'base_vertical'):
+            lineas[estado].append((clave_linea, nombre, base))
+            ids[clave_linea] = pk
+        lineas_cacheadas = (dict(lineas), ids)
+        cache.set(clave, lineas_cacheadas, TTL_INDICE)
+    return lineas_cacheadas
+
+
+def lineas_por_estado(tipo_estado):
+    """Líneas del estado como tuplas (clave, nombre, base_vertical)."""
+    return _lineas()[0].get(tipo_estado, [])
+
+
+def ids_lineas():
+    """dict {clave: pk} de todas las LineaEstado."""
+    return _lineas()[1]
+
+
+def mapeos_empresa(empresa_id):
+    """
+    Mapeos del catálogo de la empresa (una consulta, luego desde cache).
+
+    Returns:
+        dict: {clave_linea: [(cuenta_id, signo), ...]}
+    """
+    clave = _clave(f'empresa:{empresa_id}')
+    mapeos = cache.get(clave)
+    if mapeos is None:
+        agrupados = defaultdict(list)
+        for clave_linea, cuenta_id, signo in MapeoCuentaLinea.objects.filter(
+                cuenta__grupo__catalogo__empresa_id=empresa_id).values_list('linea__clave', 'cuenta_id', 'signo'):
+            agrupados[clave_linea].append((cuenta_id, signo))
+        mapeos = dict(agrupados)
+        cache.set(clave, mapeos, TTL_INDICE)
+    return mapeos
+
+
+def invalidar_indice_mapeo(catalogo=None, empresa_id=None):
+    """
+    Descarta los mapeos en cache del catálogo (o la empresa) dado, o todo el
+    índice (mapeos y líneas, subiendo la versión) si no se indica ninguno.
+    """
+    if catalogo is not None:
+        empresa_id = catalogo.empresa_id
+    if empresa_id is not None:
+        cache.delete(_clave(f'empresa:{empresa_id}'))
+        return
+    try:
+        cache.incr(CLAVE_VERSION)
+    except ValueError:
+        # La clave de versión no existe (o fue desalojada): empezar una nueva
+        cache.add(CLAVE_VERSION, time.time_ns(), None)
@@ -19,7 +19,33 @@ ratio_tag se agrupen automáticamente en la misma línea de estado.
 
 from stela.models.finanzas import LineaEstado, MapeoCuentaLinea
 from stela.models.catalogo import Cuenta
+from .cache_analisis import incrementar_revision
+from .indice_mapeo import invalidar_indice_mapeo, sin_senales_mapeo
+from .saldos_linea import descartar_saldos_linea
+from .version_datos import incrementar_version_datos
 from collections import defaultdict
+from contextlib import contextmanager
+
+
+@contextmanager
+def reescritura_mapeos(catalogo):
+    """
+    Bloque que reescribe los mapeos de un catálogo completo.
+
+    Dentro del bloque las señales de MapeoCuentaLinea no invalidan nada fila
+    por fila; al salir se descarta una sola vez lo que depende de los mapeos
+    del catálogo: su índice en cache, los SaldoLinea de los balances que usan
+    sus cuentas, la revisión de esos balances y la versión de datos de la
+    empresa.
+    """
+    try:
+        with sin_senales_mapeo():
+            yield
+    finally:
+        invalidar_indice_mapeo(catalogo)
+        descartar_saldos_linea(balance__detalles__cuenta__grupo__catalogo=catalogo)
+        incrementar_revision(detalles__cuenta__grupo__catalogo=catalogo)
+        incrementar_version_datos(pk=catalogo.empresa_id)
 
 
 def mapear_cuentas_por_bloques(catalogo):
@@ -65,99 +91,101 @@ def mapear_cuentas_por_bloques(catalogo):
         )
     
     resumen = defaultdict(int)
+
+    # Las señales por fila no invalidan nada: se invalida una vez al salir
+    with reescritura_mapeos(catalogo):
     
-    # Obtener todas las cuentas del catálogo que tengan ratio_tag
-    cuentas_con_tag = Cuenta.objects.filter(
-        grupo__catalogo=catalogo,
-        ratio_tag__isnull=False
-    ).exclude(ratio_tag='')
+        # Obtener todas las cuentas del catálogo que tengan ratio_tag
+        cuentas_con_tag = Cuenta.objects.filter(
+            grupo__catalogo=catalogo,
+            ratio_tag__isnull=False
+        ).exclude(ratio_tag='')
     
-    # Agrupar cuentas por ratio_tag
-    cuentas_por_tag = defaultdict(list)
-    for cuenta in cuentas_con_tag:
-        tag = cuenta.ratio_tag.strip()
-        if tag:
-            # Manejar tags negativos (ej: -VENTAS_NETAS para restar)
-            signo = -1 if tag.startswith('-') else 1
-            tag_limpio = tag.lstrip('-')
-            cuentas_por_tag[tag_limpio].append((cuenta, signo))
+        # Agrupar cuentas por ratio_tag
+        cuentas_por_tag = defaultdict(list)
+        for cuenta in cuentas_con_tag:
+            tag = cuenta.ratio_tag.strip()
+            if tag:
+                # Manejar tags negativos (ej: -VENTAS_NETAS para restar)
+                signo = -1 if tag.startswith('-') else 1
+                tag_limpio = tag.lstrip('-')
+                cuentas_por_tag[tag_limpio].append((cuenta, signo))
     
-    # Mapear cada grupo de cuentas a su línea de estado correspondiente
-    for ratio_tag, lista_cuentas in cuentas_por_tag.items():
-        try:
-            # Buscar la línea de estado con clave igual al ratio_tag
-            linea = LineaEstado.objects.get(clave=ratio_tag)
-        except LineaEstado.DoesNotExist:
-            # Si no existe la línea, continuar (puede ser un tag que no se usa en ratios)
-            continue
-        
-        # Eliminar mapeos existentes para esta línea en este catálogo
-        # Esto permite re-mapear sin crear duplicados
-        MapeoCuentaLinea.objects.filter(
-            linea=linea,
-            cuenta__grupo__catalogo=catalogo
-        ).delete()
+        # Mapear cada grupo de cuentas a su línea de estado correspondiente
+        for ratio_tag, lista_cuentas in cuentas_por_tag.items():
+            try:
+                # Buscar la línea de estado con clave igual al ratio_tag
+                linea = LineaEstado.objects.get(clave=ratio_tag)
+            except LineaEstado.DoesNotExist:
+                # Si no existe la línea, continuar (puede ser un tag que no se usa en ratios)
+                continue
         
-        # Crear nuevos mapeos para todas las cuentas con este tag
-        cuentas_mapeadas = 0
-        for cuenta, signo in lista_cuentas:
-            mapeo, created = MapeoCuentaLinea.objects.get_or_create(
-                cuenta=cuenta,
+            # Eliminar mapeos existentes para esta línea en este catálogo
+            # Esto permite re-mapear sin crear duplicados
+            MapeoCuentaLinea.objects.filter(
                 linea=linea,
-                defaults={'signo': signo}
-            )
-            if created:
-                cuentas_mapeadas += 1
-            elif mapeo.signo != signo:
-                # Actualizar signo si cambió
-                mapeo.signo = signo
-                mapeo.save()
-                cuentas_mapeadas += 1
+                cuenta__grupo__catalogo=catalogo
+            ).delete()
+        
+            # Crear nuevos mapeos para todas las cuentas con este tag
+            cuentas_mapeadas = 0
+            for cuenta, signo in lista_cuentas:
+                mapeo, created = MapeoCuentaLinea.objects.get_or_create(
+                    cuenta=cuenta,
+                    linea=linea,
+                    defaults={'signo': signo}
+                )
+                if created:
+                    cuentas_mapeadas += 1
+                elif mapeo.signo != signo:
+                    # Actualizar signo si cambió
+                    mapeo.signo = signo
+                    mapeo.save()
+                    cuentas_mapeadas += 1
         
-        resumen[ratio_tag] = cuentas_mapeadas
+            resumen[ratio_tag] = cuentas_mapeadas
     
-    # Mapear TOTAL_ACTIVO (suma de todas las cuentas de activo)
-    # Esto es especial porque no se mapea por ratio_tag, sino por naturaleza
-    try:
-        linea_total_activo = LineaEstado.objects.get(clave='TOTAL_ACTIVO')
-    except LineaEstado.DoesNotExist:
-        pass
-    else:
-        # Obtener todas las cuentas de activo (corriente y no corriente)
-        # que no tengan un ratio_tag específico que ya las mapee
-        cuentas_activo = Cuenta.objects.filter(
-            grupo__catalogo=catalogo,
-            grupo__naturaleza='Activo',
-            bg_bloque__in=['ACTIVO_CORRIENTE', 'ACTIVO_NO_CORRIENTE']
-        )
+        # Mapear TOTAL_ACTIVO (suma de todas las cuentas de activo)
+        # Esto es especial porque no se mapea por ratio_tag, sino por naturaleza
+        try:
+            linea_total_activo = LineaEstado.objects.get(clave='TOTAL_ACTIVO')
+        except LineaEstado.DoesNotExist:
+            pass
+        else:
+            # Obtener todas las cuentas de activo (corriente y no corriente)
+            # que no tengan un ratio_tag específico que ya las mapee
+            cuentas_activo = Cuenta.objects.filter(
+                grupo__catalogo=catalogo,
+                grupo__naturaleza='Activo',
+                bg_bloque__in=['ACTIVO_CORRIENTE', 'ACTIVO_NO_CORRIENTE']
+            )
         
-        # Eliminar mapeos existentes
-        MapeoCuentaLinea.objects.filter(
-            linea=linea_total_activo,
-            cuenta__grupo__catalogo=catalogo
-        ).delete()
+            # Eliminar mapeos existentes
+            MapeoCuentaLinea.objects.filter(
+                linea=linea_total_activo,
+                cuenta__grupo__catalogo=catalogo
+            ).delete()
         
-        # Crear nuevos mapeos (solo si la cuenta no está ya mapeada por ratio_tag)
-        cuentas_mapeadas = 0
-        for cuenta in cuentas_activo:
-            # Verificar si la cuenta ya está mapeada por ratio_tag
-            # Si tiene ratio_tag='ACTIVO_CORRIENTE' o similar, ya está mapeada
-            if cuenta.ratio_tag and cuenta.ratio_tag.strip() in ['ACTIVO_CORRIENTE', 'ACTIVO_TOTAL', 'ACTIVO_FIJO_NETO']:
-                continue
+            # Crear nuevos mapeos (solo si la cuenta no está ya mapeada por ratio_tag)
+            cuentas_mapeadas = 0
+            for cuenta in cuentas_activo:
+                # Verificar si la cuenta ya está mapeada por ratio_tag
+                # Si tiene ratio_tag='ACTIVO_CORRIENTE' o similar, ya está mapeada
+                if cuenta.ratio_tag and cuenta.ratio_tag.strip() in ['ACTIVO_CORRIENTE', 'ACTIVO_TOTAL', 'ACTIVO_FIJO_NETO']:
+                    continue
             
-            mapeo, created = MapeoCuentaLinea.objects.get_or_create(
-                cuenta=cuenta,
-                linea=linea_total_activo,
-                defaults={'signo': 1}
-            )
-            if created:
-                cuentas_mapeadas += 1
+                mapeo, created = MapeoCuentaLinea.objects.get_or_create(
+                    cuenta=cuenta,
+                    linea=linea_total_activo,
+                    defaults={'signo': 1}
+                )
+                if created:
+                    cuentas_mapeadas += 1
         
-        resumen['TOTAL_ACTIVO'] = cuentas_mapeadas
+            resumen['TOTAL_ACTIVO'] = cuentas_mapeadas
     
-    # NOTA: UTILIDAD_NETA no se mapea directamente desde cuentas.
-    # Se calcula en calcular_totales_por_seccion() a partir de los bloques
-    # del Estado de Resultados (VENTAS_NETAS, COSTO_NETO_VENTAS, etc.)
-    
-    return dict(resumen)
+        # NOTA: UTILIDAD_NETA no se mapea directamente desde cuentas.
+        # Se calcula en calcular_totales_por_seccion() a partir de los bloques
+        # del Estado de Resultados (VENTAS_NETAS, COSTO_NETO_VENTAS, etc.)
 
+    return dict(resumen)
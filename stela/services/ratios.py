@@ -1,39 +1,29 @@
-import ast, operator, re
 from decimal import Decimal
-from django.db import transaction
+from django.db import connections, transaction
 from django.db.models import Sum, Q
-from stela.models.finanzas import RatioDef, ResultadoRatio, Balance, BalanceDetalle
+from django.dispatch import Signal
+from stela.models.finanzas import ResultadoRatio, Balance, BalanceDetalle
 from stela.models.catalogo import Cuenta
 from .estados import estado_dict, calcular_totales_por_seccion
+from .formulas import evaluar_ratio
+from .registro_ratios import ratios_definidos
+from .snapshot import PeriodSnapshot, filas_agregadas
 
-# Operadores permitidos en las fórmulas
-OPS = {
-    ast.Add: operator.add,
-    ast.Sub: operator.sub,
-    ast.Mult: operator.mul,
-    ast.Div: operator.truediv,
-    ast.USub: operator.neg,
-}
 
-def _eval(node):
-    """Evalúa un AST con operaciones seguras (solo +, -, *, / y unarios)."""
-    if isinstance(node, ast.Num):  # números literales
-        return Decimal(str(node.n))
-    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
-        return -_eval(node.operand)
-    if isinstance(node, ast.BinOp):
-        return OPS[type(node.op)](_eval(node.left), _eval(node.right))
-    raise ValueError("Expresión no soportada")
+# Se envía después de guardar ResultadoRatio con pares={(empresa_id, periodo_id), ...}
+ratios_guardados = Signal()
 
-def _replace_missing(expr: str) -> str:
-    """
-    Si en la fórmula aparecen CLAVES que no están en cache,
-    las reemplazamos por (0) para evitar NameError.
-    """
-    return re.sub(r'\b[A-Z_][A-Z0-9_]*\b', '(0)', expr)
+
+# Bloques (bg_bloque/er_bloque) que alimentan directamente una clave de ratio
+MAPEO_BLOQUES = {
+    'ACTIVO_CORRIENTE': 'ACTIVO_CORRIENTE',
+    'PASIVO_CORRIENTE': 'PASIVO_CORRIENTE',
+    'PATRIMONIO': 'PATRIMONIO_TOTAL',
+    'VENTAS_NETAS': 'VENTAS_NETAS',
+}
 
 
-def calcular_valores_desde_ratio_tag(empresa, periodo, tipo_estado='BAL'):
+def calcular_valores_desde_ratio_tag(empresa, periodo, tipo_estado='BAL', snapshot=None):
     """
     Calcula los valores de las líneas de estado directamente desde las cuentas
     usando ratio_tag y bg_bloque/er_bloque, sin depender de MapeoCuentaLinea.
@@ -45,31 +35,38 @@ def calcular_valores_desde_ratio_tag(empresa, periodo, tipo_estado='BAL'):
         empresa: Instancia de Empresa
         periodo: Instancia de Periodo
         tipo_estado: 'BAL' o 'RES'
+        snapshot: PeriodSnapshot ya cargado del período (opcional)
         
     Returns:
         dict: {clave: Decimal} con los valores calculados
     """
-    try:
-        balance = Balance.objects.get(empresa=empresa, periodo=periodo, tipo_balance=tipo_estado)
-    except Balance.DoesNotExist:
+    if snapshot is None:
+        # Sin snapshot: una sola consulta agregada (Sum agrupado por tag/bloques/naturaleza)
+        detalles = filas_agregadas(
+            Balance.objects.filter(empresa=empresa, periodo=periodo, tipo_balance=tipo_estado)
+        )
+        if detalles is None:
+            return {}
+        snapshot = PeriodSnapshot(empresa, periodo, {tipo_estado: None}, {tipo_estado: detalles}, agregado=True)
+    if not snapshot.tiene(tipo_estado):
         return {}
+    # Todo aquí son sumas por tag/bloque/naturaleza: basta con las filas agregadas
+    # (una consulta GROUP BY compartida por BAL y RES, no una fila por cuenta)
+    snapshot = snapshot.agregado()
     
-    # Obtener todos los detalles del balance con sus cuentas
-    detalles = BalanceDetalle.objects.filter(
-        balance=balance
-    ).select_related('cuenta', 'cuenta__grupo')
+    # Filas (saldo, naturaleza, bloques, tag) del balance, ya agregadas
+    detalles = snapshot.detalles(tipo_estado)
     
     # Agrupar por ratio_tag y sumar saldos
     valores_por_tag = {}
     valores_por_bloque = {}
     
     for detalle in detalles:
-        cuenta = detalle.cuenta
-        saldo = detalle.saldo or Decimal('0')
+        saldo = detalle.saldo
         
         # Si la cuenta tiene ratio_tag, agregar su saldo
-        if cuenta.ratio_tag and cuenta.ratio_tag.strip():
-            tag = cuenta.ratio_tag.strip()
+        if detalle.ratio_tag and detalle.ratio_tag.strip():
+            tag = detalle.ratio_tag.strip()
             # Manejar tags negativos (ej: -VENTAS_NETAS)
             signo = -1 if tag.startswith('-') else 1
             tag_limpio = tag.lstrip('-')
@@ -81,8 +78,8 @@ def calcular_valores_desde_ratio_tag(empresa, periodo, tipo_estado='BAL'):
         
         # También agregar por bloques para compatibilidad
         # Para Balance General: sumar saldos por bg_bloque
-        if tipo_estado == 'BAL' and cuenta.bg_bloque:
-            bloque = cuenta.bg_bloque.strip()
+        if tipo_estado == 'BAL' and detalle.bg_bloque:
+            bloque = detalle.bg_bloque.strip()
             if bloque:
                 if bloque not in valores_por_bloque:
                     valores_por_bloque[bloque] = Decimal('0')
@@ -90,30 +87,22 @@ def calcular_valores_desde_ratio_tag(empresa, periodo, tipo_estado='BAL'):
                 valores_por_bloque[bloque] += saldo
         
         # Para Estado de Resultados: sumar saldos por er_bloque
-        if tipo_estado == 'RES' and cuenta.er_bloque:
-            bloque = cuenta.er_bloque.strip()
+        if tipo_estado == 'RES' and detalle.er_bloque:
+            bloque = detalle.er_bloque.strip()
             if bloque:
                 if bloque not in valores_por_bloque:
                     valores_por_bloque[bloque] = Decimal('0')
                 valores_por_bloque[bloque] += saldo
     
-    # Mapear bloques a claves de ratio (para compatibilidad con fórmulas)
-    mapeo_bloques = {
-        'ACTIVO_CORRIENTE': 'ACTIVO_CORRIENTE',
-        'PASIVO_CORRIENTE': 'PASIVO_CORRIENTE',
-        'PATRIMONIO': 'PATRIMONIO_TOTAL',
-        'VENTAS_NETAS': 'VENTAS_NETAS',
-    }
-    
     # Siempre usar valores de bloques si existen (tienen prioridad sobre ratio_tag individual)
     # Esto asegura que se calculen correctamente desde bg_bloque/er_bloque
-    for bloque, clave in mapeo_bloques.items():
+    for bloque, clave in MAPEO_BLOQUES.items():
         if bloque in valores_por_bloque:
             valores_por_tag[clave] = valores_por_bloque[bloque]
     
     # Para UTILIDAD_NETA, calcular desde los bloques consolidados
     if tipo_estado == 'RES':
-        totales = calcular_totales_por_seccion(balance)
+        totales = calcular_totales_por_seccion(snapshot=snapshot, tipo_estado='RES')
         if 'UTILIDAD_NETA' in totales:
             valores_por_tag['UTILIDAD_NETA'] = totales['UTILIDAD_NETA']
     
@@ -122,17 +111,16 @@ def calcular_valores_desde_ratio_tag(empresa, periodo, tipo_estado='BAL'):
         # TOTAL_ACTIVO: sumar todos los activos
         total_activo = Decimal('0')
         for detalle in detalles:
-            if detalle.cuenta.grupo.naturaleza == 'Activo':
-                total_activo += detalle.saldo or Decimal('0')
+            if detalle.naturaleza == 'Activo':
+                total_activo += detalle.saldo
         valores_por_tag['TOTAL_ACTIVO'] = total_activo
         
         # ACTIVO_CORRIENTE: usar bloque si existe, sino calcular desde naturaleza
         if 'ACTIVO_CORRIENTE' not in valores_por_tag:
             activo_corriente = Decimal('0')
             for detalle in detalles:
-                if (detalle.cuenta.grupo.naturaleza == 'Activo' and 
-                    detalle.cuenta.bg_bloque == 'ACTIVO_CORRIENTE'):
-                    activo_corriente += detalle.saldo or Decimal('0')
+                if detalle.naturaleza == 'Activo' and detalle.bg_bloque == 'ACTIVO_CORRIENTE':
+                    activo_corriente += detalle.saldo
             valores_por_tag['ACTIVO_CORRIENTE'] = activo_corriente
         
         # PASIVO_CORRIENTE: siempre calcular desde bg_bloque
@@ -142,9 +130,8 @@ def calcular_valores_desde_ratio_tag(empresa, periodo, tipo_estado='BAL'):
         else:
             pasivo_corriente = Decimal('0')
             for detalle in detalles:
-                if (detalle.cuenta.grupo.naturaleza == 'Pasivo' and 
-                    detalle.cuenta.bg_bloque == 'PASIVO_CORRIENTE'):
-                    pasivo_corriente += detalle.saldo or Decimal('0')
+                if detalle.naturaleza == 'Pasivo' and detalle.bg_bloque == 'PASIVO_CORRIENTE':
+                    pasivo_corriente += detalle.saldo
             valores_por_tag['PASIVO_CORRIENTE'] = pasivo_corriente
         
         # PATRIMONIO_TOTAL: siempre calcular desde naturaleza
@@ -154,8 +141,8 @@ def calcular_valores_desde_ratio_tag(empresa, periodo, tipo_estado='BAL'):
         else:
             patrimonio = Decimal('0')
             for detalle in detalles:
-                if detalle.cuenta.grupo.naturaleza == 'Patrimonio':
-                    patrimonio += detalle.saldo or Decimal('0')
+                if detalle.naturaleza == 'Patrimonio':
+                    patrimonio += detalle.saldo
             valores_por_tag['PATRIMONIO_TOTAL'] = patrimonio
         
         # Asegurar que siempre existan estos valores (inicializar en 0 si no hay datos)
@@ -168,41 +155,33 @@ def calcular_valores_desde_ratio_tag(empresa, periodo, tipo_estado='BAL'):
     
     return valores_por_tag
 
-@transaction.atomic
-def calcular_y_guardar_ratios(empresa, periodo, tipo_estado='RES'):
+def valores_linea(empresa, periodo, tipo_estado='RES', snapshot=None):
     """
-    Calcula y guarda todos los ratios financieros para una empresa y período.
-    
-    NUEVO FLUJO (directo desde ratio_tag):
-    1. BalanceDetalle: Saldos de cuentas del balance
-    2. Cuenta.ratio_tag: Agrupa cuentas por ratio_tag
-    3. calcular_valores_desde_ratio_tag(): Suma saldos por ratio_tag
-    4. RatioDef: Fórmulas que usan claves de ratio_tag (ej: (ACTIVO_CORRIENTE)/(PASIVO_CORRIENTE))
-    5. ResultadoRatio: Almacenamiento del resultado calculado
-    
-    El proceso:
-    - Calcula valores directamente desde las cuentas usando ratio_tag
-    - Obtiene valores de ambos tipos de estado (BAL y RES) si es necesario
-    - Para cada RatioDef, reemplaza las claves en la fórmula con los valores reales
-    - Evalúa la expresión matemática
-    - Si el ratio es porcentaje, multiplica por 100
-    - Guarda el resultado en ResultadoRatio
-    
+    Valores de línea de un período, listos para evaluar fórmulas.
+
+    Salen de calcular_valores_desde_ratio_tag (prioridad) y de estado_dict,
+    para BAL y RES, sobre un mismo PeriodSnapshot.
+
     Args:
         empresa: Instancia de Empresa
         periodo: Instancia de Periodo
         tipo_estado: 'BAL' o 'RES' (por defecto 'RES')
-        
+        snapshot: PeriodSnapshot ya cargado del período (opcional)
+
     Returns:
-        list: Lista de diccionarios con {'clave': str, 'nombre': str, 'valor': Decimal}
+        dict: {clave: Decimal}
     """
+    # Un solo snapshot del período alimenta los cuatro cálculos (BAL/RES x tag/estado)
+    if snapshot is None:
+        snapshot = PeriodSnapshot.cargar(empresa, periodo)
+
     # Calcular valores directamente desde ratio_tag para el tipo de estado especificado
-    valores_ratio_tag = calcular_valores_desde_ratio_tag(empresa, periodo, tipo_estado)
+    valores_ratio_tag = calcular_valores_desde_ratio_tag(empresa, periodo, tipo_estado, snapshot=snapshot)
     
     # También obtener valores del otro tipo de estado si existe (para ratios que combinan ambos)
     tipo_otro = 'RES' if tipo_estado == 'BAL' else 'BAL'
     try:
-        valores_otro = calcular_valores_desde_ratio_tag(empresa, periodo, tipo_otro)
+        valores_otro = calcular_valores_desde_ratio_tag(empresa, periodo, tipo_otro, snapshot=snapshot)
         valores_ratio_tag.update(valores_otro)
     except:
         pass
@@ -210,14 +189,14 @@ def calcular_y_guardar_ratios(empresa, periodo, tipo_estado='RES'):
     # También intentar obtener valores desde estado_dict (para compatibilidad)
     # pero usar los valores de ratio_tag como prioridad
     try:
-        data_estado = estado_dict(empresa, periodo, tipo_estado)
+        data_estado = estado_dict(empresa, periodo, tipo_estado, snapshot=snapshot)
         cache_estado = {k: v['monto'] for k, v in data_estado.items()}
     except:
         cache_estado = {}
     
     # Intentar también el otro tipo de estado
     try:
-        data_otro = estado_dict(empresa, periodo, tipo_otro)
+        data_otro = estado_dict(empresa, periodo, tipo_otro, snapshot=snapshot)
         cache_otro = {k: v['monto'] for k, v in data_otro.items()}
         cache_estado.update(cache_otro)
     except:
@@ -229,75 +208,111 @@ def calcular_y_guardar_ratios(empresa, periodo, tipo_estado='RES'):
     # Debug: Log de valores calculados (solo en desarrollo)
     # logger.debug(f"Valores calculados para {empresa.nit} período {periodo}: {cache}")
     
-    # Asegurar que los ratios base existan (crear si no existen)
-    ratios_base = [
-        ('LIQUIDEZ_CORRIENTE', 'Liquidez Corriente', '(ACTIVO_CORRIENTE)/(PASIVO_CORRIENTE)', False),
-        ('ENDEUDAMIENTO', 'Endeudamiento', '(PASIVO_CORRIENTE)/(TOTAL_ACTIVO)', True),
-        ('MARGEN_NETO', 'Margen Neto', '(UTILIDAD_NETA)/(VENTAS_NETAS)', True),
-        ('ROA', 'Rentabilidad sobre Activos (ROA)', '(UTILIDAD_NETA)/(TOTAL_ACTIVO)', True),
-        ('ROE', 'Rentabilidad sobre Patrimonio (ROE)', '(UTILIDAD_NETA)/(PATRIMONIO_TOTAL)', True),
-        ('ROTACION_ACTIVOS', 'Rotación de Activos', '(VENTAS_NETAS)/(TOTAL_ACTIVO)', False),
-        ('APALANCAMIENTO', 'Apalancamiento', '(TOTAL_ACTIVO)/(PATRIMONIO_TOTAL)', False),
-        ('CAPITAL_TRABAJO', 'Capital de Trabajo', '(ACTIVO_CORRIENTE)-(PASIVO_CORRIENTE)', False),
-        ('RAZON_ACTIVOS_CORRIENTES', 'Razón de Activos Corrientes', '(ACTIVO_CORRIENTE)/(TOTAL_ACTIVO)', True),
-        ('RAZON_PATRIMONIO', 'Razón de Patrimonio', '(PATRIMONIO_TOTAL)/(TOTAL_ACTIVO)', True),
+    return cache
+
+
+def calcular_ratios(empresa, periodo, tipo_estado='RES', snapshot=None):
+    """
+    Evalúa todos los RatioDef para una empresa y período, sin guardar.
+
+    Args:
+        empresa: Instancia de Empresa
+        periodo: Instancia de Periodo
+        tipo_estado: 'BAL' o 'RES' (por defecto 'RES'); sus valores ganan en caso de choque
+        snapshot: PeriodSnapshot ya cargado del período (opcional)
+
+    Returns:
+        list: Lista de tuplas (RatioDef, Decimal o None)
+    """
+    cache = valores_linea(empresa, periodo, tipo_estado, snapshot=snapshot)
+    return [(r, evaluar_ratio(r, cache)) for r in ratios_definidos()]
+
+
+def guardar_resultados_ratios(filas):
+    """
+    Guarda (upsert) resultados de ratios en un solo INSERT ... ON CONFLICT /
+    ON DUPLICATE KEY UPDATE, usando la restricción única (empresa, periodo, ratio).
+
+    Sirve para uno o muchos períodos y empresas a la vez.
+
+    Args:
+        filas: iterable de tuplas (empresa_id, periodo_id, ratio_id, valor)
+
+    Returns:
+        int: Cantidad de filas enviadas a la BD
+    """
+    # Si una misma clave viene repetida gana la última (como update_or_create)
+    por_clave = {}
+    for empresa_id, periodo_id, ratio_id, valor in filas:
+        por_clave[(empresa_id, periodo_id, ratio_id)] = valor
+    if not por_clave:
+        return 0
+
+    objs = [
+        ResultadoRatio(empresa_id=e, periodo_id=p, ratio_id=r, valor=v)
+        for (e, p, r), v in por_clave.items()
     ]
-    for clave, nombre, formula, porcentaje in ratios_base:
-        RatioDef.objects.get_or_create(
-            clave=clave,
-            defaults={'nombre': nombre, 'formula': formula, 'porcentaje': porcentaje}
-        )
+    opciones = {'update_conflicts': True, 'update_fields': ['valor']}
+    # MySQL no admite indicar las columnas del conflicto (usa cualquier UNIQUE)
+    if connections[ResultadoRatio.objects.db].features.supports_update_conflicts_with_target:
+        opciones['unique_fields'] = ['empresa', 'periodo', 'ratio']
+    ResultadoRatio.objects.bulk_create(objs, **opciones)
+    ratios_guardados.send(sender=ResultadoRatio, pares={(e, p) for e, p, _ in por_clave})
+    return len(objs)
+
+
+@transaction.atomic
+def calcular_y_guardar_ratios(empresa, periodo, tipo_estado='RES', snapshot=None):
+    """
+    Calcula y guarda todos los ratios financieros para una empresa y período.
+    
+    NUEVO FLUJO (directo desde ratio_tag):
+    1. BalanceDetalle: Saldos de cuentas del balance
+    2. Cuenta.ratio_tag: Agrupa cuentas por ratio_tag
+    3. calcular_valores_desde_ratio_tag(): Suma saldos por ratio_tag
+    4. RatioDef: Fórmulas que usan claves de ratio_tag (ej: (ACTIVO_CORRIENTE)/(PASIVO_CORRIENTE))
+    5. ResultadoRatio: Almacenamiento del resultado calculado
     
-    resultados = []
-    for r in RatioDef.objects.all():
-        expr = r.formula
-        # Reemplazar claves en la fórmula con valores del cache
-        for k, m in cache.items():
-            expr = expr.replace(k, f'({m})')
-        # Reemplazar claves faltantes con 0
-        expr = _replace_missing(expr)
+    El proceso:
+    - Calcula valores directamente desde las cuentas usando ratio_tag
+    - Obtiene valores de ambos tipos de estado (BAL y RES) si es necesario
+    - Para cada RatioDef, evalúa su fórmula compilada (cacheada por texto) con los valores
+    - Si el ratio es porcentaje, multiplica por 100
+    - Guarda todos los resultados en ResultadoRatio con un solo upsert
+    
+    Args:
+        empresa: Instancia de Empresa
+        periodo: Instancia de Periodo
+        tipo_estado: 'BAL' o 'RES' (por defecto 'RES')
+        snapshot: PeriodSnapshot ya cargado del período (opcional)
+        
+    Returns:
+        list: Lista de diccionarios con {'clave': str, 'nombre': str, 'valor': Decimal}
+    """
+    pares = calcular_ratios(empresa, periodo, tipo_estado, snapshot=snapshot)
+    guardar_resultados_ratios(
+        (empresa.pk, periodo.pk, r.pk, val) for r, val in pares
+    )
+    return [{'clave': r.clave, 'nombre': r.nombre, 'valor': val} for r, val in pares]
 
-        try:
-            # Verificar división por cero antes de evaluar
-            # Buscar patrones de división como (X)/(Y) donde Y podría ser 0
-            division_pattern = r'\(([^)]+)\)\s*/\s*\(([^)]+)\)'
-            matches = re.findall(division_pattern, expr)
-            division_por_cero = False
-            for num, den in matches:
-                try:
-                    den_val = Decimal(den)
-                    if den_val == 0:
-                        division_por_cero = True
-                        break
-                except:
-                    pass
-            
-            if division_por_cero:
-                val = None
-            else:
-                # No hay división por cero, evaluar normalmente
-                val = _eval(ast.parse(expr, mode='eval').body)
-                if r.porcentaje:
-                    val *= Decimal('100')
-        except (ZeroDivisionError, ValueError, TypeError) as e:
-            val = None
-        except Exception as e:
-            # Para otros errores, intentar evaluar de todas formas
-            try:
-                val = _eval(ast.parse(expr, mode='eval').body)
-                if r.porcentaje:
-                    val *= Decimal('100')
-            except:
-                val = None
-        ResultadoRatio.objects.update_or_create(
-            empresa=empresa,
-            periodo=periodo,
-            ratio=r,
-            defaults={'valor': val}
-        )
-        resultados.append({'clave': r.clave, 'nombre': r.nombre, 'valor': val})
 
-    return resultados
+@transaction.atomic
+def calcular_y_guardar_ratios_periodos(empresa, periodos, tipo_estado='RES'):
+    """
+    Igual que calcular_y_guardar_ratios pero para varios períodos de una empresa,
+    escribiendo los resultados de todos ellos en un solo upsert.
+
+    Returns:
+        dict: {id_periodo: [{'clave', 'nombre', 'valor'}, ...]}
+    """
+    filas = []
+    salida = {}
+    for periodo in periodos:
+        pares = calcular_ratios(empresa, periodo, tipo_estado)
+        filas.extend((empresa.pk, periodo.pk, r.pk, val) for r, val in pares)
+        salida[periodo.pk] = [{'clave': r.clave, 'nombre': r.nombre, 'valor': val} for r, val in pares]
+    guardar_resultados_ratios(filas)
+    return salida
 
 # Alias por compatibilidad (si en algún lado lo llamaste así):
 
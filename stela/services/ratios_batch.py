@@ -0,0 +1,217 @@
+"""
+Cálculo vectorizado de ratios para muchas empresas y períodos a la vez.
+
+En lugar de recorrer cada (empresa, periodo) con calcular_y_guardar_ratios,
+calcular_ratios_batch:
+
+1. Suma los saldos de BalanceDetalle en la BD, agrupados por
+   (empresa, periodo, tipo, naturaleza, bg_bloque, er_bloque, ratio_tag)
+   y, por separado, por línea mapeada (MapeoCuentaLinea).
+2. Con esas sumas arma los valores de línea de cada par aplicando las mismas
+   reglas y prioridades que calcular_ratios.
+3. Construye una matriz NumPy (pares x claves de línea) y evalúa cada
+   fórmula compilada como aritmética de columnas. La división entre 0 da NaN.
+4. Guarda todo con un solo upsert; los NaN se guardan como NULL.
+"""
+from collections import defaultdict
+from decimal import Decimal
+import numpy as np
+from django.db import transaction
+from django.db.models import DecimalField, F, Sum
+from stela.models.finanzas import Balance, BalanceDetalle, LineaEstado
+from .estados import calcular_totales_por_seccion, total_linea_sin_mapeo
+from .formulas import compilar_formula
+from .ratios import calcular_valores_desde_ratio_tag, guardar_resultados_ratios
+from .registro_ratios import ratios_definidos
+from .snapshot import FilaDetalle, PeriodSnapshot
+
+_SUMA = DecimalField(max_digits=20, decimal_places=2)
+
+
+class ResultadoBatch:
+    """
+    Resultado de calcular_ratios_batch.
+
+    Atributos:
+        pares: lista de (empresa_id, periodo_id), una por fila
+        ratios: lista de RatioDef, una por columna
+        valores: ndarray float64 (len(pares) x len(ratios)), NaN = sin valor (NULL)
+    """
+
+    def __init__(self, pares, ratios, valores):
+        self.pares = pares
+        self.ratios = ratios
+        self.valores = valores
+
+    def filas(self):
+        """Itera (empresa_id, periodo_id, ratio_id, Decimal o None) para guardar."""
+        for i, (empresa_id, periodo_id) in enumerate(self.pares):
+            for j, ratio in enumerate(self.ratios):
+                v = self.valores[i, j]
+                yield empresa_id, periodo_id, ratio.pk, (Decimal(repr(float(v))) if np.isfinite(v) else None)
+
+
+def _filtrar(qs, empresas, periodos, prefijo=''):
+    qs = qs.filter(**{f'{prefijo}empresa__in': empresas})
+    if periodos is not None:
+        qs = qs.filter(**{f'{prefijo}periodo__in': periodos})
+    return qs
+
+
+def _valores_estado(tipo, lineas, mapeados, filas):
+    """Replica estado_dict a partir de sumas ya agregadas: {clave: monto}."""
+    data = {}
+    for clave in lineas.get(tipo, []):
+        if clave == 'UTILIDAD_NETA':
+            totales = calcular_totales_por_seccion(
+                snapshot=PeriodSnapshot(None, None, {tipo: None}, {tipo: filas}, agregado=True), tipo_estado=tipo
+            )
+            data[clave] = totales.get('UTILIDAD_NETA', Decimal('0'))
+        elif clave in mapeados:
+            data[clave] = mapeados[clave]
+        elif tipo == 'BAL':
+            data[clave] = total_linea_sin_mapeo(clave, filas)
+        else:
+            data[clave] = Decimal('0')
+    return data
+
+
+def _valores_par(tipos, filas_por_tipo, mapeados_por_tipo, lineas, tipo_estado):
+    """Valores de línea de un par, con la misma prioridad que calcular_ratios."""
+    snapshot = PeriodSnapshot(None, None, {t: None for t in tipos}, filas_por_tipo, agregado=True)
+    tipo_otro = 'RES' if tipo_estado == 'BAL' else 'BAL'
+
+    valores_ratio_tag = calcular_valores_desde_ratio_tag(None, None, tipo_estado, snapshot=snapshot)
+    valores_ratio_tag.update(calcular_valores_desde_ratio_tag(None, None, tipo_otro, snapshot=snapshot))
+
+    cache_estado = {}
+    for tipo in (tipo_estado, tipo_otro):
+        if tipo in tipos:
+            cache_estado.update(_valores_estado(
+                tipo, lineas, mapeados_por_tipo.get(tipo, {}), filas_por_tipo.get(tipo, [])
+            ))
+    return {**cache_estado, **valores_ratio_tag}
+
+
+def _sumas_batch(empresas, periodos):
+    """
+    Sumas agregadas para todos los pares: tipos por par, filas por atributos
+    de cuenta, sumas por línea mapeada y claves de LineaEstado por estado.
+    """
+    # Balances existentes por par
+    tipos_por_par = defaultdict(set)
+    for empresa_id, periodo_id, tipo in _filtrar(Balance.objects, empresas, periodos).values_list(
+            'empresa_id', 'periodo_id', 'tipo_balance'):
+        tipos_por_par[(empresa_id, periodo_id)].add(tipo)
+
+    # Sumas por atributos de cuenta (equivalen a las filas del snapshot, ya agregadas)
+    filas = defaultdict(lambda: defaultdict(list))
+    agregados = (
+        _filtrar(BalanceDetalle.objects, empresas, periodos, 'balance__')
+        .values_list(
+            'balance__empresa_id', 'balance__periodo_id', 'balance__tipo_balance',
+            'cuenta__grupo__naturaleza', 'cuenta__bg_bloque', 'cuenta__er_bloque', 'cuenta__ratio_tag',
+        )
+        .annotate(total=Sum('saldo'))
+        .order_by()
+    )
+    for empresa_id, periodo_id, tipo, naturaleza, bg, er, tag, total in agregados:
+        filas[(empresa_id, periodo_id)][tipo].append(
+            FilaDetalle(None, total or Decimal('0'), naturaleza, bg, er, tag)
+        )
+
+    # Sumas por línea mapeada (lo que estado_dict obtiene de MapeoCuentaLinea)
+    mapeados = defaultdict(lambda: defaultdict(dict))
+    sumas_lineas = (
+        _filtrar(BalanceDetalle.objects, empresas, periodos, 'balance__')
+        .filter(cuenta__mapeocuentalinea__linea__estado=F('balance__tipo_balance'))
+        .values_list(
+            'balance__empresa_id', 'balance__periodo_id', 'balance__tipo_balance',
+            'cuenta__mapeocuentalinea__linea__clave',
+        )
+        .annotate(total=Sum(F('saldo') * F('cuenta__mapeocuentalinea__signo'), output_field=_SUMA))
+        .order_by()
+    )
+    for empresa_id, periodo_id, tipo, clave, total in sumas_lineas:
+        mapeados[(empresa_id, periodo_id)][tipo][clave] = total or Decimal('0')
+
+    lineas = defaultdict(list)
+    for estado, clave in LineaEstado.objects.values_list('estado', 'clave'):
+        lineas[estado].append(clave)
+
+    return tipos_por_par, filas, mapeados, lineas
+
+
+def valores_estados_batch(empresas, periodos=None):
+    """
+    Valores de línea (los de estado_dict) para muchos estados a la vez.
+
+    Args:
+        empresas: QuerySet o lista de Empresa (o de sus NIT)
+        periodos: QuerySet o lista de Periodo para limitar el cálculo (None = todos)
+
+    Returns:
+        dict: {(empresa_id, periodo_id, tipo): {clave: monto}}
+    """
+    tipos_por_par, filas, mapeados, lineas = _sumas_batch(empresas, periodos)
+    return {
+        (empresa_id, periodo_id, tipo): _valores_estado(
+            tipo, lineas, mapeados[(empresa_id, periodo_id)].get(tipo, {}),
+            filas[(empresa_id, periodo_id)].get(tipo, [])
+        )
+        for (empresa_id, periodo_id), tipos in tipos_por_par.items()
+        for tipo in tipos
+    }
+
+
+def calcular_ratios_batch(empresas, periodos=None, tipo_estado='RES', guardar=True):
+    """
+    Calcula todos los RatioDef para cada (empresa, periodo) con estados cargados.
+
+    Args:
+        empresas: QuerySet o lista de Empresa (o de sus NIT)
+        periodos: QuerySet o lista de Periodo para limitar el cálculo (None = todos)
+        tipo_estado: Estado cuyos valores tienen prioridad, como en calcular_ratios
+        guardar: Si es True guarda los resultados en ResultadoRatio (un solo upsert)
+
+    Returns:
+        ResultadoBatch
+    """
+    ratios = list(ratios_definidos())
+    tipos_por_par, filas, mapeados, lineas = _sumas_batch(empresas, periodos)
+    pares = sorted(tipos_por_par)
+
+    # Matriz pares x claves usadas por las fórmulas
+    compiladas = []
+    claves = set()
+    for r in ratios:
+        try:
+            compilada = compilar_formula(r.formula)
+        except ValueError:
+            compilada = None
+        else:
+            claves |= compilada.claves
+        compiladas.append(compilada)
+    claves = sorted(claves)
+    indice = {clave: j for j, clave in enumerate(claves)}
+
+    n = len(pares)
+    matriz = np.zeros((n, len(claves)), dtype=np.float64)
+    for i, par in enumerate(pares):
+        valores = _valores_par(tipos_por_par[par], filas[par], mapeados[par], lineas, tipo_estado)
+        for clave, monto in valores.items():
+            j = indice.get(clave)
+            if j is not None and monto is not None:
+                matriz[i, j] = float(monto)
+    columnas = {clave: matriz[:, j] for clave, j in indice.items()}
+
+    resultado = np.full((n, len(ratios)), np.nan)
+    for j, (r, compilada) in enumerate(zip(ratios, compiladas)):
+        if compilada is not None and n:
+            resultado[:, j] = compilada.evaluar_vector(columnas, n, porcentaje=r.porcentaje)
+
+    batch = ResultadoBatch(pares, ratios, resultado)
+    if guardar:
+        with transaction.atomic():
+            guardar_resultados_ratios(batch.filas())
+    return batch
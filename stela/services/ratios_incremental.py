@@ -0,0 +1,200 @@
+"""
+Recálculo incremental de ratios a partir de las cuentas modificadas.
+
+Cada cuenta alimenta un conjunto pequeño de claves de línea: su ratio_tag,
+la clave de su bg_bloque/er_bloque, los agregados por naturaleza
+(TOTAL_ACTIVO, UTILIDAD_NETA, ...) y las líneas a las que está mapeada
+(MapeoCuentaLinea). Cada RatioDef depende solo de las claves que aparecen en
+su fórmula compilada. Cruzando ambos conjuntos, al cambiar un BalanceDetalle
+se recalculan y guardan únicamente los ratios afectados.
+
+Las señales de BalanceDetalle llaman a registrar_detalle_modificado; los
+cambios se acumulan por transacción y se procesan en un solo callback
+on_commit (ver al_confirmar), donde también
+se reescriben las mismas líneas en SaldoLinea y se marca la versión de datos
+de la empresa. Las cargas masivas que recalculan todos los ratios al final
+(paso 3 de catalogo_upload_csv, seed_empresas_sector) usan
+sin_recalculo_incremental para no hacer trabajo doble.
+"""
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from django.db import transaction
+from stela.models.catalogo import Cuenta
+from stela.models.finanzas import Balance, MapeoCuentaLinea, Periodo
+from .al_confirmar import marcar_al_confirmar
+from .formulas import compilar_formula, evaluar_ratio
+from .ratios import MAPEO_BLOQUES, guardar_resultados_ratios, valores_linea
+from .registro_ratios import ratios_definidos
+from .saldos_linea import actualizar_saldos_linea
+from .snapshot import PeriodSnapshot
+from .version_datos import marcar_empresa_modificada
+
+# Claves agregadas que dependen de la naturaleza del grupo de la cuenta
+CLAVES_POR_NATURALEZA = {
+    'Activo': ('TOTAL_ACTIVO', 'ACTIVO_CORRIENTE'),
+    'Pasivo': ('PASIVO_CORRIENTE',),
+    'Patrimonio': ('PATRIMONIO_TOTAL',),
+}
+
+_estado = threading.local()
+
+
+def lineas_de_cuenta(naturaleza, bg_bloque, er_bloque, ratio_tag, lineas_mapeadas=()):
+    """
+    Claves de línea cuyo valor puede cambiar si cambia el saldo de la cuenta.
+
+    Es un conjunto conservador: incluye toda clave que la cuenta pueda
+    alimentar por tag, bloque, naturaleza o mapeo.
+
+    Returns:
+        set de claves
+    """
+    lineas = set(lineas_mapeadas)
+    tag = (ratio_tag or '').strip()
+    if tag:
+        lineas.add(tag.lstrip('-'))
+    for bloque in (bg_bloque, er_bloque):
+        bloque = (bloque or '').strip()
+        if bloque:
+            lineas.add(MAPEO_BLOQUES.get(bloque, bloque))
+    lineas.update(CLAVES_POR_NATURALEZA.get(naturaleza, ()))
+    if naturaleza in ('Ingreso', 'Gasto') and (er_bloque or '').strip():
+        lineas.add('UTILIDAD_NETA')
+    return lineas
+
+
+def lineas_de_cuentas(cuenta_ids):
+    """
+    Claves de línea afectadas por un conjunto de cuentas (dos consultas).
+
+    Returns:
+        set de claves
+    """
+    mapeadas = defaultdict(list)
+    for cuenta_id, clave in MapeoCuentaLinea.objects.filter(
+            cuenta_id__in=cuenta_ids).values_list('cuenta_id', 'linea__clave'):
+        mapeadas[cuenta_id].append(clave)
+
+    lineas = set()
+    for cuenta_id, naturaleza, bg, er, tag in Cuenta.objects.filter(pk__in=cuenta_ids).values_list(
+            'id_cuenta', 'grupo__naturaleza', 'bg_bloque', 'er_bloque', 'ratio_tag'):
+        lineas |= lineas_de_cuenta(naturaleza, bg, er, tag, mapeadas[cuenta_id])
+    return lineas
+
+
+def ratios_afectados(lineas, ratios=None):
+    """
+    RatioDef cuya fórmula usa alguna de las claves dadas.
+
+    Las fórmulas inválidas nunca se consideran afectadas (siempre valen None).
+    """
+    if ratios is None:
+        ratios = ratios_definidos()
+    afectados = []
+    for r in ratios:
+        try:
+            claves = compilar_formula(r.formula).claves
+        except ValueError:
+            continue
+        if claves & lineas:
+            afectados.append(r)
+    return afectados
+
+
+def recalcular_ratios_afectados(empresa, periodo, cuenta_ids, tipo_estado='RES', snapshot=None, lineas=None):
+    """
+    Recalcula y guarda solo los ratios que dependen de las cuentas dadas.
+
+    Args:
+        empresa: Instancia de Empresa
+        periodo: Instancia de Periodo
+        cuenta_ids: Iterable de id_cuenta con saldo modificado
+        tipo_estado: 'BAL' o 'RES', como en calcular_ratios
+        snapshot: PeriodSnapshot ya cargado del período (opcional)
+        lineas: Claves afectadas ya calculadas con lineas_de_cuentas (opcional)
+
+    Returns:
+        list: Lista de tuplas (RatioDef, Decimal o None) guardadas
+    """
+    if lineas is None:
+        lineas = lineas_de_cuentas(set(cuenta_ids))
+    afectados = ratios_afectados(lineas)
+    if not afectados:
+        return []
+
+    if snapshot is None:
+        snapshot = PeriodSnapshot.cargar(empresa, periodo)
+    if not snapshot.balances:
+        # El período ya no tiene estados (ej. se eliminó el Balance)
+        return []
+
+    cache = valores_linea(empresa, periodo, tipo_estado, snapshot=snapshot)
+    resultados = [(r, evaluar_ratio(r, cache)) for r in afectados]
+    with transaction.atomic():
+        guardar_resultados_ratios(
+            (empresa.pk, periodo.pk, r.pk, valor) for r, valor in resultados
+        )
+    return resultados
+
+
+def registrar_detalle_modificado(balance_id, cuenta_id):
+    """
+    Marca la cuenta de un BalanceDetalle como modificada.
+
+    Los cambios se agrupan por transacción y se procesan al confirmarla (de
+    inmediato en modo autocommit); los de una transacción revertida se
+    descartan.
+    """
+    if getattr(_estado, 'suspendido', 0):
+        return
+    marcar_al_confirmar(
+        _estado,
+        lambda: defaultdict(set),   # {balance_id: {cuenta_id, ...}}
+        lambda lote: lote[balance_id].add(cuenta_id),
+        procesar_pendientes,
+    )
+
+
+def procesar_pendientes(por_balance):
+    """
+    Recalcula los ratios afectados por los BalanceDetalle marcados.
+
+    Args:
+        por_balance: dict {balance_id: {cuenta_id, ...}}
+    """
+    # Agrupar cuentas por (empresa, periodo); los Balance borrados se ignoran
+    cuentas_por_par = defaultdict(set)
+    for id_balance, empresa_id, periodo_id in Balance.objects.filter(
+            pk__in=por_balance).values_list('id_balance', 'empresa_id', 'periodo_id'):
+        cuentas_por_par[(empresa_id, periodo_id)] |= por_balance[id_balance]
+        # Los saldos cambiaron aunque ningún ratio dependa de las cuentas
+        marcar_empresa_modificada(empresa_id)
+
+    periodos = Periodo.objects.select_related('empresa').in_bulk(
+        [periodo_id for _, periodo_id in cuentas_por_par]
+    )
+    for (_, periodo_id), cuenta_ids in cuentas_por_par.items():
+        periodo = periodos[periodo_id]
+        snapshot = PeriodSnapshot.cargar(periodo.empresa, periodo)
+        lineas = lineas_de_cuentas(cuenta_ids)
+        actualizar_saldos_linea(snapshot, lineas)
+        # Misma prioridad de estados que el recálculo completo (RES), sea cual
+        # sea el estado de la cuenta: el valor guardado no depende del camino
+        recalcular_ratios_afectados(
+            periodo.empresa, periodo, cuenta_ids, snapshot=snapshot, lineas=lineas
+        )
+
+
+@contextmanager
+def sin_recalculo_incremental():
+    """
+    Desactiva el registro de cambios dentro del bloque.
+
+    Para cargas masivas que recalculan todos los ratios al terminar.
+    """
+    _estado.suspendido = getattr(_estado, 'suspendido', 0) + 1
+    try:
+        yield
+    finally:
+        _estado.suspendido -= 1
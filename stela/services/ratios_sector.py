@@ -1,34 +1,92 @@
+"""
+Parámetros de ratios por sector (CIIU) digitados.
+
+Fuentes:
+- seeders/ratios_sector.json
+- la tabla RatioSector (editable desde el admin), que prevalece sobre el archivo
+
+Ambas se cargan una vez por proceso. El archivo se relee solo cuando cambia
+su mtime (editarlo surte efecto sin reiniciar); la tabla se relee al
+invalidarse por señales o al vencer TTL_RATIOS_BD en los demás procesos.
+"""
 import json
+import os
+import time
 from pathlib import Path
 from decimal import Decimal
-from django.conf import settings
+from stela.models.finanzas import RatioSector
+
+RATIOS_SECTOR_FILE = Path(__file__).parent.parent / 'seeders' / 'ratios_sector.json'
+
+# Segundos que un proceso confía en los valores leídos de RatioSector
+TTL_RATIOS_BD = 300
+
+_cache_archivo = None   # (mtime_ns, {ciiu: {clave: Decimal}})
+_cache_bd = None        # (cargado_en, {ciiu: {clave: Decimal}})
+_cache_combinado = None # ((mtime_ns, cargado_en), {ciiu: {clave: Decimal}})
+
+
+def _ratios_archivo():
+    global _cache_archivo
+    try:
+        mtime = os.stat(RATIOS_SECTOR_FILE).st_mtime_ns
+    except OSError:
+        return None, {}
+    if _cache_archivo is None or _cache_archivo[0] != mtime:
+        try:
+            with open(RATIOS_SECTOR_FILE, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            # Convertir valores a Decimal para consistencia
+            result = {
+                ciiu_code: {
+                    ratio_clave: Decimal(str(valor))
+                    for ratio_clave, valor in ratios.items()
+                }
+                for ciiu_code, ratios in data.items()
+            }
+        except (json.JSONDecodeError, ValueError, IOError, AttributeError):
+            # Archivo inválido: vacío hasta que vuelva a cambiar
+            result = {}
+        _cache_archivo = (mtime, result)
+    return _cache_archivo
+
+
+def _ratios_bd():
+    global _cache_bd
+    if _cache_bd is None or time.monotonic() - _cache_bd[0] > TTL_RATIOS_BD:
+        result = {}
+        for ciiu_code, ratio_clave, valor in RatioSector.objects.values_list('ciiu_id', 'ratio__clave', 'valor'):
+            result.setdefault(ciiu_code, {})[ratio_clave] = valor
+        _cache_bd = (time.monotonic(), result)
+    return _cache_bd
+
 
 def cargar_ratios_sector():
     """
-    Carga ratios por sector desde archivo JSON estático.
+    Carga ratios por sector: archivo JSON más la tabla RatioSector (que
+    prevalece), desde la cache del proceso. El dict devuelto es compartido:
+    no modificarlo.
     
     Returns:
         dict: {CIIU_CODE: {RATIO_CLAVE: valor, ...}, ...}
         Ejemplo: {"0111": {"LIQUIDEZ_CORRIENTE": 1.5, "ENDEUDAMIENTO": 0.6}}
     """
-    ratios_file = Path(__file__).parent.parent / 'seeders' / 'ratios_sector.json'
-    
-    if not ratios_file.exists():
-        return {}
-    
-    try:
-        with open(ratios_file, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-            # Convertir valores a Decimal para consistencia
-            result = {}
-            for ciiu_code, ratios in data.items():
-                result[ciiu_code] = {
-                    ratio_clave: Decimal(str(valor))
-                    for ratio_clave, valor in ratios.items()
-                }
-            return result
-    except (json.JSONDecodeError, ValueError, IOError) as e:
-        return {}
+    global _cache_combinado
+    mtime, archivo = _ratios_archivo()
+    cargado_en, bd = _ratios_bd()
+    version = (mtime, cargado_en)
+    if _cache_combinado is None or _cache_combinado[0] != version:
+        result = {ciiu_code: dict(ratios) for ciiu_code, ratios in archivo.items()}
+        for ciiu_code, ratios in bd.items():
+            result.setdefault(ciiu_code, {}).update(ratios)
+        _cache_combinado = (version, result)
+    return _cache_combinado[1]
+
+
+def invalidar_ratios_sector():
+    """Descarta los valores de RatioSector; la próxima lectura vuelve a la BD."""
+    global _cache_bd
+    _cache_bd = None
 
 def obtener_ratio_sector(ciiu_codigo, ratio_clave):
     """
@@ -86,12 +144,15 @@ def obtener_comparacion_sector(empresa, ratios_empresa):
     Returns:
         list: Lista de diccionarios con información de comparación
     """
-    if not empresa.ciiu:
+    if not empresa.ciiu_id:
         return []
     
-    ciiu_codigo = empresa.ciiu.codigo
+    # Un dict por sector desde la cache: luego una búsqueda por ratio.
+    # Si el CIIU no tiene parámetros se usan los del ancestro más cercano que sí.
     ratios_sector = cargar_ratios_sector()
-    sector_ratios = ratios_sector.get(ciiu_codigo, {})
+    sector_ratios = next(
+        (ratios_sector[c] for c in empresa.ciiu.codigos_ancestros() if c in ratios_sector), {}
+    )
     
     resultado = []
     for r in ratios_empresa:
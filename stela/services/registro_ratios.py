@@ -0,0 +1,69 @@
+"""
+Registro de proceso de las definiciones de ratios (RatioDef).
+
+Los RatioDef casi nunca cambian, pero se leían en cada cálculo. Aquí se
+cargan una vez por proceso y luego se sirven desde memoria: una consulta
+repetida al registro solo lee la versión en la cache de Django, no la BD.
+
+La siembra de los ratios base la hace la migración 0003_seed_ratios_base (o
+el comando seed_finanzas), no el cálculo. Las señales post_save/post_delete
+de RatioDef suben la versión compartida (CLAVE_VERSION, como en
+indice_mapeo); cada proceso compara la versión de su registro con ella en
+cada lectura y recarga si cambió, así que ningún proceso sigue usando un
+RatioDef editado o eliminado en otro.
+"""
+import time
+from django.core.cache import cache
+from stela.models.finanzas import RatioDef
+
+CLAVE_VERSION = 'stela:registro_ratios:version'
+
+_registro = None    # (versión, tuple de RatioDef, {clave: RatioDef})
+
+
+def _version():
+    version = cache.get(CLAVE_VERSION)
+    if version is None:
+        # Un valor nuevo (no 1) para no confundirse con una versión anterior
+        # si la clave fue desalojada
+        cache.add(CLAVE_VERSION, time.time_ns(), None)
+        version = cache.get(CLAVE_VERSION)
+    return version
+
+
+def _cargar():
+    global _registro
+    version = _version()
+    if _registro is None or _registro[0] != version:
+        ratios = tuple(RatioDef.objects.all())
+        _registro = (version, ratios, {r.clave: r for r in ratios})
+    return _registro
+
+
+def ratios_definidos():
+    """Todos los RatioDef, en el mismo orden que RatioDef.objects.all()."""
+    return _cargar()[1]
+
+
+def ratio_por_clave(clave):
+    """RatioDef con la clave dada, o None si no existe."""
+    return _cargar()[2].get(clave)
+
+
+def huella_registro():
+    """
+    Parte del ETag de las APIs que dependen de los RatioDef: la versión
+    compartida, igual en todos los procesos y sin consultar la BD.
+    """
+    return str(_version())
+
+
+def invalidar_registro():
+    """Sube la versión compartida: la próxima lectura de cada proceso vuelve a la BD."""
+    global _registro
+    _registro = None
+    try:
+        cache.incr(CLAVE_VERSION)
+    except ValueError:
+        # La clave de versión no existe (o fue desalojada): empezar una nueva
+        cache.add(CLAVE_VERSION, time.time_ns(), None)
@@ -0,0 +1,167 @@
+"""
+Saldos por línea de estado materializados en SaldoLinea.
+
+analisis_vertical, analisis_horizontal y las gráficas recalculaban cada línea
+desde BalanceDetalle en cada request. SaldoLinea guarda el monto de cada
+(Balance, LineaEstado) y se mantiene así:
+
+- tras recalcular_saldos_balances (cargas de estados) quien lo llama usa
+  saldos_recalculados, que reconstruye los Balance;
+- al cambiar un BalanceDetalle (señales) se reescriben solo las líneas afectadas;
+- al cambiar mapeos o atributos de cuentas se descartan las filas afectadas y
+  se reconstruyen en la siguiente lectura;
+- el comando rebuild_saldos_linea reconstruye en bloque.
+"""
+from django.db import connections, transaction
+from django.db.models import Count, F
+from stela.models.finanzas import Balance, SaldoLinea
+from .estados import estado_dict
+from .indice_mapeo import ids_lineas, lineas_por_estado
+from .ratios_batch import valores_estados_batch
+from .snapshot import PeriodSnapshot
+from .version_datos import incrementar_version_datos
+
+
+def _guardar_saldos(objs):
+    """Upsert de SaldoLinea sobre la restricción única (balance, linea)."""
+    if not objs:
+        return 0
+    opciones = {'update_conflicts': True, 'update_fields': ['monto']}
+    # MySQL no admite indicar las columnas del conflicto (usa cualquier UNIQUE)
+    if connections[SaldoLinea.objects.db].features.supports_update_conflicts_with_target:
+        opciones['unique_fields'] = ['balance', 'linea']
+    SaldoLinea.objects.bulk_create(objs, **opciones)
+    return len(objs)
+
+
+def _objetos(balance_id, montos, claves=None):
+    ids = ids_lineas()
+    return [
+        SaldoLinea(balance_id=balance_id, linea_id=ids[clave], monto=monto)
+        for clave, monto in montos.items()
+        if clave in ids and (claves is None or clave in claves)
+    ]
+
+
+@transaction.atomic
+def reconstruir_saldos_linea(balances):
+    """
+    Recalcula todas las líneas de los Balance dados con consultas agregadas
+    (ver valores_estados_batch), sin importar cuántos sean.
+
+    Args:
+        balances: QuerySet de Balance
+
+    Returns:
+        int: Cantidad de filas escritas
+    """
+    por_par = {}
+    for id_balance, empresa_id, periodo_id, tipo in balances.values_list(
+            'id_balance', 'empresa_id', 'periodo_id', 'tipo_balance'):
+        por_par[(empresa_id, periodo_id, tipo)] = id_balance
+    if not por_par:
+        return 0
+    valores = valores_estados_batch(
+        {e for e, _, _ in por_par}, {p for _, p, _ in por_par}
+    )
+    objs = []
+    for clave_par, id_balance in por_par.items():
+        objs += _objetos(id_balance, valores.get(clave_par, {}))
+    return _guardar_saldos(objs)
+
+
+def saldos_recalculados(balances):
+    """
+    Invalida lo que deriva de los saldos después de recalcular_saldos_balances,
+    cuyo UPDATE masivo no dispara señales: sube la revisión de los Balance
+    (cache de análisis) y la versión de datos de sus empresas (ETag de las
+    APIs), y vuelve a materializar sus líneas.
+
+    Args:
+        balances: lista de Balance / id_balance
+
+    Returns:
+        int: Cantidad de filas de SaldoLinea escritas
+    """
+    ids = [getattr(b, 'pk', b) for b in balances]
+    if not ids:
+        return 0
+    Balance.objects.filter(pk__in=ids).update(revision=F('revision') + 1)
+    incrementar_version_datos(balance__pk__in=ids)
+    return reconstruir_saldos_linea(Balance.objects.filter(pk__in=ids))
+
+
+def actualizar_saldos_linea(snapshot, claves):
+    """
+    Reescribe solo las líneas dadas de los estados del snapshot.
+
+    Args:
+        snapshot: PeriodSnapshot ya cargado (con empresa y periodo)
+        claves: set de claves de línea afectadas
+
+    Returns:
+        int: Cantidad de filas escritas
+    """
+    objs = []
+    for tipo, id_balance in snapshot.balances.items():
+        data = estado_dict(snapshot.empresa, snapshot.periodo, tipo, snapshot=snapshot)
+        objs += _objetos(id_balance, {k: v['monto'] for k, v in data.items()}, claves)
+    with transaction.atomic():
+        return _guardar_saldos(objs)
+
+
+def descartar_saldos_linea(**filtros):
+    """
+    Borra filas de SaldoLinea (ej. balance__detalles__cuenta_id=...) para que
+    se reconstruyan en la siguiente lectura.
+    """
+    SaldoLinea.objects.filter(**filtros).delete()
+
+
+def estado_materializado(empresa, periodo, tipo_estado, snapshot=None):
+    """
+    Igual que estado_dict pero leyendo SaldoLinea (una consulta).
+
+    Si el Balance aún no está materializado (o hay líneas nuevas) calcula con
+    estado_dict y guarda el resultado.
+
+    Returns:
+        dict: {clave_linea: {'nombre': str, 'monto': Decimal, 'base': bool}}
+
+    Raises:
+        Balance.DoesNotExist: Si el período no tiene estado del tipo indicado
+    """
+    lineas = lineas_por_estado(tipo_estado)
+    montos = dict(
+        SaldoLinea.objects.filter(
+            balance__empresa=empresa, balance__periodo=periodo, balance__tipo_balance=tipo_estado
+        ).values_list('linea__clave', 'monto')
+    )
+    if lineas and len(montos) == len(lineas) and all(clave in montos for clave, _, _ in lineas):
+        return {
+            clave: {'nombre': nombre, 'monto': montos[clave], 'base': base}
+            for clave, nombre, base in lineas
+        }
+
+    if snapshot is None:
+        snapshot = PeriodSnapshot.cargar(empresa, periodo)
+    data = estado_dict(empresa, periodo, tipo_estado, snapshot=snapshot)
+    with transaction.atomic():
+        _guardar_saldos(_objetos(snapshot.balances[tipo_estado], {k: v['monto'] for k, v in data.items()}))
+    return data
+
+
+def asegurar_saldos_linea(empresa):
+    """
+    Materializa los Balance de la empresa a los que les falten líneas.
+
+    Cuesta una consulta cuando todo está al día.
+    """
+    incompletos = [
+        id_balance
+        for id_balance, tipo, n in Balance.objects.filter(empresa=empresa)
+        .annotate(n=Count('saldos_linea')).values_list('id_balance', 'tipo_balance', 'n')
+        if n < len(lineas_por_estado(tipo))
+    ]
+    if incompletos:
+        reconstruir_saldos_linea(Balance.objects.filter(pk__in=incompletos))
@@ -0,0 +1,149 @@
+"""
+Snapshot de un período: todos los BalanceDetalle de (empresa, periodo)
+cargados una sola vez como tuplas compactas.
+
+estado_dict, calcular_totales_por_seccion, calcular_valores_desde_ratio_tag
+y analisis_vertical aceptan un PeriodSnapshot opcional. Así un recálculo
+completo de ratios (BAL + RES) cuesta un número fijo de consultas sin
+importar cuántas cuentas tenga el catálogo.
+"""
+from collections import namedtuple
+from decimal import Decimal
+from django.db.models import Sum
+from stela.models.finanzas import Balance, BalanceDetalle
+
+# Una fila por BalanceDetalle con lo necesario para armar estados y ratios
+FilaDetalle = namedtuple(
+    'FilaDetalle',
+    ['cuenta_id', 'saldo', 'naturaleza', 'bg_bloque', 'er_bloque', 'ratio_tag']
+)
+
+_CAMPOS_FILA = (
+    'cuenta_id',
+    'saldo',
+    'cuenta__grupo__naturaleza',
+    'cuenta__bg_bloque',
+    'cuenta__er_bloque',
+    'cuenta__ratio_tag',
+)
+
+
+def _fila(valores):
+    cuenta_id, saldo, naturaleza, bg_bloque, er_bloque, ratio_tag = valores
+    return FilaDetalle(
+        cuenta_id,
+        saldo if saldo is not None else Decimal('0'),
+        naturaleza,
+        bg_bloque,
+        er_bloque,
+        ratio_tag,
+    )
+
+
+def filas_agregadas(balances, por_tipo=False):
+    """
+    Suma los saldos en la BD agrupando por (naturaleza, bg_bloque, er_bloque,
+    ratio_tag) de la cuenta: una consulta y una fila por combinación, no por cuenta.
+
+    Como todos los cálculos por tag/bloque/naturaleza son sumas, estas filas
+    (con cuenta_id=None) dan exactamente los mismos totales que las filas
+    por cuenta, incluida la convención de signo de los tags '-TAG'.
+
+    Args:
+        balances: QuerySet de Balance a incluir
+        por_tipo: True para agrupar también por tipo_balance (misma consulta)
+
+    Returns:
+        list de FilaDetalle (o dict {tipo_balance: [FilaDetalle, ...]} con
+        por_tipo), o None si el QuerySet no tiene ningún Balance
+    """
+    agregados = list(
+        balances.values_list(
+            *(('tipo_balance',) if por_tipo else ()),
+            'detalles__cuenta__grupo__naturaleza',
+            'detalles__cuenta__bg_bloque',
+            'detalles__cuenta__er_bloque',
+            'detalles__cuenta__ratio_tag',
+        )
+        .annotate(total=Sum('detalles__saldo'))
+        .order_by()
+    )
+    if not agregados:
+        return None
+    filas = {}
+    for *tipo, nat, bg, er, tag, total in agregados:
+        # Un Balance sin detalles aparece como una fila de NULLs que suma 0
+        filas.setdefault(tipo[0] if por_tipo else None, []).append(
+            FilaDetalle(None, total if total is not None else Decimal('0'), nat, bg, er, tag)
+        )
+    return filas if por_tipo else filas[None]
+
+
+class PeriodSnapshot:
+    """
+    Detalle de los estados BAL y RES de una empresa en un período.
+
+    Se construye con PeriodSnapshot.cargar(empresa, periodo), que hace dos
+    consultas: una para saber qué Balance existen y otra para traer todos
+    sus detalles.
+
+    Con agregado=True las filas ya vienen sumadas por (naturaleza, bloques,
+    tag), con cuenta_id=None: valen para todo cálculo por tag/bloque/naturaleza
+    pero no para mapeos por cuenta.
+    """
+
+    def __init__(self, empresa, periodo, balances, filas, agregado=False):
+        self.empresa = empresa
+        self.periodo = periodo
+        self.balances = balances    # {'BAL': id_balance, 'RES': id_balance}
+        self._filas = filas         # {'BAL': [FilaDetalle, ...], 'RES': [...]}
+        self._saldos = {}
+        self._agregado = self if agregado else None
+
+    @classmethod
+    def cargar(cls, empresa, periodo):
+        balances = dict(
+            Balance.objects.filter(empresa=empresa, periodo=periodo)
+            .values_list('tipo_balance', 'id_balance')
+        )
+        filas = {tipo: [] for tipo in balances}
+        if balances:
+            detalles = (
+                BalanceDetalle.objects
+                .filter(balance_id__in=balances.values())
+                .values_list('balance__tipo_balance', *_CAMPOS_FILA)
+            )
+            for tipo, *valores in detalles:
+                filas[tipo].append(_fila(valores))
+        return cls(empresa, periodo, balances, filas)
+
+    def tiene(self, tipo_estado):
+        """True si existe el Balance del tipo dado en el período."""
+        return tipo_estado in self.balances
+
+    def detalles(self, tipo_estado):
+        """Lista de FilaDetalle del estado (vacía si no existe)."""
+        return self._filas.get(tipo_estado, [])
+
+    def saldos_por_cuenta(self, tipo_estado):
+        """dict {cuenta_id: saldo} del estado, calculado una vez."""
+        if tipo_estado not in self._saldos:
+            self._saldos[tipo_estado] = {
+                f.cuenta_id: f.saldo for f in self.detalles(tipo_estado)
+            }
+        return self._saldos[tipo_estado]
+
+    def agregado(self):
+        """
+        Snapshot con las filas de ambos estados sumadas en la BD (ver
+        filas_agregadas): una consulta la primera vez, una fila por
+        combinación de naturaleza/bloques/tag en lugar de una por cuenta.
+        """
+        if self._agregado is None:
+            filas = {tipo: [] for tipo in self.balances}
+            if self.balances:
+                filas.update(filas_agregadas(
+                    Balance.objects.filter(pk__in=self.balances.values()), por_tipo=True
+                ))
+            self._agregado = PeriodSnapshot(self.empresa, self.periodo, self.balances, filas, agregado=True)
+        return self._agregado
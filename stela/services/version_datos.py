@@ -0,0 +1,106 @@
+"""
+Versión de datos por empresa para respuestas condicionales (ETag / Last-Modified).
+
+Las APIs JSON que el dashboard consulta seguido (get_cuentas_api,
+get_periodos_api, get_chart_data_api, ratios_series_json) reconstruían y
+serializaban todo en cada llamada. Empresa.version_datos es un contador que
+sube con cada carga o recálculo de los datos de la empresa; con él se arma el
+ETag en una consulta y, si el cliente ya tiene esa versión, la vista responde
+304 sin ejecutar sus consultas.
+
+El contador sube así:
+
+- períodos, estados y cuentas creados o eliminados, y ratios guardados
+  (señales): se marca la empresa y al confirmar la transacción se hace un
+  solo UPDATE por empresa, aunque una carga guarde cientos de filas;
+- saldos_recalculados (cargas de estados) y los cambios de detalle que
+  procesa el recálculo incremental;
+- cambios de LineaEstado (todas las empresas: cambian nombres y montos).
+"""
+import threading
+from django.db.models import F
+from django.utils import timezone
+from django.views.decorators.http import condition
+from stela.models.empresa import Empresa
+from .al_confirmar import marcar_al_confirmar
+
+_estado = threading.local()
+
+
+def incrementar_version_datos(**filtros):
+    """
+    Incrementa la versión de datos de las empresas que cumplen los filtros
+    (todas si no se pasa ninguno), ej. pk__in=[...] o balance__pk__in=[...]
+
+    Returns:
+        int: Cantidad de empresas actualizadas
+    """
+    return Empresa.objects.filter(**filtros).update(
+        version_datos=F('version_datos') + 1, datos_actualizados=timezone.now()
+    )
+
+
+def marcar_empresa_modificada(empresa_id):
+    """
+    Marca la empresa para incrementar su versión al confirmar la transacción
+    en curso (de inmediato en modo autocommit); las marcas de una transacción
+    revertida se descartan.
+    """
+    if empresa_id is None:
+        return
+    marcar_al_confirmar(_estado, set, lambda lote: lote.add(empresa_id), procesar_versiones_pendientes)
+
+
+def procesar_versiones_pendientes(empresas):
+    """Incrementa con un UPDATE la versión de las empresas marcadas."""
+    incrementar_version_datos(pk__in=empresas)
+
+
+def version_empresa(request, nit):
+    """
+    (version_datos, datos_actualizados) de una empresa del usuario, o None si
+    no existe o no tiene acceso. Una consulta por request aunque se pida dos
+    veces (ETag y Last-Modified).
+    """
+    if not nit or not request.user.is_authenticated:
+        return None
+    versiones = request.__dict__.setdefault('_versiones_datos', {})
+    if nit not in versiones:
+        versiones[nit] = Empresa.objects.filter(usuario=request.user, nit=nit).values_list(
+            'version_datos', 'datos_actualizados'
+        ).first()
+    return versiones[nit]
+
+
+def etag_empresa(vista, request, nit, *extra):
+    """ETag de la vista para los datos actuales de la empresa (None = sin ETag)."""
+    version = version_empresa(request, nit)
+    if version is None:
+        return None
+    return '-'.join(str(parte) for parte in (vista, nit, version[0], *extra))
+
+
+def modificado_empresa(request, nit):
+    """Last-Modified de los datos de la empresa (None si nunca cambiaron)."""
+    version = version_empresa(request, nit)
+    return version[1] if version else None
+
+
+def condicional_por_empresa(vista, nit_de, extra=None):
+    """
+    Decorador condition() de Django para una API JSON con datos de una empresa:
+    responde 304 si el cliente ya tiene la versión actual, sin ejecutar la vista.
+
+    Args:
+        vista: Prefijo del ETag (nombre corto de la vista)
+        nit_de: función(request) -> NIT de la empresa consultada
+        extra: función() -> parte adicional del ETag para datos globales (opcional)
+    """
+    def etag(request, *args, **kwargs):
+        partes = (extra(),) if extra else ()
+        return etag_empresa(vista, request, nit_de(request), *partes)
+
+    def ultima_modificacion(request, *args, **kwargs):
+        return modificado_empresa(request, nit_de(request))
+
+    return condition(etag_func=etag, last_modified_func=ultima_modificacion)
@@ -0,0 +1,154 @@
+from django.db.models.signals import post_save, post_delete, pre_save
+from django.core.exceptions import ObjectDoesNotExist
+from django.dispatch import receiver
+from stela.models.catalogo import Cuenta, GrupoCuenta
+from stela.models.ciiu import Ciiu
+from stela.models.finanzas import Balance, BalanceDetalle, LineaEstado, MapeoCuentaLinea, Periodo, RatioDef, RatioSector
+from stela.services.cache_analisis import incrementar_revision
+from stela.services.ciiu_jerarquia import asignar_ruta, mover_subarbol
+from stela.services.estadistica_sector import registrar_ratios_guardados
+from stela.services.formulas import invalidar_formula
+from stela.services.indice_mapeo import invalidar_indice_mapeo, senales_mapeo_suspendidas
+from stela.services.ratios import ratios_guardados
+from stela.services.ratios_sector import invalidar_ratios_sector
+from stela.services.registro_ratios import invalidar_registro
+from stela.services.ratios_incremental import registrar_detalle_modificado
+from stela.services.saldos_linea import descartar_saldos_linea
+from stela.services.version_datos import incrementar_version_datos, marcar_empresa_modificada
+
+
+@receiver([post_save, post_delete], sender=RatioDef)
+def ratiodef_cambiado(sender, instance, **kwargs):
+    """Descarta fórmulas compiladas, registro y parámetros de sector cuando se crea, edita o elimina un RatioDef."""
+    invalidar_formula()
+    invalidar_registro()
+    invalidar_ratios_sector()
+
+
+@receiver([post_save, post_delete], sender=RatioSector)
+def ratio_sector_cambiado(sender, **kwargs):
+    """Los parámetros digitados por sector se releen en la próxima comparación."""
+    invalidar_ratios_sector()
+
+
+@receiver(post_save, sender=BalanceDetalle)
+def detalle_guardado(sender, instance, created=False, update_fields=None, raw=False, **kwargs):
+    """
+    Marca la cuenta para recalcular solo los ratios que dependen de ella.
+
+    Se ignoran los guardados que no pueden cambiar el saldo: filas nuevas en 0
+    y actualizaciones limitadas a otros campos (ej. debe/haber antes de
+    recalcular_saldos_detalle).
+    """
+    if raw or (update_fields is not None and 'saldo' not in update_fields):
+        return
+    if created and not instance.saldo:
+        return
+    incrementar_revision(pk=instance.balance_id)
+    registrar_detalle_modificado(instance.balance_id, instance.cuenta_id)
+
+
+@receiver(post_delete, sender=BalanceDetalle)
+def detalle_eliminado(sender, instance, **kwargs):
+    incrementar_revision(pk=instance.balance_id)
+    registrar_detalle_modificado(instance.balance_id, instance.cuenta_id)
+
+
+@receiver([post_save, post_delete], sender=LineaEstado)
+def linea_indice_cambiada(sender, **kwargs):
+    """Las líneas son globales: se descarta el índice de todas las empresas."""
+    invalidar_indice_mapeo()
+
+
+@receiver([post_save, post_delete], sender=MapeoCuentaLinea)
+def mapeo_cambiado(sender, instance, **kwargs):
+    """
+    Descarta los mapeos en cache de la empresa dueña de la cuenta ante cambios
+    fuera de los servicios de mapeo (ej. admin); esos invalidan una vez al terminar.
+    """
+    if senales_mapeo_suspendidas():
+        return
+    empresa_id = Cuenta.objects.filter(pk=instance.cuenta_id).values_list(
+        'grupo__catalogo__empresa_id', flat=True).first()
+    # Sin cuenta (borrado en cascada ya aplicado) no se sabe la empresa: índice completo
+    invalidar_indice_mapeo(empresa_id=empresa_id)
+
+
+@receiver([post_save, post_delete], sender=LineaEstado)
+def linea_cambiada(sender, raw=False, **kwargs):
+    """Nombre o base de una línea cambian el resultado de todos los análisis."""
+    if not raw:
+        incrementar_revision()
+        incrementar_version_datos()
+
+
+@receiver([post_save, post_delete], sender=MapeoCuentaLinea)
+def mapeo_saldos_linea(sender, instance, **kwargs):
+    """
+    La línea del mapeo cambia en los balances que usan la cuenta: se
+    rematerializa al leerla. Los servicios de mapeo lo hacen una vez por catálogo.
+    """
+    if senales_mapeo_suspendidas():
+        return
+    descartar_saldos_linea(linea_id=instance.linea_id, balance__detalles__cuenta_id=instance.cuenta_id)
+    incrementar_revision(detalles__cuenta_id=instance.cuenta_id)
+    incrementar_version_datos(catalogo__grupos__cuentas=instance.cuenta_id)
+
+
+@receiver(post_save, sender=Cuenta)
+def cuenta_guardada(sender, instance, created=False, raw=False, **kwargs):
+    """bloques, ratio_tag o grupo pueden mover el saldo de la cuenta entre líneas."""
+    if not created and not raw:
+        descartar_saldos_linea(balance__detalles__cuenta_id=instance.pk)
+        incrementar_revision(detalles__cuenta_id=instance.pk)
+
+
+@receiver(post_save, sender=GrupoCuenta)
+def grupo_guardado(sender, instance, created=False, raw=False, **kwargs):
+    """La naturaleza del grupo decide los totales sin mapeo y la utilidad."""
+    if not created and not raw:
+        descartar_saldos_linea(balance__detalles__cuenta__grupo=instance)
+        incrementar_revision(detalles__cuenta__grupo=instance)
+        marcar_empresa_modificada(instance.catalogo.empresa_id)
+
+
+@receiver(ratios_guardados)
+def ratios_recalculados(sender, pares, **kwargs):
+    """Refresca (al confirmar) las estadísticas de sector y la versión de datos de las empresas recalculadas."""
+    registrar_ratios_guardados(pares)
+    for empresa_id in {e for e, _ in pares}:
+        marcar_empresa_modificada(empresa_id)
+
+
+@receiver([post_save, post_delete], sender=Periodo)
+@receiver([post_save, post_delete], sender=Balance)
+def periodo_o_balance_cambiado(sender, instance, created=False, raw=False, **kwargs):
+    """Períodos y estados nuevos o eliminados cambian las APIs de la empresa (no las revisiones)."""
+    if raw or (kwargs['signal'] is post_save and not created):
+        return
+    marcar_empresa_modificada(instance.empresa_id)
+
+
+@receiver([post_save, post_delete], sender=Cuenta)
+def cuenta_en_catalogo(sender, instance, raw=False, **kwargs):
+    """Código o nombre de una cuenta cambian la lista de cuentas de la empresa."""
+    if not raw:
+        try:
+            marcar_empresa_modificada(instance.grupo.catalogo.empresa_id)
+        except ObjectDoesNotExist:
+            # Borrado en cascada del grupo o del catálogo
+            pass
+
+
+@receiver(pre_save, sender=Ciiu)
+def ciiu_por_guardar(sender, instance, raw=False, **kwargs):
+    """Calcula la ruta materializada del CIIU a partir de la de su padre."""
+    if not raw:
+        instance._ruta_anterior = asignar_ruta(instance)
+
+
+@receiver(post_save, sender=Ciiu)
+def ciiu_guardado(sender, instance, created=False, raw=False, **kwargs):
+    """Si el CIIU cambió de padre, su subárbol hereda la nueva ruta."""
+    if not created and not raw:
+        mover_subarbol(getattr(instance, '_ruta_anterior', ''), instance.ruta)
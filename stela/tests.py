@@ -300,3 +300,1049 @@ class SeedCiiuCommandTests(TestCase):
         if ciiu_hijo:
             self.assertIsNotNone(ciiu_hijo.padre, "El código 55 debería tener padre")
             self.assertEqual(ciiu_hijo.padre.codigo, 'I', "El padre de 55 debería ser I")
+
+
+class FormulaCompiladaTests(TestCase):
+    """Tests para el motor de fórmulas compiladas de RatioDef"""
+
+    def test_evaluar_division(self):
+        """Test que evalúa una división simple"""
+        from decimal import Decimal
+        from stela.services.formulas import compilar_formula
+        f = compilar_formula('(ACTIVO_CORRIENTE)/(PASIVO_CORRIENTE)')
+        self.assertEqual(f.claves, frozenset({'ACTIVO_CORRIENTE', 'PASIVO_CORRIENTE'}))
+        valor = f.evaluar({'ACTIVO_CORRIENTE': Decimal('300'), 'PASIVO_CORRIENTE': Decimal('200')})
+        self.assertEqual(valor, Decimal('1.5'))
+
+    def test_division_por_cero_devuelve_none(self):
+        """Test que la división entre cero (o clave faltante) devuelve None"""
+        from decimal import Decimal
+        from stela.services.formulas import compilar_formula
+        f = compilar_formula('(UTILIDAD_NETA)/(VENTAS_NETAS)')
+        self.assertIsNone(f.evaluar({'UTILIDAD_NETA': Decimal('10')}))
+        self.assertIsNone(f.evaluar({'UTILIDAD_NETA': Decimal('10'), 'VENTAS_NETAS': Decimal('0')}))
+
+    def test_porcentaje_y_cache(self):
+        """Test que aplica porcentaje y reutiliza la fórmula compilada"""
+        from decimal import Decimal
+        from stela.services.formulas import compilar_formula
+        f = compilar_formula('(PASIVO_CORRIENTE)/(TOTAL_ACTIVO)')
+        self.assertIs(f, compilar_formula('(PASIVO_CORRIENTE)/(TOTAL_ACTIVO)'))
+        valor = f.evaluar({'PASIVO_CORRIENTE': Decimal('25'), 'TOTAL_ACTIVO': Decimal('100')}, porcentaje=True)
+        self.assertEqual(valor, Decimal('25'))
+
+    def test_formula_invalida(self):
+        """Test que rechaza operaciones no permitidas"""
+        from stela.services.formulas import compilar_formula
+        with self.assertRaises(ValueError):
+            compilar_formula('__import__("os")')
+
+    def test_invalidacion_al_guardar_ratiodef(self):
+        """Test que editar un RatioDef descarta la cache de fórmulas"""
+        from stela.models.finanzas import RatioDef
+        from stela.services import formulas
+        formulas.compilar_formula('(A)/(B)')
+        RatioDef.objects.create(clave='X', nombre='X', formula='(A)/(B)')
+        self.assertNotIn('(A)/(B)', formulas._cache_formulas)
+
+    def test_registro_ratios(self):
+        """Test que el registro sirve los RatioDef sembrados sin consultas y se refresca por señal"""
+        from stela.models.finanzas import RatioDef
+        from stela.services.registro_ratios import invalidar_registro, ratio_por_clave, ratios_definidos
+        invalidar_registro()
+        # El registro guarda filas que el rollback del test elimina
+        self.addCleanup(invalidar_registro)
+        with self.assertNumQueries(1):
+            self.assertEqual(len(ratios_definidos()), 10)
+        with self.assertNumQueries(0):
+            self.assertEqual(ratio_por_clave('ROE').formula, '(UTILIDAD_NETA)/(PATRIMONIO_TOTAL)')
+            self.assertIsNone(ratio_por_clave('NO_EXISTE'))
+        RatioDef.objects.create(clave='X', nombre='X', formula='(A)/(B)')
+        self.assertEqual(ratio_por_clave('X').nombre, 'X')
+
+        # Un cambio hecho en otro proceso sube la versión compartida: este recarga
+        from django.core.cache import cache
+        from stela.services.registro_ratios import CLAVE_VERSION
+        RatioDef.objects.filter(clave='X').update(nombre='Y')
+        self.assertEqual(ratio_por_clave('X').nombre, 'X')
+        cache.incr(CLAVE_VERSION)
+        self.assertEqual(ratio_por_clave('X').nombre, 'Y')
+
+
+class CalculoRatiosTests(TestCase):
+    """Tests para el cálculo de estados y ratios desde BalanceDetalle"""
+
+    def setUp(self):
+        from decimal import Decimal
+        from stela.models.catalogo import Catalogo, GrupoCuenta, Cuenta
+        from stela.models.finanzas import Periodo, Balance, BalanceDetalle, LineaEstado
+        from stela.services.estados import recalcular_saldos_detalle
+        from stela.services.mapeo_automatico import mapear_cuentas_por_bloques
+
+        # Los datos base se confirman como en un request: se procesan sus marcas on_commit
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user = User.objects.create_user(username='ratios', password='testpass123')
+            ciiu = Ciiu.objects.create(codigo='A', descripcion='Actividad A', nivel=1)
+            self.empresa = Empresa.objects.create(
+                nit='0614-010101-101-1', ciiu=ciiu, nrc='1111111',
+                razon_social='Empresa Ratios', direccion='Dirección', telefono='2222-2222',
+                email='ratios@test.com'
+            )
+            self.empresa.usuario.add(self.user)
+            catalogo = Catalogo.objects.create(empresa=self.empresa)
+            grupos = {
+                nat: GrupoCuenta.objects.create(catalogo=catalogo, nombre=nat, naturaleza=nat)
+                for nat in ('Activo', 'Pasivo', 'Patrimonio', 'Ingreso', 'Gasto')
+            }
+            # (codigo, naturaleza, bg_bloque, er_bloque, ratio_tag, tipo, debe, haber)
+            cuentas = [
+                ('1101', 'Activo', 'ACTIVO_CORRIENTE', '', 'EFECTIVO', 'BAL', '300', '0'),
+                ('1102', 'Activo', 'ACTIVO_CORRIENTE', '', 'CUENTAS_POR_COBRAR', 'BAL', '120', '0'),
+                ('1103', 'Activo', 'ACTIVO_CORRIENTE', '', '-CUENTAS_POR_COBRAR', 'BAL', '20', '0'),
+                ('1201', 'Activo', 'ACTIVO_NO_CORRIENTE', '', '', 'BAL', '700', '0'),
+                ('2101', 'Pasivo', 'PASIVO_CORRIENTE', '', '', 'BAL', '0', '250'),
+                ('2201', 'Pasivo', 'PASIVO_NO_CORRIENTE', '', '', 'BAL', '0', '90'),
+                ('3101', 'Patrimonio', 'PATRIMONIO', '', '', 'BAL', '0', '760'),
+                ('4101', 'Ingreso', '', 'VENTAS_NETAS', 'VENTAS_NETAS', 'RES', '0', '1000'),
+                ('4201', 'Ingreso', '', 'OTROS_INGRESOS', '', 'RES', '0', '40'),
+                ('5101', 'Gasto', '', 'COSTO_NETO_VENTAS', 'COSTO_VENTAS', 'RES', '600', '0'),
+                ('5201', 'Gasto', '', 'GASTOS_OPERATIVOS', '', 'RES', '150', '0'),
+                ('5301', 'Gasto', '', 'IMPUESTO_SOBRE_LA_RENTA', '', 'RES', '45', '0'),
+            ]
+            self.periodo = Periodo.objects.create(empresa=self.empresa, anio=2024)
+            balances = {
+                tipo: Balance.objects.create(empresa=self.empresa, periodo=self.periodo, tipo_balance=tipo)
+                for tipo in ('BAL', 'RES')
+            }
+            for codigo, nat, bg, er, tag, tipo, debe, haber in cuentas:
+                cuenta = Cuenta.objects.create(
+                    grupo=grupos[nat], codigo=codigo, nombre=f'Cuenta {codigo}',
+                    bg_bloque=bg, er_bloque=er, ratio_tag=tag
+                )
+                BalanceDetalle.objects.create(
+                    balance=balances[tipo], cuenta=cuenta, debe=Decimal(debe), haber=Decimal(haber)
+                )
+            for balance in balances.values():
+                recalcular_saldos_detalle(balance)
+            self.balances = balances
+
+            for estado, clave, nombre, base in [
+                ('BAL', 'TOTAL_ACTIVO', 'Total Activo', True),
+                ('BAL', 'ACTIVO_CORRIENTE', 'Activo Corriente', False),
+                ('BAL', 'PASIVO_CORRIENTE', 'Pasivo Corriente', False),
+                ('BAL', 'PATRIMONIO_TOTAL', 'Patrimonio', False),
+                ('RES', 'VENTAS_NETAS', 'Ventas Netas', True),
+                ('RES', 'UTILIDAD_NETA', 'Utilidad Neta', False),
+            ]:
+                LineaEstado.objects.create(estado=estado, clave=clave, nombre=nombre, base_vertical=base)
+            mapear_cuentas_por_bloques(catalogo)
+
+    def test_valores_desde_ratio_tag(self):
+        """Test que suma saldos por ratio_tag, bloque y naturaleza"""
+        from decimal import Decimal
+        from stela.services.ratios import calcular_valores_desde_ratio_tag
+        bal = calcular_valores_desde_ratio_tag(self.empresa, self.periodo, 'BAL')
+        self.assertEqual(bal['TOTAL_ACTIVO'], Decimal('1140'))
+        self.assertEqual(bal['ACTIVO_CORRIENTE'], Decimal('440'))
+        self.assertEqual(bal['PASIVO_CORRIENTE'], Decimal('250'))
+        self.assertEqual(bal['PATRIMONIO_TOTAL'], Decimal('760'))
+        self.assertEqual(bal['CUENTAS_POR_COBRAR'], Decimal('100'))
+        res = calcular_valores_desde_ratio_tag(self.empresa, self.periodo, 'RES')
+        self.assertEqual(res['VENTAS_NETAS'], Decimal('1000'))
+        self.assertEqual(res['COSTO_VENTAS'], Decimal('600'))
+        self.assertEqual(res['UTILIDAD_NETA'], Decimal('1835'))
+
+    def test_calcular_y_guardar_ratios(self):
+        """Test que calcula y guarda los ratios del período"""
+        from decimal import Decimal
+        from stela.models.finanzas import ResultadoRatio
+        from stela.services.ratios import calcular_y_guardar_ratios
+        resultados = {r['clave']: r['valor'] for r in calcular_y_guardar_ratios(self.empresa, self.periodo)}
+        self.assertEqual(resultados['LIQUIDEZ_CORRIENTE'], Decimal('1.76'))
+        self.assertEqual(resultados['MARGEN_NETO'], Decimal('183.5'))
+        self.assertEqual(resultados['CAPITAL_TRABAJO'], Decimal('190'))
+        self.assertEqual(ResultadoRatio.objects.filter(empresa=self.empresa, periodo=self.periodo).count(), 10)
+        guardado = ResultadoRatio.objects.get(periodo=self.periodo, ratio__clave='ROE')
+        self.assertEqual(guardado.valor, Decimal('241.4474'))
+
+    def test_estado_dict_y_vertical(self):
+        """Test que arma el estado y el análisis vertical sobre la línea base"""
+        from decimal import Decimal
+        from stela.services.estados import estado_dict
+        from stela.services.analisis import analisis_vertical
+        data = estado_dict(self.empresa, self.periodo, 'BAL')
+        self.assertEqual(data['TOTAL_ACTIVO']['monto'], Decimal('1140'))
+        self.assertEqual(data['PATRIMONIO_TOTAL']['monto'], Decimal('760'))
+        vertical = {f['clave']: f for f in analisis_vertical(self.empresa, self.periodo, 'RES')}
+        self.assertEqual(vertical['UTILIDAD_NETA']['monto'], Decimal('1835'))
+        self.assertEqual(vertical['VENTAS_NETAS']['porc'], Decimal('100'))
+
+    def test_snapshot_periodo(self):
+        """Test que el snapshot carga el período en dos consultas y se reutiliza sin consultar"""
+        from stela.services.snapshot import PeriodSnapshot
+        from stela.services.ratios import calcular_valores_desde_ratio_tag
+        from stela.services.estados import calcular_totales_por_seccion
+        with self.assertNumQueries(2):
+            snapshot = PeriodSnapshot.cargar(self.empresa, self.periodo)
+        self.assertEqual(len(snapshot.detalles('BAL')), 7)
+        self.assertEqual(len(snapshot.detalles('RES')), 5)
+        with self.assertNumQueries(0):
+            totales = calcular_totales_por_seccion(snapshot=snapshot)
+        # Los valores por tag usan las filas agregadas: un GROUP BY para BAL y RES juntos
+        with self.assertNumQueries(1):
+            bal = calcular_valores_desde_ratio_tag(self.empresa, self.periodo, 'BAL', snapshot=snapshot)
+            res = calcular_valores_desde_ratio_tag(self.empresa, self.periodo, 'RES', snapshot=snapshot)
+        self.assertTrue(all(f.cuenta_id is None for f in snapshot.agregado().detalles('BAL')))
+        self.assertEqual(bal, calcular_valores_desde_ratio_tag(self.empresa, self.periodo, 'BAL'))
+        self.assertEqual(res, calcular_valores_desde_ratio_tag(self.empresa, self.periodo, 'RES'))
+        self.assertEqual(totales, calcular_totales_por_seccion(self.balances['RES']))
+        with self.assertRaises(ValueError):
+            calcular_totales_por_seccion()
+
+    def test_guardar_resultados_ratios_upsert(self):
+        """Test que el upsert masivo inserta y luego actualiza sin duplicar"""
+        from decimal import Decimal
+        from stela.models.finanzas import Periodo, RatioDef, ResultadoRatio
+        from stela.services.ratios import guardar_resultados_ratios, calcular_y_guardar_ratios_periodos
+        calcular_y_guardar_ratios_periodos(self.empresa, [self.periodo])
+        ratio = RatioDef.objects.get(clave='ROE')
+        otro = Periodo.objects.create(empresa=self.empresa, anio=2025)
+        with self.assertNumQueries(1):
+            guardar_resultados_ratios([
+                (self.empresa.pk, self.periodo.pk, ratio.pk, Decimal('1.5')),
+                (self.empresa.pk, otro.pk, ratio.pk, None),
+            ])
+        self.assertEqual(ResultadoRatio.objects.filter(empresa=self.empresa, ratio=ratio).count(), 2)
+        self.assertEqual(ResultadoRatio.objects.get(periodo=self.periodo, ratio=ratio).valor, Decimal('1.5'))
+        self.assertIsNone(ResultadoRatio.objects.get(periodo=otro, ratio=ratio).valor)
+
+    def test_calcular_ratios_batch(self):
+        """Test que el cálculo vectorizado coincide con el cálculo por período"""
+        import math
+        from decimal import Decimal
+        from stela.models.finanzas import Periodo, Balance, ResultadoRatio
+        from stela.services.ratios import calcular_ratios
+        from stela.services.ratios_batch import calcular_ratios_batch
+        vacio = Periodo.objects.create(empresa=self.empresa, anio=2025)
+        Balance.objects.create(empresa=self.empresa, periodo=vacio, tipo_balance='BAL')
+
+        batch = calcular_ratios_batch([self.empresa])
+        self.assertEqual(batch.pares, [(self.empresa.pk, self.periodo.pk), (self.empresa.pk, vacio.pk)])
+        esperados = {r.clave: v for r, v in calcular_ratios(self.empresa, self.periodo)}
+        for j, ratio in enumerate(batch.ratios):
+            self.assertAlmostEqual(batch.valores[0, j], float(esperados[ratio.clave]), places=6)
+        # Período sin saldos: divisiones entre cero -> NaN -> NULL
+        liquidez = [r.clave for r in batch.ratios].index('LIQUIDEZ_CORRIENTE')
+        self.assertTrue(math.isnan(batch.valores[1, liquidez]))
+        self.assertIsNone(ResultadoRatio.objects.get(periodo=vacio, ratio__clave='LIQUIDEZ_CORRIENTE').valor)
+        self.assertEqual(
+            ResultadoRatio.objects.get(periodo=self.periodo, ratio__clave='ROE').valor, Decimal('241.4474')
+        )
+
+    def test_valores_desde_ratio_tag_una_consulta(self):
+        """Test que sin snapshot los totales salen de una sola consulta agregada"""
+        from stela.services.ratios import calcular_valores_desde_ratio_tag
+        from stela.services.snapshot import PeriodSnapshot
+        snapshot = PeriodSnapshot.cargar(self.empresa, self.periodo)
+        for tipo in ('BAL', 'RES'):
+            with self.assertNumQueries(1):
+                agregado = calcular_valores_desde_ratio_tag(self.empresa, self.periodo, tipo)
+            self.assertEqual(agregado, calcular_valores_desde_ratio_tag(self.empresa, self.periodo, tipo, snapshot=snapshot))
+
+    def test_recalculo_incremental_por_cuenta(self):
+        """Test que editar un saldo solo recalcula los ratios que dependen de esa cuenta"""
+        from decimal import Decimal
+        from stela.models.finanzas import BalanceDetalle, ResultadoRatio
+        from stela.services.ratios import calcular_y_guardar_ratios
+        calcular_y_guardar_ratios(self.empresa, self.periodo)
+        ResultadoRatio.objects.filter(periodo=self.periodo).update(valor=Decimal('-1'))
+
+        detalle = BalanceDetalle.objects.get(balance=self.balances['BAL'], cuenta__codigo='2101')
+        detalle.saldo = Decimal('500')
+        with self.captureOnCommitCallbacks(execute=True):
+            detalle.save()
+
+        actualizados = dict(
+            ResultadoRatio.objects.filter(periodo=self.periodo).exclude(valor=Decimal('-1'))
+            .values_list('ratio__clave', 'valor')
+        )
+        self.assertEqual(set(actualizados), {'LIQUIDEZ_CORRIENTE', 'ENDEUDAMIENTO', 'CAPITAL_TRABAJO'})
+        self.assertEqual(actualizados['LIQUIDEZ_CORRIENTE'], Decimal('0.88'))
+        self.assertEqual(actualizados['CAPITAL_TRABAJO'], Decimal('-60'))
+        # Mismo valor que deja el recálculo completo
+        calcular_y_guardar_ratios(self.empresa, self.periodo)
+        completos = dict(ResultadoRatio.objects.filter(
+            periodo=self.periodo, ratio__clave__in=actualizados).values_list('ratio__clave', 'valor'))
+        self.assertEqual(completos, actualizados)
+
+        # Guardar solo debe/haber no cambia el saldo: no se recalcula nada
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            detalle.save(update_fields=['debe', 'haber'])
+        self.assertEqual(callbacks, [])
+
+    def test_recalculo_incremental_tras_rollback(self):
+        """Test que las marcas de una transacción revertida se descartan y cada transacción registra un callback"""
+        from decimal import Decimal
+        from unittest import mock
+        from django.db import transaction
+        from stela.models.finanzas import BalanceDetalle, ResultadoRatio
+        from stela.services import ratios_incremental
+        from stela.services.ratios import calcular_y_guardar_ratios
+        from stela.services.ratios_incremental import sin_recalculo_incremental
+        with self.captureOnCommitCallbacks(execute=True):
+            calcular_y_guardar_ratios(self.empresa, self.periodo)
+        detalle = BalanceDetalle.objects.get(balance=self.balances['BAL'], cuenta__codigo='2101')
+        liquidez = ResultadoRatio.objects.get(periodo=self.periodo, ratio__clave='LIQUIDEZ_CORRIENTE').valor
+
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            try:
+                with transaction.atomic():
+                    detalle.saldo = Decimal('1')
+                    detalle.save()
+                    raise ValueError('rollback')
+            except ValueError:
+                pass
+        self.assertEqual(callbacks, [])
+        self.assertEqual(
+            ResultadoRatio.objects.get(periodo=self.periodo, ratio__clave='LIQUIDEZ_CORRIENTE').valor, liquidez
+        )
+
+        # Varios guardados en una transacción: un solo callback de recálculo
+        otro = BalanceDetalle.objects.get(balance=self.balances['BAL'], cuenta__codigo='1101')
+        detalle.saldo = Decimal('500')
+        with mock.patch.object(ratios_incremental, 'procesar_pendientes',
+                               wraps=ratios_incremental.procesar_pendientes) as procesar:
+            with self.captureOnCommitCallbacks(execute=True):
+                with transaction.atomic():
+                    detalle.save()
+                    otro.save(update_fields=['saldo'])
+        procesar.assert_called_once_with({self.balances['BAL'].pk: {detalle.cuenta_id, otro.cuenta_id}})
+        self.assertEqual(
+            ResultadoRatio.objects.get(periodo=self.periodo, ratio__clave='LIQUIDEZ_CORRIENTE').valor,
+            Decimal('0.88')
+        )
+
+        # Suspendido (cargas masivas) no se registra nada
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            with sin_recalculo_incremental():
+                detalle.save()
+        self.assertEqual(callbacks, [])
+
+    def test_comando_recompute_ratios(self):
+        """Test que recompute_ratios recalcula los pares filtrados y exige un filtro"""
+        from decimal import Decimal
+        from stela.models.finanzas import ResultadoRatio
+        out = StringIO()
+        call_command('recompute_ratios', '--empresa', self.empresa.nit, '--anio', '2024', stdout=out)
+        self.assertIn('1 período(s)', out.getvalue())
+        self.assertEqual(ResultadoRatio.objects.filter(empresa=self.empresa, periodo=self.periodo).count(), 10)
+        self.assertEqual(
+            ResultadoRatio.objects.get(periodo=self.periodo, ratio__clave='ROE').valor, Decimal('241.4474')
+        )
+        with self.assertRaises(CommandError):
+            call_command('recompute_ratios', stdout=StringIO())
+
+    def test_estado_dict_indice_mapeo(self):
+        """Test que estado_dict usa el índice de mapeos en cache y se invalida al re-mapear"""
+        from decimal import Decimal
+        from stela.models.catalogo import Catalogo
+        from stela.models.finanzas import Balance, MapeoCuentaLinea
+        from stela.services.estados import estado_dict
+        from stela.services.mapeo_automatico import mapear_cuentas_por_bloques
+        from stela.services.snapshot import PeriodSnapshot
+        snapshot = PeriodSnapshot.cargar(self.empresa, self.periodo)
+        with self.assertNumQueries(2):
+            # Primera llamada: líneas + mapeos del catálogo
+            estado_dict(self.empresa, self.periodo, 'BAL', snapshot=snapshot)
+        with self.assertNumQueries(0):
+            data = estado_dict(self.empresa, self.periodo, 'BAL', snapshot=snapshot)
+        self.assertEqual(data['PASIVO_CORRIENTE']['monto'], Decimal('250'))
+
+        MapeoCuentaLinea.objects.filter(linea__clave='PASIVO_CORRIENTE').update(signo=-1)
+        revision = Balance.objects.get(pk=self.balances['BAL'].pk).revision
+        mapear_cuentas_por_bloques(Catalogo.objects.get(empresa=self.empresa))
+        # Re-mapear el catálogo invalida una sola vez, no una por fila de mapeo
+        self.assertEqual(Balance.objects.get(pk=self.balances['BAL'].pk).revision, revision + 1)
+        data = estado_dict(self.empresa, self.periodo, 'BAL', snapshot=snapshot)
+        self.assertEqual(data['PASIVO_CORRIENTE']['monto'], Decimal('250'))
+
+        # Un guardado de mapeo (ej. admin) descarta solo la entrada de su empresa
+        from django.core.cache import cache
+        from stela.services.indice_mapeo import CLAVE_VERSION, mapeos_empresa
+        version = cache.get(CLAVE_VERSION)
+        otra_empresa = 'X' + self.empresa.pk
+        mapeos_empresa(otra_empresa)
+        self.assertEqual(data['TOTAL_ACTIVO']['monto'], Decimal('1140'))
+        for mapeo in MapeoCuentaLinea.objects.filter(linea__clave='TOTAL_ACTIVO'):
+            mapeo.signo = -1
+            mapeo.save()
+        self.assertEqual(cache.get(CLAVE_VERSION), version)
+        with self.assertNumQueries(0):
+            mapeos_empresa(otra_empresa)
+        data = estado_dict(self.empresa, self.periodo, 'BAL', snapshot=snapshot)
+        self.assertEqual(data['TOTAL_ACTIVO']['monto'], Decimal('-1140'))
+
+    def test_saldos_linea_materializados(self):
+        """Test que SaldoLinea se reconstruye en bloque, se lee en una consulta y se actualiza por detalle"""
+        from decimal import Decimal
+        from stela.models.finanzas import BalanceDetalle, SaldoLinea
+        from stela.services.analisis import analisis_vertical
+        from stela.services.estados import estado_dict
+        call_command('rebuild_saldos_linea', '--empresa', self.empresa.nit, stdout=StringIO())
+        self.assertEqual(SaldoLinea.objects.filter(balance__empresa=self.empresa).count(), 6)
+
+        with self.assertNumQueries(1):
+            vertical = {f['clave']: f for f in analisis_vertical(self.empresa, self.periodo, 'BAL')}
+        for clave, v in estado_dict(self.empresa, self.periodo, 'BAL').items():
+            self.assertEqual(vertical[clave]['monto'], v['monto'])
+
+        detalle = BalanceDetalle.objects.get(balance=self.balances['BAL'], cuenta__codigo='2101')
+        detalle.saldo = Decimal('500')
+        with self.captureOnCommitCallbacks(execute=True):
+            detalle.save()
+        self.assertEqual(
+            SaldoLinea.objects.get(balance=self.balances['BAL'], linea__clave='PASIVO_CORRIENTE').monto,
+            Decimal('500')
+        )
+
+        # Cambiar atributos de la cuenta descarta sus líneas; la lectura las vuelve a materializar
+        detalle.cuenta.ratio_tag = 'PASIVO_CORRIENTE'
+        detalle.cuenta.save()
+        self.assertFalse(SaldoLinea.objects.filter(balance=self.balances['BAL']).exists())
+        vertical = {f['clave']: f for f in analisis_vertical(self.empresa, self.periodo, 'BAL')}
+        self.assertEqual(vertical['PASIVO_CORRIENTE']['monto'], Decimal('500'))
+        self.assertEqual(SaldoLinea.objects.filter(balance=self.balances['BAL']).count(), 4)
+
+    def test_recalcular_saldos_un_update(self):
+        """Test que los saldos de varios balances se recalculan con un solo UPDATE según naturaleza"""
+        from decimal import Decimal
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from stela.models.finanzas import BalanceDetalle
+        from stela.services.estados import recalcular_saldos_balances
+        BalanceDetalle.objects.update(saldo=0)
+        with CaptureQueriesContext(connection) as ctx:
+            actualizados = recalcular_saldos_balances(list(self.balances.values()))
+        self.assertEqual(actualizados, 12)
+        updates = [q for q in ctx.captured_queries if q['sql'].startswith('UPDATE "stela_balancedetalle"')]
+        self.assertEqual(len(updates), 1)
+        saldos = dict(BalanceDetalle.objects.values_list('cuenta__codigo', 'saldo'))
+        self.assertEqual(saldos['1101'], Decimal('300'))
+        self.assertEqual(saldos['2101'], Decimal('250'))
+        self.assertEqual(saldos['4101'], Decimal('1000'))
+        self.assertEqual(saldos['5101'], Decimal('600'))
+
+        # Solo el UPDATE: las invalidaciones quedan a cargo de quien llama
+        from stela.models.empresa import Empresa
+        from stela.models.finanzas import Balance, SaldoLinea
+        from stela.services.saldos_linea import saldos_recalculados
+        self.assertFalse(any('stela_saldolinea' in q['sql'] or 'stela_empresa' in q['sql'] for q in ctx.captured_queries))
+        revision = Balance.objects.get(pk=self.balances['BAL'].pk).revision
+        version = Empresa.objects.get(pk=self.empresa.pk).version_datos
+        saldos_recalculados(list(self.balances.values()))
+        self.assertEqual(Balance.objects.get(pk=self.balances['BAL'].pk).revision, revision + 1)
+        self.assertEqual(Empresa.objects.get(pk=self.empresa.pk).version_datos, version + 1)
+        self.assertTrue(SaldoLinea.objects.filter(balance=self.balances['BAL']).exists())
+
+    def test_cubo_cuentas_y_ratios(self):
+        """Test que los cubos multi-período salen de una consulta y alimentan horizontal y gráficas"""
+        import math
+        from decimal import Decimal
+        from stela.models.catalogo import Cuenta
+        from stela.models.finanzas import Periodo
+        from stela.services.analisis import analisis_horizontal
+        from stela.services.cubo import cubo_cuentas, cubo_ratios
+        from stela.services.ratios import calcular_y_guardar_ratios
+        calcular_y_guardar_ratios(self.empresa, self.periodo)
+        vacio = Periodo.objects.create(empresa=self.empresa, anio=2025)
+        periodos = [self.periodo, vacio]
+        caja = Cuenta.objects.get(codigo='1101', grupo__catalogo__empresa=self.empresa)
+
+        with self.assertNumQueries(1):
+            cubo = cubo_cuentas(self.empresa, periodos)
+        self.assertEqual(cubo.valores.shape, (12, 2))
+        self.assertEqual(cubo.serie(caja.pk)[0], 300.0)
+        self.assertEqual(cubo.codigos[cubo.filas.tolist().index(caja.pk)], '1101')
+        self.assertTrue(math.isnan(cubo.serie(caja.pk)[1]))
+        # Las celdas se suman en Decimal (0.10 + 0.20 en float64 no da 0.30)
+        from stela.models.finanzas import BalanceDetalle
+        from stela.services.ratios_incremental import sin_recalculo_incremental
+        with sin_recalculo_incremental():
+            BalanceDetalle.objects.filter(cuenta=caja).update(saldo=Decimal('0.10'))
+            extra = BalanceDetalle.objects.create(balance=self.balances['RES'], cuenta=caja, saldo=Decimal('0.20'))
+            cubo = cubo_cuentas(self.empresa, periodos, cuentas=[caja.pk])
+            self.assertEqual(cubo.columna(self.periodo)[0], Decimal('0.30'))
+            self.assertIsNone(cubo.columna(vacio)[0])
+            extra.delete()
+            BalanceDetalle.objects.filter(cuenta=caja).update(saldo=Decimal('300'))
+        with self.assertNumQueries(1):
+            ratios = cubo_ratios(self.empresa, periodos, claves=['LIQUIDEZ_CORRIENTE', 'NO_EXISTE'])
+        self.assertAlmostEqual(ratios.serie('LIQUIDEZ_CORRIENTE')[0], 1.76)
+        self.assertTrue(math.isnan(ratios.serie('NO_EXISTE')[0]))
+
+        analisis_horizontal(self.empresa, self.periodo, self.periodo, 'BAL')  # materializa
+        with self.assertNumQueries(1):
+            filas = analisis_horizontal(self.empresa, self.periodo, self.periodo, 'BAL')
+        activo = next(f for f in filas if f['clave'] == 'TOTAL_ACTIVO')
+        self.assertEqual((activo['base'], activo['variacion'], activo['porc']), (Decimal('1140.00'), 0, 0))
+
+        self.client.force_login(self.user)
+        session = self.client.session
+        session['active_company_nit'] = self.empresa.nit
+        session.save()
+        respuesta = self.client.get(reverse('api_get_chart_data'), {'type': 'cuentas', 'ids': [caja.pk, 999999]})
+        self.assertEqual(respuesta.json()['datasets'], [{'label': '1101 - Cuenta 1101', 'data': [300.0, 0.0]}])
+
+    def test_analisis_tendencia(self):
+        """Test que la tendencia de N períodos sale del cubo de líneas en una pasada"""
+        from decimal import Decimal
+        from stela.models.catalogo import Cuenta
+        from stela.models.finanzas import Periodo, Balance, BalanceDetalle
+        from stela.services.analisis import analisis_tendencia
+        from stela.services.estados import recalcular_saldos_detalle
+        anterior = Periodo.objects.create(empresa=self.empresa, anio=2023)
+        balance = Balance.objects.create(empresa=self.empresa, periodo=anterior, tipo_balance='BAL')
+        BalanceDetalle.objects.create(
+            balance=balance, debe=Decimal('150'), haber=Decimal('0'),
+            cuenta=Cuenta.objects.get(codigo='1101', grupo__catalogo__empresa=self.empresa)
+        )
+        recalcular_saldos_detalle(balance)
+        periodos = [anterior, self.periodo]
+
+        analisis_tendencia(self.empresa, periodos, 'BAL')  # materializa
+        with self.assertNumQueries(2):
+            bal = analisis_tendencia(self.empresa, periodos, 'BAL')
+        self.assertEqual(bal['etiquetas'], ['2023', '2024'])
+        activo = next(f for f in bal['filas'] if f['clave'] == 'TOTAL_ACTIVO')
+        inicial, actual = activo['celdas']
+        self.assertEqual((inicial['monto'], inicial['variacion'], inicial['indice']), (Decimal('150.00'), None, 100))
+        self.assertEqual((actual['monto'], actual['variacion']), (Decimal('1140.00'), Decimal('990.00')))
+        self.assertEqual((actual['porc'], actual['indice'], actual['vertical']), (660, 760, 100))
+        corriente = next(f for f in bal['filas'] if f['clave'] == 'ACTIVO_CORRIENTE')
+        self.assertAlmostEqual(float(corriente['celdas'][1]['vertical']), 440 / 1140 * 100)
+
+        res = analisis_tendencia(self.empresa, periodos, 'RES')
+        ventas = next(f for f in res['filas'] if f['clave'] == 'VENTAS_NETAS')
+        self.assertIsNone(ventas['celdas'][0]['monto'])
+        self.assertEqual((ventas['celdas'][1]['monto'], ventas['celdas'][1]['indice']), (Decimal('1000.00'), None))
+
+    def test_cache_analisis_por_revision(self):
+        """Test que los análisis se sirven por (balance, revisión) y se invalidan al escribir detalles o mapeos"""
+        from decimal import Decimal
+        from django.core.cache import cache
+        from stela.models.catalogo import Cuenta
+        from stela.models.finanzas import BalanceDetalle, LineaEstado, MapeoCuentaLinea
+        from stela.services.cache_analisis import horizontal_cacheado, vertical_cacheado
+        cache.clear()
+        balance = self.balances['BAL']
+        balance.refresh_from_db()
+        revision = balance.revision
+
+        def total_activo():
+            filas = vertical_cacheado(self.empresa, self.periodo, 'BAL')
+            return next(f['monto'] for f in filas if f['clave'] == 'TOTAL_ACTIVO')
+
+        self.assertEqual(total_activo(), Decimal('1140'))
+        with self.assertNumQueries(1):
+            self.assertEqual(total_activo(), Decimal('1140'))
+        horizontal_cacheado(self.empresa, self.periodo, self.periodo, 'BAL')
+        with self.assertNumQueries(1):
+            horizontal_cacheado(self.empresa, self.periodo, self.periodo, 'BAL')
+
+        detalle = BalanceDetalle.objects.get(balance=balance, cuenta__codigo='1201')
+        detalle.saldo = Decimal('800')
+        with self.captureOnCommitCallbacks(execute=True):
+            detalle.save()
+        balance.refresh_from_db()
+        self.assertEqual(balance.revision, revision + 1)
+        self.assertEqual(total_activo(), Decimal('1240'))
+
+        caja = Cuenta.objects.get(codigo='1101', grupo__catalogo__empresa=self.empresa)
+        MapeoCuentaLinea.objects.create(
+            cuenta=caja, linea=LineaEstado.objects.get(clave='PASIVO_CORRIENTE'), signo=1
+        )
+        balance.refresh_from_db()
+        self.assertEqual(balance.revision, revision + 2)
+
+    def test_benchmarking_por_ciiu_una_consulta(self):
+        """Test que el benchmark sectorial agrega todos los ratios y períodos en una consulta"""
+        from decimal import Decimal
+        from stela.models.finanzas import Periodo, ResultadoRatio
+        from stela.services.benchmark import benchmarking_por_ciiu
+        from stela.services.ratios import calcular_y_guardar_ratios
+        calcular_y_guardar_ratios(self.empresa, self.periodo)
+        otra = Empresa.objects.create(
+            nit='0614-010101-102-1', ciiu=self.empresa.ciiu, nrc='2222222',
+            razon_social='Empresa Sector', direccion='Dirección', telefono='2222-2222',
+            email='sector@test.com'
+        )
+        liquidez = ResultadoRatio.objects.get(empresa=self.empresa, ratio__clave='LIQUIDEZ_CORRIENTE').ratio
+        for anio, valor in ((2024, Decimal('2.24')), (2023, Decimal('1.5'))):
+            ResultadoRatio.objects.create(
+                empresa=otra, periodo=Periodo.objects.create(empresa=otra, anio=anio),
+                ratio=liquidez, valor=valor
+            )
+        anterior = Periodo.objects.create(empresa=self.empresa, anio=2023)
+
+        # Leer no calcula celdas: hasta refrescarlas se leen vacías
+        with self.assertNumQueries(1):
+            self.assertEqual(benchmarking_por_ciiu(self.empresa.ciiu, self.periodo), {})
+        call_command('refresh_estadisticas_sector', '--all', stdout=StringIO())
+        with self.assertNumQueries(1):
+            sector = benchmarking_por_ciiu(self.empresa.ciiu, self.periodo)
+        self.assertEqual(len(sector), 10)
+        self.assertEqual(sector['LIQUIDEZ_CORRIENTE']['n'], 2)
+        self.assertAlmostEqual(float(sector['LIQUIDEZ_CORRIENTE']['promedio']), 2.0)
+        self.assertAlmostEqual(float(sector['LIQUIDEZ_CORRIENTE']['desv']), 0.24)
+        self.assertEqual(sector['LIQUIDEZ_CORRIENTE']['p10'], Decimal('1.808'))
+        self.assertEqual(sector['LIQUIDEZ_CORRIENTE']['p50'], Decimal('2'))
+        self.assertEqual(sector['ROE']['desv'], Decimal('0'))
+
+        with self.assertNumQueries(1):
+            historia = benchmarking_por_ciiu(self.empresa.ciiu, [anterior, self.periodo])
+        self.assertEqual(set(historia), {(2023, None), (2024, None)})
+        self.assertEqual(historia[(2023, None)]['LIQUIDEZ_CORRIENTE']['promedio'], Decimal('1.5'))
+        self.assertEqual(historia[(2024, None)], sector)
+
+    def test_estadisticas_sector_se_refrescan(self):
+        """Test que recalcular ratios refresca solo las celdas del sector afectadas y el comando las reconstruye"""
+        from decimal import Decimal
+        from stela.models.finanzas import EstadisticaSector, RatioDef
+        from stela.services.estadistica_sector import refrescar_estadisticas_sector
+        from stela.services.ratios import calcular_y_guardar_ratios
+        otra_celda = EstadisticaSector.objects.create(
+            ciiu=self.empresa.ciiu, anio=2020, ratio=RatioDef.objects.first(), n=3,
+            promedio=1, desv=0, p10=1, p25=1, p50=1, p75=1, p90=1
+        )
+        with self.captureOnCommitCallbacks(execute=True):
+            calcular_y_guardar_ratios(self.empresa, self.periodo)
+        celda = EstadisticaSector.objects.filter(ciiu=self.empresa.ciiu, anio=2024)
+        self.assertEqual(celda.count(), 10)
+        self.assertEqual(celda.get(ratio__clave='LIQUIDEZ_CORRIENTE').p90, Decimal('1.76'))
+        self.assertTrue(EstadisticaSector.objects.filter(pk=otra_celda.pk).exists())
+
+        EstadisticaSector.objects.filter(anio=2024).delete()
+        call_command('refresh_estadisticas_sector', '--all', stdout=StringIO())
+        self.assertEqual(EstadisticaSector.objects.filter(anio=2024).count(), 10)
+        # Refrescar de nuevo actualiza en su lugar (upsert): el anual se guarda como mes 0
+        ids = set(EstadisticaSector.objects.filter(anio=2024).values_list('pk', flat=True))
+        refrescar_estadisticas_sector([(self.empresa.ciiu_id, 2024, None)])
+        self.assertEqual(set(EstadisticaSector.objects.filter(anio=2024, mes=0).values_list('pk', flat=True)), ids)
+        self.assertFalse(EstadisticaSector.objects.filter(anio=2020).exists())
+
+    def test_historico_ratios_una_consulta(self):
+        """Test que la historia de ratios sale de una consulta agrupada y el semáforo se clasifica en bloque"""
+        from decimal import Decimal
+        from stela.models.finanzas import Periodo, RatioDef, ResultadoRatio
+        from stela.services.benchmark import clasificar_semaforos, etiqueta_semaforo, historico_ratios
+        from stela.services.ratios import calcular_y_guardar_ratios
+        calcular_y_guardar_ratios(self.empresa, self.periodo)
+        liquidez = RatioDef.objects.get(clave='LIQUIDEZ_CORRIENTE')
+        for anio, mes, valor in ((2023, None, '1.00'), (2024, 6, '2.00'), (2025, None, None)):
+            ResultadoRatio.objects.create(
+                empresa=self.empresa, periodo=Periodo.objects.create(empresa=self.empresa, anio=anio, mes=mes),
+                ratio=liquidez, valor=None if valor is None else Decimal(valor)
+            )
+
+        with self.assertNumQueries(1):
+            historico = historico_ratios(self.empresa, claves=['LIQUIDEZ_CORRIENTE', 'NO_EXISTE'])
+
+        self.assertEqual(list(historico), ['LIQUIDEZ_CORRIENTE'])
+        h = historico['LIQUIDEZ_CORRIENTE']
+        self.assertEqual(h['n'], 3)
+        self.assertAlmostEqual(float(h['promedio']), 1.5867, places=4)
+        self.assertAlmostEqual(float(h['desv']), 0.426, places=3)
+        self.assertEqual((h['minimo'], h['maximo']), (Decimal('1'), Decimal('2')))
+        # 2024-06 es posterior al anual 2024 y 2025 no tiene valor
+        self.assertEqual(h['ultimo'], Decimal('2'))
+
+        filas = [
+            {'valor': Decimal('3'), 'promedio': Decimal('1'), 'desv': Decimal('1')},
+            {'valor': Decimal('1.5'), 'promedio': Decimal('1'), 'desv': Decimal('1')},
+            {'valor': Decimal('0'), 'promedio': Decimal('1'), 'desv': Decimal('0.5')},
+            {'valor': Decimal('1'), 'promedio': Decimal('1'), 'desv': Decimal('0')},
+            {'valor': Decimal('2'), 'promedio': Decimal('1'), 'desv': Decimal('0')},
+            {'valor': None, 'promedio': Decimal('1'), 'desv': Decimal('0')},
+            {'valor': Decimal('1'), 'promedio': None, 'desv': None},
+        ]
+        esperado = [
+            etiqueta_semaforo(f['valor'], f['promedio'], f['desv']) if f['promedio'] is not None else 'NA'
+            for f in filas
+        ]
+        self.assertEqual([f['semaforo'] for f in clasificar_semaforos(filas)], esperado)
+        self.assertEqual(esperado, ['ALTO', 'OK', 'BAJO', 'OK', 'ALTO', 'NA', 'NA'])
+
+    def test_chart_data_consultas_fijas(self):
+        """Test que get_chart_data_api arma la matriz con un número fijo de consultas"""
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from stela.models.finanzas import Periodo
+        from stela.services.ratios import calcular_y_guardar_ratios
+        calcular_y_guardar_ratios(self.empresa, self.periodo)
+        for anio in (2021, 2022, 2023):
+            Periodo.objects.create(empresa=self.empresa, anio=anio)
+        cuentas = [str(d.cuenta_id) for b in self.balances.values() for d in b.detalles.all()]
+        self.client.login(username='ratios', password='testpass123')
+        sesion = self.client.session
+        sesion['active_company_nit'] = self.empresa.nit
+        sesion.save()
+
+        def consultas(tipo, ids):
+            with CaptureQueriesContext(connection) as ctx:
+                respuesta = self.client.get(reverse('api_get_chart_data'), {'type': tipo, 'ids': ids})
+            self.assertEqual(respuesta.status_code, 200)
+            return respuesta.json(), len([q for q in ctx.captured_queries if '"stela_' in q['sql']])
+
+        # Más la lectura de la versión de datos de la empresa (ETag)
+        datos, n = consultas('ratios', ['LIQUIDEZ_CORRIENTE', 'NO_EXISTE'])
+        self.assertEqual(n, 3)
+        self.assertEqual(datos['labels'], ['2021', '2022', '2023', '2024'])
+        self.assertEqual(datos['datasets'][0]['data'], [0, 0, 0, 1.76])
+
+        datos, n = consultas('cuentas', cuentas + ['999999'])
+        self.assertEqual(n, 4)
+        self.assertEqual(len(datos['datasets']), len(cuentas))
+
+        # Empresa de otro usuario: 404 aunque tenga períodos
+        otra = Empresa.objects.create(
+            nit='0614-010101-999-1', ciiu=self.empresa.ciiu, nrc='9999999', razon_social='Ajena',
+            direccion='Dirección', telefono='2222-2222', email='ajena@test.com'
+        )
+        Periodo.objects.create(empresa=otra, anio=2024)
+        sesion['active_company_nit'] = otra.nit
+        sesion.save()
+        respuesta = self.client.get(reverse('api_get_chart_data'), {'type': 'ratios', 'ids': ['LIQUIDEZ_CORRIENTE']})
+        self.assertNotEqual(respuesta.status_code, 200)
+
+    def test_ratios_series_solo_lectura_y_cola(self):
+        """Test que ratios_series_json no calcula: encola una vez los períodos sin ratios y los informa"""
+        from stela.models.finanzas import Periodo, RecalculoPendiente, ResultadoRatio
+        Periodo.objects.create(empresa=self.empresa, anio=2023)   # sin estados: nada que recalcular
+        self.client.login(username='ratios', password='testpass123')
+        url = reverse('ratios_series_json')
+        params = {'empresa': self.empresa.nit, 'claves': 'LIQUIDEZ_CORRIENTE,ROA'}
+
+        for _ in range(3):
+            datos = self.client.get(url, params).json()
+        self.assertFalse(ResultadoRatio.objects.exists())
+        self.assertEqual(datos['anios'], ['2023', '2024'])
+        self.assertEqual(datos['pendientes'], ['2024'])
+        self.assertEqual(datos['series']['LIQUIDEZ_CORRIENTE']['valores'], [None, None])
+        self.assertEqual(
+            list(RecalculoPendiente.objects.values_list('empresa_id', 'periodo_id')),
+            [(self.empresa.pk, self.periodo.pk)]
+        )
+
+        out = StringIO()
+        call_command('process_ratio_queue', stdout=out)
+        self.assertIn('1 período', out.getvalue())
+        self.assertFalse(RecalculoPendiente.objects.exists())
+
+        datos = self.client.get(url, params).json()
+        self.assertEqual(datos['pendientes'], [])
+        self.assertEqual(datos['series']['LIQUIDEZ_CORRIENTE']['valores'], [None, 1.76])
+        self.assertFalse(RecalculoPendiente.objects.exists())
+
+        # Un par encolado de nuevo mientras se procesa sigue en la cola
+        from unittest import mock
+        from stela.services import cola_ratios
+        par = [(self.empresa.pk, self.periodo.pk)]
+        cola_ratios.encolar_recalculo(par)
+        creado = RecalculoPendiente.objects.get().creado
+        calcular = cola_ratios.calcular_ratios_batch
+
+        def calcular_y_reencolar(*args, **kwargs):
+            cola_ratios.encolar_recalculo(par)
+            return calcular(*args, **kwargs)
+
+        with mock.patch.object(cola_ratios, 'calcular_ratios_batch', side_effect=calcular_y_reencolar):
+            self.assertEqual(cola_ratios.procesar_cola_ratios(), 1)
+        self.assertEqual(RecalculoPendiente.objects.get().creado, creado)
+        self.assertEqual(cola_ratios.procesar_cola_ratios(), 1)
+        self.assertFalse(RecalculoPendiente.objects.exists())
+
+    def test_dashboard_consultas_fijas(self):
+        """Test que el dashboard resume todas las empresas con un número fijo de consultas"""
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from stela.models.finanzas import Periodo
+        self.user.is_superuser = True
+        self.user.save()
+        self.client.login(username='ratios', password='testpass123')
+
+        def consultas():
+            with CaptureQueriesContext(connection) as ctx:
+                respuesta = self.client.get(reverse('dashboard'))
+            self.assertEqual(respuesta.status_code, 200)
+            return respuesta.context['empresas_data'], len([q for q in ctx.captured_queries if '"stela_' in q['sql']])
+
+        consultas()   # la primera visita elige la empresa activa de la sesión
+        _, una = consultas()
+        for i in range(3):
+            otra = Empresa.objects.create(
+                nit=f'0614-010101-30{i}-1', ciiu=self.empresa.ciiu, nrc=f'555555{i}',
+                razon_social=f'Empresa Dash {i}', direccion='Dirección', telefono='2222-2222',
+                email=f'dash{i}@test.com'
+            )
+            otra.usuario.add(self.user)
+            for anio in range(2015, 2022):
+                Periodo.objects.create(empresa=otra, anio=anio)
+        Periodo.objects.create(empresa=self.empresa, anio=2023)
+
+        datos, varias = consultas()
+        self.assertEqual(varias, una)
+        resumen = {d['empresa'].nit: d for d in datos}
+        propia = resumen[self.empresa.nit]
+        self.assertTrue(propia['tiene_catalogo'])
+        self.assertFalse(resumen['0614-010101-300-1']['tiene_catalogo'])
+        self.assertEqual((propia['num_periodos'], propia['num_balances']), (2, 2))
+        dash = resumen['0614-010101-300-1']
+        self.assertEqual((dash['num_periodos'], dash['num_balances']), (7, 0))
+        self.assertEqual([p.anio for p in dash['periodos']], [2021, 2020, 2019, 2018, 2017])
+
+    def test_empresa_detalles_sin_efectos(self):
+        """Test que empresa_detalles no borra períodos y carga los balances con un número fijo de consultas"""
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from stela.models.finanzas import Balance, BalanceDetalle, Periodo, ResultadoRatio
+        from stela.services.ratios import calcular_y_guardar_ratios
+        self.user.is_superuser = True
+        self.user.save()
+        self.client.login(username='ratios', password='testpass123')
+        url = reverse('empresa_detalles', args=[self.empresa.nit])
+
+        def consultas():
+            with CaptureQueriesContext(connection) as ctx:
+                respuesta = self.client.get(url)
+            self.assertEqual(respuesta.status_code, 200)
+            return respuesta.context, len([q for q in ctx.captured_queries if '"stela_' in q['sql']])
+
+        consultas()   # la primera visita elige la empresa activa de la sesión
+        _, una = consultas()
+        detalle = self.balances['BAL'].detalles.first()
+        for anio in (2022, 2023):
+            periodo = Periodo.objects.create(empresa=self.empresa, anio=anio)
+            for tipo in ('BAL', 'RES'):
+                balance = Balance.objects.create(empresa=self.empresa, periodo=periodo, tipo_balance=tipo)
+                BalanceDetalle.objects.create(balance=balance, cuenta=detalle.cuenta, saldo=detalle.saldo)
+        vacio = Periodo.objects.create(empresa=self.empresa, anio=2020)
+        calcular_y_guardar_ratios(self.empresa, vacio)
+
+        contexto, varias = consultas()
+        self.assertEqual(varias, una)
+        self.assertEqual([p.anio for p in contexto['periodos']], [2024, 2023, 2022])
+        grupo = contexto['balances_por_periodo'][self.periodo]
+        self.assertEqual((grupo['balance'], grupo['resultados']), (self.balances['BAL'], self.balances['RES']))
+        # El GET no borra el período vacío
+        self.assertTrue(Periodo.objects.filter(pk=vacio.pk).exists())
+
+        out = StringIO()
+        call_command('purge_empty_periods', '--empresa', self.empresa.nit, stdout=out)
+        self.assertIn('1 período', out.getvalue())
+        self.assertFalse(Periodo.objects.filter(pk=vacio.pk).exists())
+        self.assertFalse(ResultadoRatio.objects.filter(periodo_id=vacio.pk).exists())
+        self.assertEqual(Periodo.objects.filter(empresa=self.empresa).count(), 3)
+
+    def test_apis_json_condicionales(self):
+        """Test que las APIs JSON responden 304 mientras no cambie la versión de datos de la empresa"""
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from stela.models.finanzas import Periodo
+        from stela.services.ratios import calcular_y_guardar_ratios
+        self.client.login(username='ratios', password='testpass123')
+        url = reverse('ratios_series_json')
+        params = {'empresa': self.empresa.nit, 'claves': 'LIQUIDEZ_CORRIENTE'}
+
+        respuesta = self.client.get(url, params)
+        self.assertEqual(respuesta.status_code, 200)
+        etag = respuesta['ETag']
+        with CaptureQueriesContext(connection) as ctx:
+            respuesta = self.client.get(url, params, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(respuesta.status_code, 304)
+        # Solo la lectura de la versión de la empresa
+        self.assertEqual(len([q for q in ctx.captured_queries if '"stela_' in q['sql']]), 1)
+
+        # Un recálculo (varias filas, una transacción) sube la versión una sola vez
+        version = Empresa.objects.get(pk=self.empresa.pk).version_datos
+        with self.captureOnCommitCallbacks(execute=True):
+            calcular_y_guardar_ratios(self.empresa, self.periodo)
+            calcular_y_guardar_ratios(self.empresa, self.periodo, tipo_estado='BAL')
+        empresa = Empresa.objects.get(pk=self.empresa.pk)
+        self.assertEqual(empresa.version_datos, version + 1)
+        self.assertIsNotNone(empresa.datos_actualizados)
+        respuesta = self.client.get(url, params, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(respuesta.status_code, 200)
+        self.assertNotEqual(respuesta['ETag'], etag)
+        self.assertTrue(respuesta.has_header('Last-Modified'))
+        self.assertEqual(respuesta.json()['series']['LIQUIDEZ_CORRIENTE']['valores'], [1.76])
+
+        # Un período nuevo cambia la lista de períodos
+        url = reverse('api_get_periodos')
+        params = {'empresa_id': self.empresa.nit, 'tipo_estado': 'BAL'}
+        etag = self.client.get(url, params)['ETag']
+        self.assertEqual(self.client.get(url, params, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        with self.captureOnCommitCallbacks(execute=True):
+            Periodo.objects.create(empresa=self.empresa, anio=2023)
+        self.assertEqual(self.client.get(url, params, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+        # Definiciones de ratios: ETag global
+        url = reverse('api_get_ratios')
+        etag = self.client.get(url)['ETag']
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        # Editar un RatioDef sube la versión compartida del registro, y con ella el ETag
+        from stela.models.finanzas import RatioDef
+        ratio = RatioDef.objects.get(clave='ROE')
+        ratio.nombre = 'Rentabilidad del patrimonio'
+        ratio.save()
+        respuesta = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(respuesta.status_code, 200)
+        self.assertIn('Rentabilidad del patrimonio', respuesta.content.decode())
+
+        # Sin acceso a la empresa no hay 304 (la vista responde el error)
+        respuesta = self.client.get(reverse('ratios_series_json'), {'empresa': 'NO-EXISTE'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertNotEqual(respuesta.status_code, 304)
+
+    def test_percentil_en_sector(self):
+        """Test que el rango percentil de cada empresa en su CIIU se guarda en ResultadoRatio al refrescar el sector"""
+        from decimal import Decimal
+        from stela.models.finanzas import Periodo, RatioDef, ResultadoRatio
+        from stela.services.ratios import calcular_y_guardar_ratios
+        liquidez = RatioDef.objects.get(clave='LIQUIDEZ_CORRIENTE')
+        for i, valor in enumerate(('2.24', '1.76', None)):
+            otra = Empresa.objects.create(
+                nit=f'0614-010101-20{i}-1', ciiu=self.empresa.ciiu, nrc=f'444444{i}',
+                razon_social=f'Empresa Par {i}', direccion='Dirección', telefono='2222-2222',
+                email=f'par{i}@test.com'
+            )
+            ResultadoRatio.objects.create(
+                empresa=otra, periodo=Periodo.objects.create(empresa=otra, anio=2024),
+                ratio=liquidez, valor=None if valor is None else Decimal(valor), percentil=Decimal('50')
+            )
+        with self.captureOnCommitCallbacks(execute=True):
+            calcular_y_guardar_ratios(self.empresa, self.periodo)
+
+        percentiles = dict(
+            ResultadoRatio.objects.filter(ratio=liquidez).values_list('empresa__razon_social', 'percentil')
+        )
+        self.assertEqual(percentiles, {
+            'Empresa Ratios': Decimal('33.3333'),  # 1.76 empata con otra: (0 + 2) / 2 de 3
+            'Empresa Par 0': Decimal('83.3333'),
+            'Empresa Par 1': Decimal('33.3333'),
+            'Empresa Par 2': None,                 # sin valor no tiene rango
+        })
+
+    def test_ratios_sector_cache_por_mtime(self):
+        """Test que ratios_sector.json se parsea una vez por mtime y RatioSector prevalece sobre el archivo"""
+        import json
+        import tempfile
+        from decimal import Decimal
+        from pathlib import Path
+        from unittest import mock
+        from stela.models.finanzas import RatioDef, RatioSector
+        from stela.services import ratios_sector
+        with tempfile.TemporaryDirectory() as tmp:
+            archivo = Path(tmp) / 'ratios_sector.json'
+            archivo.write_text(json.dumps({'A': {'LIQUIDEZ_CORRIENTE': 1.5, 'ROE': 20}}), encoding='utf-8')
+            with mock.patch.object(ratios_sector, 'RATIOS_SECTOR_FILE', archivo):
+                ratios_sector.invalidar_ratios_sector()
+                datos = ratios_sector.cargar_ratios_sector()
+                self.assertEqual(datos['A']['LIQUIDEZ_CORRIENTE'], Decimal('1.5'))
+                with self.assertNumQueries(0):
+                    self.assertIs(ratios_sector.cargar_ratios_sector(), datos)
+                    comparacion = ratios_sector.obtener_comparacion_sector(
+                        self.empresa, [{'clave': 'LIQUIDEZ_CORRIENTE', 'valor': Decimal('1.76')}]
+                    )
+                self.assertEqual(comparacion[0]['semaforo_sector'], 'CUMPLE')
+
+                archivo.write_text(json.dumps({'A': {'LIQUIDEZ_CORRIENTE': 2}}), encoding='utf-8')
+                os.utime(archivo, ns=(0, os.stat(archivo).st_mtime_ns + 10**9))
+                self.assertEqual(ratios_sector.obtener_ratio_sector('A', 'LIQUIDEZ_CORRIENTE'), Decimal('2'))
+                self.assertIsNone(ratios_sector.obtener_ratio_sector('A', 'ROE'))
+
+                RatioSector.objects.create(
+                    ciiu=self.empresa.ciiu, ratio=RatioDef.objects.get(clave='LIQUIDEZ_CORRIENTE'), valor=Decimal('1.9')
+                )
+                self.assertEqual(ratios_sector.obtener_ratio_sector('A', 'LIQUIDEZ_CORRIENTE'), Decimal('1.9'))
+            ratios_sector.invalidar_ratios_sector()
+
+    def test_jerarquia_ciiu_ruta_y_fallback(self):
+        """Test que la ruta materializada se mantiene y el benchmark sube al ancestro con suficientes empresas"""
+        import json
+        import tempfile
+        from decimal import Decimal
+        from pathlib import Path
+        from unittest import mock
+        from stela.models.finanzas import Periodo, ResultadoRatio
+        from stela.services import ratios_sector
+        from stela.services.benchmark import benchmark_sector
+        from stela.services.ciiu_jerarquia import ciiu_referencia, recalcular_rutas_ciiu
+        from stela.services.estadistica_sector import celdas_de_pares
+        from stela.services.ratios import calcular_y_guardar_ratios
+        raiz = self.empresa.ciiu
+        division = Ciiu.objects.create(codigo='01', descripcion='División', nivel=2, padre=raiz)
+        propio = Ciiu.objects.create(codigo='011', descripcion='Grupo propio', nivel=3, padre=division)
+        vecino = Ciiu.objects.create(codigo='012', descripcion='Grupo vecino', nivel=3, padre=division)
+        self.assertEqual(propio.ruta, 'A/01/011/')
+        self.assertEqual(propio.codigos_ancestros(), ['011', '01', 'A'])
+
+        # Cambiar de padre reescribe la ruta de todo el subárbol
+        otra_raiz = Ciiu.objects.create(codigo='B', descripcion='Actividad B', nivel=1)
+        division.padre = otra_raiz
+        division.save()
+        propio.refresh_from_db()
+        self.assertEqual(propio.ruta, 'B/01/011/')
+        division.padre = raiz
+        division.save()
+        propio.refresh_from_db()
+        Ciiu.objects.filter(pk='012').update(ruta='')
+        self.assertEqual(recalcular_rutas_ciiu(), 1)
+        vecino.refresh_from_db()
+        self.assertEqual(vecino.ruta, 'A/01/012/')
+
+        self.empresa.ciiu = propio
+        self.empresa.save()
+        calcular_y_guardar_ratios(self.empresa, self.periodo)
+        otra = Empresa.objects.create(
+            nit='0614-010101-103-1', ciiu=vecino, nrc='3333333',
+            razon_social='Empresa Vecina', direccion='Dirección', telefono='2222-2222',
+            email='vecina@test.com'
+        )
+        ResultadoRatio.objects.create(
+            empresa=otra, periodo=Periodo.objects.create(empresa=otra, anio=2024),
+            ratio=ResultadoRatio.objects.filter(ratio__clave='LIQUIDEZ_CORRIENTE').first().ratio,
+            valor=Decimal('2.24')
+        )
+        with self.assertNumQueries(1):
+            self.assertEqual(ciiu_referencia(propio, minimo=2), ('01', 2))
+        self.assertEqual(ciiu_referencia(propio, minimo=1), ('011', 1))
+        self.assertEqual(ciiu_referencia(propio, minimo=5), ('A', 2))
+
+        call_command('refresh_estadisticas_sector', '--all', stdout=StringIO())
+        codigo, sector = benchmark_sector(propio, self.periodo, minimo=2)
+        self.assertEqual(codigo, '01')
+        self.assertEqual(sector['LIQUIDEZ_CORRIENTE']['n'], 2)
+        self.assertAlmostEqual(float(sector['LIQUIDEZ_CORRIENTE']['promedio']), 2.0)
+        # Recalcular la empresa refresca también las celdas de sus ancestros
+        self.assertEqual(
+            celdas_de_pares({(self.empresa.pk, self.periodo.pk)}),
+            {('011', 2024, None), ('01', 2024, None), ('A', 2024, None)}
+        )
+
+        # La vista de herramientas usa el fallback: con menos de MIN_EMPRESAS_SECTOR
+        # empresas en todos los niveles compara contra la raíz
+        self.user.is_superuser = True
+        self.user.save()
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('tools_finanzas'), {'nit': self.empresa.nit, 'per_act': self.periodo.pk})
+        self.assertEqual(response.context['ciiu_sector'], 'A')
+        liquidez = next(r for r in response.context['ratios_sector'] if r['clave'] == 'LIQUIDEZ_CORRIENTE')
+        self.assertEqual((liquidez['mediana_sector'], liquidez['n_sector']), (Decimal('2'), 2))
+
+        with tempfile.TemporaryDirectory() as tmp:
+            archivo = Path(tmp) / 'ratios_sector.json'
+            archivo.write_text(json.dumps({'01': {'LIQUIDEZ_CORRIENTE': 2}}), encoding='utf-8')
+            with mock.patch.object(ratios_sector, 'RATIOS_SECTOR_FILE', archivo):
+                comparacion = ratios_sector.obtener_comparacion_sector(
+                    self.empresa, [{'clave': 'LIQUIDEZ_CORRIENTE', 'valor': Decimal('1.76')}]
+                )
+        self.assertEqual(comparacion[0]['valor_sector'], Decimal('2'))
@@ -15,11 +15,18 @@ from django.contrib import messages
 from stela.models.empresa import Empresa
 from stela.models.finanzas import Periodo, Balance, BalanceDetalle, ResultadoRatio
 from stela.models.catalogo import Catalogo, GrupoCuenta, Cuenta
-from stela.services.analisis import analisis_vertical, analisis_horizontal
+from stela.services.cache_analisis import horizontal_cacheado, revisiones, tendencia_cacheada, vertical_cacheado
 from stela.services.ratios import calcular_y_guardar_ratios
-from stela.services.benchmark import benchmarking_por_ciiu, etiqueta_semaforo
+from stela.services.ratios_incremental import sin_recalculo_incremental
+from stela.services.benchmark import benchmark_sector, clasificar_semaforos, historico_ratios
 from stela.services.ratios_sector import obtener_comparacion_sector
-from stela.services.estados import recalcular_saldos_detalle
+from stela.services.estados import eliminar_periodos_vacios, recalcular_saldos_balances
+from stela.services.snapshot import PeriodSnapshot
+from stela.services.saldos_linea import saldos_recalculados
+from stela.services.cola_ratios import encolar_recalculo
+from stela.services.cubo import cubo_cuentas, cubo_ratios, periodos_empresa
+from stela.services.registro_ratios import huella_registro, ratio_por_clave, ratios_definidos
+from stela.services.version_datos import condicional_por_empresa
 from stela.services.plantillas import (
     generar_plantilla_catalogo_csv,
     generar_plantilla_catalogo_excel,
@@ -30,6 +37,7 @@ from stela.models.ciiu import Ciiu
 from stela.forms import CiiuForm, CatalogoUploadForm, CatalogoManualForm, MapeoCuentaForm
 from django.core.paginator import Paginator
 from django.http import HttpResponse, HttpResponseRedirect, JsonResponse
+from django.views.decorators.http import condition
 from decimal import Decimal
 import csv
 import io
@@ -40,13 +48,23 @@ from .forms.EmpresaForm import EmpresaForm,EmpresaEditForm
 from .models.empresa import Empresa
 from .models.finanzas import RatioDef, Periodo, ResultadoRatio, BalanceDetalle
 from .models.catalogo import Catalogo, Cuenta
-from django.db.models import F
+from django.db.models import Count, Exists, F, IntegerField, OuterRef, Prefetch, Subquery
+from django.db.models.functions import Coalesce
 
 # Create your views here.
 def landing(request):
     return render(request, "stela/landing.html")
 
 
+def _conteo_por_empresa(modelo):
+    """Subconsulta con la cantidad de filas de `modelo` de cada empresa (0 si no tiene)."""
+    conteo = (
+        modelo.objects.filter(empresa=OuterRef('pk')).order_by()
+        .values('empresa').annotate(n=Count('pk')).values('n')
+    )
+    return Coalesce(Subquery(conteo, output_field=IntegerField()), 0)
+
+
 @access_required('002')
 def dashboard(request):
     """Vista del dashboard con información de empresas y catálogos"""
@@ -65,25 +83,32 @@ def dashboard(request):
     if query:
         empresas = empresas.filter(razon_social__icontains=query)
     
+    # Catálogo y conteos en la misma consulta de empresas, y los últimos 5 períodos
+    # de todas en una segunda: dos consultas sin importar cuántas empresas haya
+    empresas = empresas.select_related('catalogo').annotate(
+        num_periodos=_conteo_por_empresa(Periodo),
+        num_balances=_conteo_por_empresa(Balance),
+    ).prefetch_related(
+        Prefetch('periodos', queryset=Periodo.objects.order_by('-anio', '-mes')[:5], to_attr='periodos_recientes')
+    )
+    
     # Obtener información de catálogos y estados financieros por empresa
     empresas_data = []
     for empresa in empresas:
-        catalogo = Catalogo.objects.filter(empresa=empresa).first()
-        periodos = Periodo.objects.filter(empresa=empresa).order_by('-anio', '-mes')
-        balances = Balance.objects.filter(empresa=empresa).select_related('periodo').order_by('-periodo__anio', '-periodo__mes')
+        catalogo = getattr(empresa, 'catalogo', None)
         
         empresas_data.append({
             'empresa': empresa,
             'catalogo': catalogo,
             'tiene_catalogo': catalogo is not None,
-            'num_periodos': periodos.count(),
-            'num_balances': balances.count(),
-            'periodos': periodos[:5],  # Últimos 5 períodos
+            'num_periodos': empresa.num_periodos,
+            'num_balances': empresa.num_balances,
+            'periodos': empresa.periodos_recientes,  # Últimos 5 períodos
         })
     
     context = {
         'empresas_data': empresas_data,
-        'tiene_empresas': empresas.exists(),
+        'tiene_empresas': bool(empresas_data),
         'query': query,
     }
     
@@ -103,35 +128,23 @@ def empresa_detalles(request, empresa_nit):
     if catalogo:
         cuentas = Cuenta.objects.filter(grupo__catalogo=catalogo).select_related('grupo').order_by('codigo')
     
-    # Obtener períodos que tienen al menos un balance
-    periodos = Periodo.objects.filter(
-        empresa=empresa,
-        balance__isnull=False
-    ).distinct().order_by('-anio', '-mes')
-    
-    # Eliminar períodos vacíos (sin balances)
-    periodos_vacios = Periodo.objects.filter(empresa=empresa).exclude(
-        id_periodo__in=periodos.values_list('id_periodo', flat=True)
+    # Todos los balances de la empresa (con sus detalles y cuentas) en tres consultas,
+    # agrupados por período en memoria. La vista no borra nada: los períodos vacíos
+    # se eliminan en eliminar_balance y con el comando purge_empty_periods.
+    balances = (
+        Balance.objects.filter(empresa=empresa)
+        .select_related('periodo')
+        .prefetch_related(Prefetch('detalles', queryset=BalanceDetalle.objects.select_related('cuenta')))
+        .order_by('-periodo__anio', '-periodo__mes', 'id_balance')
     )
-    
-    if periodos_vacios.exists():
-        # Guardar el conteo antes de eliminar
-        num_periodos_vacios = periodos_vacios.count()
-        # Eliminar ratios calculados para períodos vacíos primero
-        from stela.models.finanzas import ResultadoRatio
-        ResultadoRatio.objects.filter(periodo__in=periodos_vacios).delete()
-        # Eliminar los períodos vacíos
-        periodos_vacios.delete()
-        messages.info(request, f'Se eliminaron {num_periodos_vacios} período(s) vacío(s) sin estados financieros.')
-    
-    # Agrupar balances por período
     balances_por_periodo = {}
-    for periodo in periodos:
-        balances = Balance.objects.filter(empresa=empresa, periodo=periodo).select_related('periodo')
-        balances_por_periodo[periodo] = {
-            'balance': balances.filter(tipo_balance='BAL').first(),
-            'resultados': balances.filter(tipo_balance='RES').first(),
-        }
+    for balance in balances:
+        grupo = balances_por_periodo.setdefault(balance.periodo, {'balance': None, 'resultados': None})
+        clave = 'balance' if balance.tipo_balance == 'BAL' else 'resultados'
+        if grupo[clave] is None:
+            grupo[clave] = balance
+    # Solo los períodos que tienen al menos un balance
+    periodos = list(balances_por_periodo)
     
     context = {
         'empresa': empresa,
@@ -193,13 +206,9 @@ def eliminar_balance(request, balance_id):
             # Eliminar el balance (esto eliminará automáticamente todos los BalanceDetalle por CASCADE)
             balance.delete()
             
-            # Verificar si el período ya no tiene balances
-            balances_restantes = Balance.objects.filter(periodo=periodo).count()
-            
-            # Si no quedan balances, eliminar también los ratios calculados para ese período
-            if balances_restantes == 0:
-                ResultadoRatio.objects.filter(empresa=empresa, periodo=periodo).delete()
-                messages.info(request, f'Se eliminaron también los ratios calculados para el período {periodo}.')
+            # Si el período ya no tiene balances se elimina junto con sus ratios calculados
+            if eliminar_periodos_vacios(pk=periodo.pk):
+                messages.info(request, f'Se eliminaron también el período {periodo} y sus ratios calculados.')
             
             messages.success(request, f'{tipo_balance} del período {periodo} eliminado correctamente.')
             return redirect('empresa_detalles', empresa_nit=empresa.nit)
@@ -272,7 +281,7 @@ def tools_finanzas(request):
         return render(request, "tools/tools.html", ctx)
 
     # se cambio por el nuevo campo many to many
-    empresa = get_object_or_404(Empresa.objects.filter(usuario=request.user), nit=nit)
+    empresa = get_object_or_404(Empresa.objects.filter(usuario=request.user).select_related('ciiu'), nit=nit)
     p_act   = get_object_or_404(Periodo, pk=per_act_id)
 
     # CONSULTAR ratios ya calculados desde ResultadoRatio (no calcular)
@@ -290,14 +299,18 @@ def tools_finanzas(request):
             ratios_dict[clave] = {
                 'clave': clave,
                 'nombre': rr.ratio.nombre,
-                'valor': rr.valor
+                'valor': rr.valor,
+                # Rango percentil en su CIIU, guardado con el resultado (sin recorrer el sector)
+                'percentil': rr.percentil,
             }
     
     # Si no hay ratios guardados, intentar calcular en tiempo real como respaldo
     if not ratios_dict:
         try:
-            ratios_bal = calcular_y_guardar_ratios(empresa, p_act, tipo_estado='BAL')
-            ratios_res = calcular_y_guardar_ratios(empresa, p_act, tipo_estado='RES')
+            # Todos los detalles del período actual se cargan una sola vez
+            snapshot_act = PeriodSnapshot.cargar(empresa, p_act)
+            ratios_bal = calcular_y_guardar_ratios(empresa, p_act, tipo_estado='BAL', snapshot=snapshot_act)
+            ratios_res = calcular_y_guardar_ratios(empresa, p_act, tipo_estado='RES', snapshot=snapshot_act)
             for r in ratios_bal + ratios_res:
                 if r['clave'] not in ratios_dict:
                     ratios_dict[r['clave']] = r
@@ -310,96 +323,61 @@ def tools_finanzas(request):
     
     ratios = list(ratios_dict.values())
 
+    # Tendencia: todo el historial hasta el período actual, en una sola pasada por estado
+    historial = [
+        p for p in periodos_empresa(empresa)
+        if (p.anio, p.mes or 0) <= (p_act.anio, p_act.mes or 0)
+    ]
+    p_base = get_object_or_404(Periodo, pk=per_base_id) if per_base_id else None
+
+    # Los análisis salen de la cache mientras la revisión de cada balance no cambie
+    revs = revisiones(empresa, historial + [p_act] + ([p_base] if p_base else []))
+
     # Análisis Vertical - Estado de Resultados
-    vertical_act_res = analisis_vertical(empresa, p_act, 'RES')
+    vertical_act_res = vertical_cacheado(empresa, p_act, 'RES', revs=revs)
     vertical_base_res = []
     horizontal_rows_res = []
     
     # Análisis Vertical - Balance General
-    vertical_act_bal = analisis_vertical(empresa, p_act, 'BAL')
+    vertical_act_bal = vertical_cacheado(empresa, p_act, 'BAL', revs=revs)
     vertical_base_bal = []
     horizontal_rows_bal = []
 
     # Horizontal si hay base
-    if per_base_id:
-        p_base = get_object_or_404(Periodo, pk=per_base_id)
+    if p_base:
         # Estado de Resultados
-        horizontal_rows_res = analisis_horizontal(empresa, p_base, p_act, 'RES')
-        vertical_base_res = analisis_vertical(empresa, p_base, 'RES')
+        horizontal_rows_res = horizontal_cacheado(empresa, p_base, p_act, 'RES', revs=revs)
+        vertical_base_res = vertical_cacheado(empresa, p_base, 'RES', revs=revs)
         # Balance General
-        horizontal_rows_bal = analisis_horizontal(empresa, p_base, p_act, 'BAL')
-        vertical_base_bal = analisis_vertical(empresa, p_base, 'BAL')
-
-    # Benchmark: Promedio histórico de la misma empresa (todos los períodos)
-    ratios_bench = []
-    from decimal import Decimal
-    from statistics import mean, pstdev
-    
-    # Obtener todos los períodos de la empresa con ratios calculados
-    periodos_empresa = Periodo.objects.filter(
-        empresa=empresa,
-        resultadoratio__isnull=False
-    ).distinct()
-    
-    for r in ratios:
-        # Buscar el ratio definido
-        try:
-            ratio_def = RatioDef.objects.get(clave=r['clave'])
-        except RatioDef.DoesNotExist:
-            continue
-        
-        # Obtener todos los valores históricos de este ratio para la empresa
-        valores_historicos = list(
-            ResultadoRatio.objects.filter(
-                empresa=empresa,
-                ratio=ratio_def,
-                periodo__in=periodos_empresa,
-                valor__isnull=False
-            ).values_list('valor', flat=True)
-        )
-        
-        if valores_historicos and len(valores_historicos) > 0:
-            # Calcular promedio y desviación estándar
-            valores_decimal = [Decimal(str(v)) for v in valores_historicos]
-            prom_historico = Decimal(mean(valores_decimal))
-            desv_historico = Decimal(pstdev(valores_decimal)) if len(valores_decimal) > 1 else Decimal('0')
-            
-            # Comparar valor actual con promedio histórico
-            valor_actual = r.get('valor')
-            if valor_actual is not None:
-                # Calcular semáforo comparando valor actual vs promedio histórico
-                if desv_historico == 0:
-                    sem = 'OK' if valor_actual == prom_historico else ('ALTO' if valor_actual > prom_historico else 'BAJO')
-                else:
-                    k = Decimal('1')
-                    if valor_actual > prom_historico + k * desv_historico:
-                        sem = 'ALTO'
-                    elif valor_actual < prom_historico - k * desv_historico:
-                        sem = 'BAJO'
-                    else:
-                        sem = 'OK'
-            else:
-                sem = 'NA'
-            
-            ratios_bench.append({
-                **r,
-                'promedio': prom_historico,
-                'desv': desv_historico,
-                'semaforo': sem
-            })
-        else:
-            # Si no hay valores históricos, mostrar solo el valor actual
-            ratios_bench.append({
-                **r,
-                'promedio': None,
-                'desv': None,
-                'semaforo': 'NA'
-            })
+        horizontal_rows_bal = horizontal_cacheado(empresa, p_base, p_act, 'BAL', revs=revs)
+        vertical_base_bal = vertical_cacheado(empresa, p_base, 'BAL', revs=revs)
+
+    tendencia_res = tendencia_cacheada(empresa, historial, 'RES', revs=revs)
+    tendencia_bal = tendencia_cacheada(empresa, historial, 'BAL', revs=revs)
+
+    # Benchmark: historia de la misma empresa (todos los períodos), una consulta agrupada por ratio
+    historico = historico_ratios(empresa, claves=[r['clave'] for r in ratios])
+    ratios_bench = clasificar_semaforos([
+        {
+            **r,
+            **historico.get(r['clave'], {'promedio': None, 'desv': None, 'minimo': None, 'maximo': None}),
+        }
+        for r in ratios
+        if ratio_por_clave(r['clave']) is not None
+    ])
 
-    # Comparación con parámetros de sector (ratios digitados)
+    # Comparación con parámetros de sector (ratios digitados) y con las empresas
+    # del sector: si el CIIU tiene pocas empresas se usa su ancestro más cercano
+    # que las tenga (dos consultas: conteo por nivel y celda de EstadisticaSector)
     ratios_sector = []
-    if empresa.ciiu:
+    ciiu_sector = None
+    if empresa.ciiu_id:
         ratios_sector = obtener_comparacion_sector(empresa, ratios)
+        ciiu_sector, empresas_sector = benchmark_sector(empresa.ciiu, p_act)
+        for r in ratios_sector:
+            stats = empresas_sector.get(r['clave'], {})
+            r['mediana_sector'] = stats.get('p50')
+            r['n_sector'] = stats.get('n')
     
     # Contar períodos con ratios para validar botón de gráficas
     periodos_con_ratios = Periodo.objects.filter(
@@ -420,9 +398,13 @@ def tools_finanzas(request):
         'vertical_act_bal': vertical_act_bal,
         'vertical_base_bal': vertical_base_bal,
         'horizontal_rows_bal': horizontal_rows_bal,
+        # Tendencia multi-período
+        'tendencia_res': tendencia_res,
+        'tendencia_bal': tendencia_bal,
         # Ratios
         'ratios_rows': ratios_bench or ratios,
         'ratios_sector': ratios_sector,
+        'ciiu_sector': ciiu_sector,
         'puede_ver_graficas': puede_ver_graficas,
         'periodos_con_ratios': periodos_con_ratios,
     })
@@ -908,158 +890,162 @@ def catalogo_upload_csv(request):
                 messages.error(request, 'El formato CSV está deprecado. Por favor usa el formato Excel (.xlsx o .xls)')
                 return redirect('catalogo_upload')
             
-            for i, row in enumerate(reader, start=2):
-                try:
-                    codigo = row.get('codigo', '').strip()
-                    nombre = row.get('nombre', '').strip()
-                    grupo_nombre = row.get('grupo', '').strip()
-                    naturaleza = row.get('naturaleza', '').strip()
-                    bg_bloque = row.get('bg_bloque', '').strip()
-                    er_bloque = row.get('er_bloque', '').strip()
-                    ratio_tag = row.get('ratio_tag', '').strip()
-                    tipo_estado = row.get('tipo_estado', 'BAL').strip().upper()
-                    
-                    # Convertir debe y haber de forma segura
+            # En el paso 3 saldos y ratios se recalculan completos al final:
+            # sin recálculo incremental por cada BalanceDetalle guardado
+            with sin_recalculo_incremental():
+                for i, row in enumerate(reader, start=2):
                     try:
-                        debe_str = str(row.get('debe', '0') or '0').strip()
-                        debe = Decimal(debe_str) if debe_str else Decimal('0')
-                    except (ValueError, TypeError, Exception):
-                        debe = Decimal('0')
+                        codigo = row.get('codigo', '').strip()
+                        nombre = row.get('nombre', '').strip()
+                        grupo_nombre = row.get('grupo', '').strip()
+                        naturaleza = row.get('naturaleza', '').strip()
+                        bg_bloque = row.get('bg_bloque', '').strip()
+                        er_bloque = row.get('er_bloque', '').strip()
+                        ratio_tag = row.get('ratio_tag', '').strip()
+                        tipo_estado = row.get('tipo_estado', 'BAL').strip().upper()
                     
-                    try:
-                        haber_str = str(row.get('haber', '0') or '0').strip()
-                        haber = Decimal(haber_str) if haber_str else Decimal('0')
-                    except (ValueError, TypeError, Exception):
-                        haber = Decimal('0')
-                    
-                    if not codigo:
-                        errores.append(f"Fila {i}: Falta código de cuenta")
-                        continue
+                        # Convertir debe y haber de forma segura
+                        try:
+                            debe_str = str(row.get('debe', '0') or '0').strip()
+                            debe = Decimal(debe_str) if debe_str else Decimal('0')
+                        except (ValueError, TypeError, Exception):
+                            debe = Decimal('0')
                     
-                    # Buscar cuenta en el catálogo para obtener información faltante
-                    cuenta_existente = None
-                    if codigo:
-                        cuenta_existente = Cuenta.objects.filter(
-                            grupo__catalogo=catalogo,
-                            codigo=codigo
-                        ).select_related('grupo').first()
+                        try:
+                            haber_str = str(row.get('haber', '0') or '0').strip()
+                            haber = Decimal(haber_str) if haber_str else Decimal('0')
+                        except (ValueError, TypeError, Exception):
+                            haber = Decimal('0')
                     
-                    # Si la cuenta existe, usar sus datos para completar información faltante
-                    if cuenta_existente:
-                        if not grupo_nombre:
-                            grupo_nombre = cuenta_existente.grupo.nombre
-                        if not naturaleza:
-                            naturaleza = cuenta_existente.grupo.naturaleza
-                        if not nombre:
-                            nombre = cuenta_existente.nombre
-                        if not bg_bloque and cuenta_existente.bg_bloque:
-                            bg_bloque = cuenta_existente.bg_bloque
-                        if not er_bloque and cuenta_existente.er_bloque:
-                            er_bloque = cuenta_existente.er_bloque
-                        if not ratio_tag and cuenta_existente.ratio_tag:
-                            ratio_tag = cuenta_existente.ratio_tag
-                        cuenta = cuenta_existente
-                    else:
-                        # Si la cuenta no existe, solo continuar si es paso 3 (estados financieros)
-                        # En paso 3, si no existe la cuenta, simplemente la ignoramos
-                        if paso == '3':
-                            # En estados financieros, si la cuenta no existe, la ignoramos
-                            # El subtotal se mostrará en 0
+                        if not codigo:
+                            errores.append(f"Fila {i}: Falta código de cuenta")
                             continue
+                    
+                        # Buscar cuenta en el catálogo para obtener información faltante
+                        cuenta_existente = None
+                        if codigo:
+                            cuenta_existente = Cuenta.objects.filter(
+                                grupo__catalogo=catalogo,
+                                codigo=codigo
+                            ).select_related('grupo').first()
+                    
+                        # Si la cuenta existe, usar sus datos para completar información faltante
+                        if cuenta_existente:
+                            if not grupo_nombre:
+                                grupo_nombre = cuenta_existente.grupo.nombre
+                            if not naturaleza:
+                                naturaleza = cuenta_existente.grupo.naturaleza
+                            if not nombre:
+                                nombre = cuenta_existente.nombre
+                            if not bg_bloque and cuenta_existente.bg_bloque:
+                                bg_bloque = cuenta_existente.bg_bloque
+                            if not er_bloque and cuenta_existente.er_bloque:
+                                er_bloque = cuenta_existente.er_bloque
+                            if not ratio_tag and cuenta_existente.ratio_tag:
+                                ratio_tag = cuenta_existente.ratio_tag
+                            cuenta = cuenta_existente
+                        else:
+                            # Si la cuenta no existe, solo continuar si es paso 3 (estados financieros)
+                            # En paso 3, si no existe la cuenta, simplemente la ignoramos
+                            if paso == '3':
+                                # En estados financieros, si la cuenta no existe, la ignoramos
+                                # El subtotal se mostrará en 0
+                                continue
                         
-                        # En paso 2 (catálogo), necesitamos crear la cuenta
-                        # Validar que tengamos los datos mínimos
-                        if not nombre or not grupo_nombre:
-                            errores.append(f"Fila {i}: Faltan campos obligatorios (nombre o grupo) para crear cuenta {codigo}")
-                            continue
+                            # En paso 2 (catálogo), necesitamos crear la cuenta
+                            # Validar que tengamos los datos mínimos
+                            if not nombre or not grupo_nombre:
+                                errores.append(f"Fila {i}: Faltan campos obligatorios (nombre o grupo) para crear cuenta {codigo}")
+                                continue
                         
-                        # Crear o obtener grupo
-                        grupo, _ = GrupoCuenta.objects.get_or_create(
-                            catalogo=catalogo,
-                            nombre=grupo_nombre,
-                            defaults={'naturaleza': naturaleza}
-                        )
+                            # Crear o obtener grupo
+                            grupo, _ = GrupoCuenta.objects.get_or_create(
+                                catalogo=catalogo,
+                                nombre=grupo_nombre,
+                                defaults={'naturaleza': naturaleza}
+                            )
                         
-                        # Actualizar naturaleza si no tenía
-                        if not grupo.naturaleza and naturaleza:
-                            grupo.naturaleza = naturaleza
-                            grupo.save()
+                            # Actualizar naturaleza si no tenía
+                            if not grupo.naturaleza and naturaleza:
+                                grupo.naturaleza = naturaleza
+                                grupo.save()
                         
-                        # Crear cuenta
-                        cuenta, created = Cuenta.objects.get_or_create(
-                            grupo=grupo,
-                            codigo=codigo,
-                            defaults={
-                                'nombre': nombre, 
-                                'aparece_en_balance': True,
-                                'bg_bloque': bg_bloque if bg_bloque else None,
-                                'er_bloque': er_bloque if er_bloque else None,
-                                'ratio_tag': ratio_tag if ratio_tag else None
-                            }
-                        )
+                            # Crear cuenta
+                            cuenta, created = Cuenta.objects.get_or_create(
+                                grupo=grupo,
+                                codigo=codigo,
+                                defaults={
+                                    'nombre': nombre, 
+                                    'aparece_en_balance': True,
+                                    'bg_bloque': bg_bloque if bg_bloque else None,
+                                    'er_bloque': er_bloque if er_bloque else None,
+                                    'ratio_tag': ratio_tag if ratio_tag else None
+                                }
+                            )
                         
-                        # Actualizar nombre, bloques y ratio_tag si cambiaron
-                        actualizar = False
-                        if cuenta.nombre != nombre:
-                            cuenta.nombre = nombre
-                            actualizar = True
-                        if bg_bloque and cuenta.bg_bloque != bg_bloque:
-                            cuenta.bg_bloque = bg_bloque
-                            actualizar = True
-                        if er_bloque and cuenta.er_bloque != er_bloque:
-                            cuenta.er_bloque = er_bloque
-                            actualizar = True
-                        if ratio_tag and cuenta.ratio_tag != ratio_tag:
-                            cuenta.ratio_tag = ratio_tag
-                            actualizar = True
-                        if actualizar:
-                            cuenta.save()
+                            # Actualizar nombre, bloques y ratio_tag si cambiaron
+                            actualizar = False
+                            if cuenta.nombre != nombre:
+                                cuenta.nombre = nombre
+                                actualizar = True
+                            if bg_bloque and cuenta.bg_bloque != bg_bloque:
+                                cuenta.bg_bloque = bg_bloque
+                                actualizar = True
+                            if er_bloque and cuenta.er_bloque != er_bloque:
+                                cuenta.er_bloque = er_bloque
+                                actualizar = True
+                            if ratio_tag and cuenta.ratio_tag != ratio_tag:
+                                cuenta.ratio_tag = ratio_tag
+                                actualizar = True
+                            if actualizar:
+                                cuenta.save()
                     
-                    # En paso 2 solo se crean cuentas, no balances
-                    # En paso 3 se crean balances con debe/haber
-                    if paso == '3':
-                        # Si hay debe/haber, crear balance y detalle
-                        # Solo procesar si la cuenta existe (si no existe, se ignoró arriba)
-                        # Procesar incluso si debe y haber son 0, para tener el registro completo
-                        if cuenta:
-                            # Crear o obtener balance según tipo
-                            if tipo_estado not in balances_por_tipo:
-                                balance, _ = Balance.objects.get_or_create(
-                                    empresa=empresa,
-                                    periodo=periodo,
-                                    tipo_balance=tipo_estado
-                                )
-                                balances_por_tipo[tipo_estado] = balance
-                            else:
-                                balance = balances_por_tipo[tipo_estado]
+                        # En paso 2 solo se crean cuentas, no balances
+                        # En paso 3 se crean balances con debe/haber
+                        if paso == '3':
+                            # Si hay debe/haber, crear balance y detalle
+                            # Solo procesar si la cuenta existe (si no existe, se ignoró arriba)
+                            # Procesar incluso si debe y haber son 0, para tener el registro completo
+                            if cuenta:
+                                # Crear o obtener balance según tipo
+                                if tipo_estado not in balances_por_tipo:
+                                    balance, _ = Balance.objects.get_or_create(
+                                        empresa=empresa,
+                                        periodo=periodo,
+                                        tipo_balance=tipo_estado
+                                    )
+                                    balances_por_tipo[tipo_estado] = balance
+                                else:
+                                    balance = balances_por_tipo[tipo_estado]
                             
-                            # Crear o actualizar detalle de balance
-                            detalle, created = BalanceDetalle.objects.get_or_create(
-                                balance=balance,
-                                cuenta=cuenta,
-                                defaults={'debe': debe, 'haber': haber}
-                            )
-                            if not created:
-                                detalle.debe = debe
-                                detalle.haber = haber
-                                detalle.save()
+                                # Crear o actualizar detalle de balance
+                                detalle, created = BalanceDetalle.objects.get_or_create(
+                                    balance=balance,
+                                    cuenta=cuenta,
+                                    defaults={'debe': debe, 'haber': haber}
+                                )
+                                if not created:
+                                    detalle.debe = debe
+                                    detalle.haber = haber
+                                    detalle.save(update_fields=['debe', 'haber'])
                     
-                    creados += 1
+                        creados += 1
                     
-                except Exception as e:
-                    errores.append(f"Fila {i}: {str(e)}")
+                    except Exception as e:
+                        errores.append(f"Fila {i}: {str(e)}")
             
             # Recalcular saldos solo en paso 3 (cuando se crean balances)
             if paso == '3':
-                for balance in balances_por_tipo.values():
-                    recalcular_saldos_detalle(balance)
+                recalcular_saldos_balances(list(balances_por_tipo.values()))
+                saldos_recalculados(list(balances_por_tipo.values()))
                 
                 # Calcular ratios automáticamente después de cargar estados financieros
                 if periodo:
                     try:
-                        # Calcular ratios para ambos tipos de estado
-                        ratios_bal = calcular_y_guardar_ratios(empresa, periodo, tipo_estado='BAL')
-                        ratios_res = calcular_y_guardar_ratios(empresa, periodo, tipo_estado='RES')
+                        # Calcular ratios para ambos tipos de estado (mismo snapshot del período)
+                        snapshot = PeriodSnapshot.cargar(empresa, periodo)
+                        ratios_bal = calcular_y_guardar_ratios(empresa, periodo, tipo_estado='BAL', snapshot=snapshot)
+                        ratios_res = calcular_y_guardar_ratios(empresa, periodo, tipo_estado='RES', snapshot=snapshot)
                         # Contar ratios calculados con valores
                         num_ratios = len([r for r in ratios_bal + ratios_res if r['valor'] is not None])
                         if num_ratios > 0:
@@ -1223,43 +1209,46 @@ def catalogo_mapeo_cuentas(request, catalogo_id):
         form = MapeoCuentaForm(request.POST, catalogo=catalogo)
         if form.is_valid():
             from stela.models.finanzas import LineaEstado, MapeoCuentaLinea
-            
-            # Procesar cada campo del formulario (ahora puede tener múltiples cuentas)
-            for field_name, cuentas_seleccionadas in form.cleaned_data.items():
-                if field_name.startswith('linea_') and cuentas_seleccionadas:
-                    clave_linea = field_name.replace('linea_', '')
-                    try:
-                        linea = LineaEstado.objects.get(clave=clave_linea)
+            from stela.services.mapeo_automatico import reescritura_mapeos
+
+            # Los mapeos cambian fila por fila; el índice del catálogo se descarta una vez al salir
+            with reescritura_mapeos(catalogo):
+                # Procesar cada campo del formulario (ahora puede tener múltiples cuentas)
+                for field_name, cuentas_seleccionadas in form.cleaned_data.items():
+                    if field_name.startswith('linea_') and cuentas_seleccionadas:
+                        clave_linea = field_name.replace('linea_', '')
+                        try:
+                            linea = LineaEstado.objects.get(clave=clave_linea)
                         
-                        # Eliminar TODOS los mapeos existentes para esta línea en este catálogo
-                        MapeoCuentaLinea.objects.filter(
-                            linea=linea,
-                            cuenta__grupo__catalogo=catalogo
-                        ).delete()
+                            # Eliminar TODOS los mapeos existentes para esta línea en este catálogo
+                            MapeoCuentaLinea.objects.filter(
+                                linea=linea,
+                                cuenta__grupo__catalogo=catalogo
+                            ).delete()
                         
-                        # Crear nuevos mapeos para cada cuenta seleccionada
-                        cuentas_mapeadas = 0
-                        for cuenta in cuentas_seleccionadas:
-                            # Para UTILIDAD_NETA, el signo se determina por la naturaleza de la cuenta
-                            # pero se aplicará correctamente en estado_dict
-                            signo = 1  # Por defecto positivo
-                            if clave_linea == 'UTILIDAD_NETA':
-                                # El signo se ajustará en estado_dict según naturaleza y bloque
-                                # Aquí solo guardamos 1, el cálculo real se hace en estado_dict
-                                signo = 1
+                            # Crear nuevos mapeos para cada cuenta seleccionada
+                            cuentas_mapeadas = 0
+                            for cuenta in cuentas_seleccionadas:
+                                # Para UTILIDAD_NETA, el signo se determina por la naturaleza de la cuenta
+                                # pero se aplicará correctamente en estado_dict
+                                signo = 1  # Por defecto positivo
+                                if clave_linea == 'UTILIDAD_NETA':
+                                    # El signo se ajustará en estado_dict según naturaleza y bloque
+                                    # Aquí solo guardamos 1, el cálculo real se hace en estado_dict
+                                    signo = 1
                             
-                            MapeoCuentaLinea.objects.create(
-                                cuenta=cuenta,
-                                linea=linea,
-                                signo=signo
-                            )
-                            cuentas_mapeadas += 1
+                                MapeoCuentaLinea.objects.create(
+                                    cuenta=cuenta,
+                                    linea=linea,
+                                    signo=signo
+                                )
+                                cuentas_mapeadas += 1
                         
-                        if cuentas_mapeadas > 0:
-                            messages.info(request, f'{linea.nombre}: {cuentas_mapeadas} cuenta(s) mapeada(s)')
-                    except LineaEstado.DoesNotExist:
-                        pass
-            
+                            if cuentas_mapeadas > 0:
+                                messages.info(request, f'{linea.nombre}: {cuentas_mapeadas} cuenta(s) mapeada(s)')
+                        except LineaEstado.DoesNotExist:
+                            pass
+
             messages.success(request, 'Mapeo de cuentas guardado correctamente.')
             return redirect('dashboard')
     else:
@@ -1373,22 +1362,32 @@ def descargar_plantilla_estados_excel(request, catalogo_id):
     return response
 
 
+def _nit_activo(request):
+    """NIT de la empresa activa guardado en sesión."""
+    return request.session.get('active_company_nit')
+
+
+# Las APIs JSON responden 304 si el cliente ya tiene la versión actual de los
+# datos (ETag/Last-Modified por empresa, ver services/version_datos.py)
 @login_required
+@condition(etag_func=lambda request: f'ratios-{huella_registro()}')
 def get_ratios_api(request):
     """
     API que devuelve la lista de TODAS las definiciones de ratios
     (Esto es global, así que está bien como estaba).
     """
     try:
-        ratios = RatioDef.objects.all().values(
-            'clave', 'nombre', 'formula'
-        )
-        return JsonResponse(list(ratios), safe=False)
+        ratios = [
+            {'clave': r.clave, 'nombre': r.nombre, 'formula': r.formula}
+            for r in ratios_definidos()
+        ]
+        return JsonResponse(ratios, safe=False)
     except Exception as e:
         return JsonResponse({'error': str(e)}, status=500)
 
 
 @login_required
+@condicional_por_empresa('cuentas', _nit_activo)
 def get_cuentas_api(request):
     """
     API que devuelve la lista de cuentas del catálogo
@@ -1423,6 +1422,7 @@ def get_cuentas_api(request):
 
 
 @login_required
+@condicional_por_empresa('grafica', _nit_activo, extra=huella_registro)
 def get_chart_data_api(request):
     """
     API que devuelve los datos (labels y datasets) para un conjunto
@@ -1440,68 +1440,50 @@ def get_chart_data_api(request):
         if not active_nit:
             return JsonResponse({'error': 'No hay empresa activa seleccionada'}, status=404)
 
-        # Asumimos que la relación de usuario a empresa es 'usuario' (ManyToMany)
-        empresa = get_object_or_404(Empresa.objects.filter(usuario=request.user), nit=active_nit)
-        # --- Fin de la obtención ---
-
-        periodos = Periodo.objects.filter(empresa=empresa).order_by('anio', 'mes')
-        if not periodos.exists():
+        # Períodos y empresa (con su control de acceso) en una sola consulta;
+        # solo si no hay períodos hace falta distinguir "sin datos" de "sin acceso"
+        periodos = list(
+            Periodo.objects.filter(empresa__nit=active_nit, empresa__usuario=request.user)
+            .select_related('empresa').order_by('anio', 'mes')
+        )
+        if not periodos:
+            get_object_or_404(Empresa.objects.filter(usuario=request.user), nit=active_nit)
             return JsonResponse({'labels': [], 'datasets': []})  # No hay datos para graficar
+        empresa = periodos[0].empresa
+        # --- Fin de la obtención ---
 
         labels = [f"{p.anio}-{p.mes:02d}" if p.mes else str(p.anio) for p in periodos]
         datasets = []
 
+        # Cada tipo se resuelve con un cubo (filas x períodos) de una sola consulta;
+        # los períodos sin dato se grafican como 0. En total: ratios 2 consultas,
+        # cuentas 3 (más sus nombres), sin importar cuántos ids ni períodos.
         if data_type == 'ratios':
             # --- Lógica de Ratios ---
-            for ratio_clave in item_ids:
-                try:
-                    ratio_def = RatioDef.objects.get(clave=ratio_clave)
-                    valores = []
-                    for p in periodos:
-                        # Buscamos el valor del ratio para ese período
-                        r_res = ResultadoRatio.objects.filter(
-                            empresa=empresa,
-                            periodo=p,
-                            ratio=ratio_def
-                        ).first()
-                        # Añadimos el valor o 0 si no existe
-                        valores.append(float(r_res.valor) if r_res and r_res.valor is not None else 0)
-
-                    datasets.append({
-                        'label': ratio_def.nombre,
-                        'data': valores,
-                    })
-                except RatioDef.DoesNotExist:
-                    pass  # Ignora si la clave del ratio es incorrecta
+            ratio_defs = [r for r in (ratio_por_clave(c) for c in item_ids) if r is not None]  # Ignora claves incorrectas
+            cubo = cubo_ratios(empresa, periodos, claves=[r.clave for r in ratio_defs])
+            for ratio_def in ratio_defs:
+                datasets.append({
+                    'label': ratio_def.nombre,
+                    'data': np.nan_to_num(cubo.serie(ratio_def.clave)).tolist(),
+                })
 
         elif data_type == 'cuentas':
-            # --- Lógica de Cuentas (Corregida) ---
-            for cuenta_id in item_ids:
-                try:
-                    # ¡CORREGIDO! Buscamos por el nombre real del campo en la BD
-                    cuenta = Cuenta.objects.get(id_cuenta=cuenta_id)
-
-                    # Validar que la cuenta pertenezca a la empresa activa
-                    if cuenta.grupo.catalogo.empresa != empresa:
-                        continue  # Esta cuenta no es de esta empresa
-
-                    valores = []
-                    for p in periodos:
-                        # Buscamos el saldo de esa cuenta para ese período
-                        bd = BalanceDetalle.objects.filter(
-                            balance__empresa=empresa,
-                            balance__periodo=p,
-                            cuenta=cuenta
-                        ).first()
-                        # Añadimos el saldo o 0 si no existe
-                        valores.append(float(bd.saldo) if bd and bd.saldo is not None else 0)
-
-                    datasets.append({
-                        'label': f"{cuenta.codigo} - {cuenta.nombre}",
-                        'data': valores,
-                    })
-                except Cuenta.DoesNotExist:
-                    pass  # Ignora si el ID de cuenta es incorrecto
+            # --- Lógica de Cuentas ---
+            # Solo cuentas del catálogo de la empresa activa (ignora IDs incorrectos)
+            ids = [int(c) for c in item_ids if str(c).isdigit()]
+            cuentas = {
+                c.id_cuenta: c
+                for c in Cuenta.objects.filter(id_cuenta__in=ids, grupo__catalogo__empresa=empresa)
+            }
+            ids = [i for i in ids if i in cuentas]
+            cubo = cubo_cuentas(empresa, periodos, cuentas=ids)
+            for cuenta_id in ids:
+                cuenta = cuentas[cuenta_id]
+                datasets.append({
+                    'label': f"{cuenta.codigo} - {cuenta.nombre}",
+                    'data': np.nan_to_num(cubo.serie(cuenta_id)).tolist(),
+                })
 
         return JsonResponse({'labels': labels, 'datasets': datasets})
 
@@ -1538,6 +1520,7 @@ def set_active_company(request, empresa_nit):
 
 
 @login_required
+@condicional_por_empresa('periodos', lambda request: request.GET.get('empresa_id'))
 def get_periodos_api(request):
     """
     API que devuelve los períodos disponibles para una empresa según el tipo de estado.
@@ -1583,6 +1566,7 @@ def get_periodos_api(request):
         return JsonResponse({'error': str(e)}, status=500)
 
 @login_required
+@condicional_por_empresa('series', lambda request: request.GET.get('empresa'), extra=huella_registro)
 def ratios_series_json(request):
     """
     API que devuelve datos de ratios para múltiples períodos de una empresa.
@@ -1602,11 +1586,15 @@ def ratios_series_json(request):
             nit=empresa_nit
         )
         
-        # Obtener todos los períodos de la empresa ordenados
-        periodos = Periodo.objects.filter(empresa=empresa).order_by('anio', 'mes')
+        # Obtener todos los períodos de la empresa ordenados (y si tienen estados cargados)
+        periodos = list(
+            Periodo.objects.filter(empresa=empresa)
+            .annotate(con_balance=Exists(Balance.objects.filter(periodo=OuterRef('pk'))))
+            .order_by('anio', 'mes')
+        )
         
-        if not periodos.exists():
-            return JsonResponse({'anios': [], 'series': {}})
+        if not periodos:
+            return JsonResponse({'anios': [], 'series': {}, 'pendientes': []})
         
         # Crear labels para los períodos
         anios = []
@@ -1625,45 +1613,44 @@ def ratios_series_json(request):
                 'ROA',
                 'ROE'
             ]
+        ratio_defs = [r for r in (ratio_por_clave(c) for c in ratio_claves) if r is not None]
+        
+        # Solo lectura: valores guardados de todos los ratios y períodos (una consulta).
+        # Una fila con valor NULL es un ratio ya calculado sin resultado (ej. división entre 0).
+        guardados = {
+            (clave, periodo_id): valor
+            for clave, periodo_id, valor in ResultadoRatio.objects.filter(
+                empresa=empresa, periodo__in=periodos, ratio__clave__in=[r.clave for r in ratio_defs]
+            ).values_list('ratio__clave', 'periodo_id', 'valor')
+        }
+        
+        # Los períodos con estados cargados a los que les faltan filas se recalculan
+        # en segundo plano (cola sin duplicados, ver process_ratio_queue)
+        pendientes = [
+            j for j, p in enumerate(periodos)
+            if p.con_balance and any((r.clave, p.pk) not in guardados for r in ratio_defs)
+        ]
+        if pendientes:
+            encolar_recalculo((empresa.pk, periodos[j].pk) for j in pendientes)
         
         # Obtener datos de cada ratio
         series = {}
-        for ratio_clave in ratio_claves:
-            try:
-                ratio_def = RatioDef.objects.get(clave=ratio_clave)
-                valores = []
-                for p in periodos:
-                    r_res = ResultadoRatio.objects.filter(
-                        empresa=empresa,
-                        periodo=p,
-                        ratio=ratio_def
-                    ).first()
-                    
-                    if r_res and r_res.valor is not None:
-                        # Usar valor guardado (más rápido)
-                        valores.append(float(r_res.valor))
-                    else:
-                        # Calcular en tiempo real si no está guardado (respaldo)
-                        try:
-                            ratios_calc = calcular_y_guardar_ratios(empresa, p, tipo_estado='RES')
-                            ratio_encontrado = next((r for r in ratios_calc if r['clave'] == ratio_clave), None)
-                            if ratio_encontrado and ratio_encontrado['valor'] is not None:
-                                valores.append(float(ratio_encontrado['valor']))
-                            else:
-                                valores.append(None)
-                        except Exception:
-                            valores.append(None)
-                
-                series[ratio_clave] = {
-                    'nombre': ratio_def.nombre,
-                    'valores': valores
-                }
-            except RatioDef.DoesNotExist:
-                continue
+        for ratio_def in ratio_defs:
+            valores = []
+            for p in periodos:
+                valor = guardados.get((ratio_def.clave, p.pk))
+                valores.append(float(valor) if valor is not None else None)
+            
+            series[ratio_def.clave] = {
+                'nombre': ratio_def.nombre,
+                'valores': valores
+            }
         
         return JsonResponse({
             'anios': anios,
-            'series': series
+            'series': series,
+            # Períodos (etiquetas de 'anios') cuyos puntos aún se están recalculando
+            'pendientes': [anios[j] for j in pendientes],
         })
         
     except Exception as e:
@@ -1707,14 +1694,13 @@ def ratios_graficas_modal(request):
         
         ratios_info = []
         for clave in ratios_claves:
-            try:
-                ratio_def = RatioDef.objects.get(clave=clave)
-                ratios_info.append({
-                    'clave': clave,
-                    'nombre': ratio_def.nombre
-                })
-            except RatioDef.DoesNotExist:
+            ratio_def = ratio_por_clave(clave)
+            if ratio_def is None:
                 continue
+            ratios_info.append({
+                'clave': clave,
+                'nombre': ratio_def.nombre
+            })
         
         return JsonResponse({
             'empresa_nit': empresa_nit,